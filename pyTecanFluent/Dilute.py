@@ -80,6 +80,10 @@ def parse_args(test_args=None, subparsers=None):
                       help='Sample liquid class (default: %(default)s)')
     dil.add_argument('--reuse-tips', action='store_true', default=False,
                       help='Re-use tips for each dispense of dilutant? (default: %(default)s)')
+    dil.add_argument('--dil-multi-disp', action='store_true', default=False,
+                     help='Multi-dispense dilutant (as many wells per aspiration as fit in the tip) (default: %(default)s)')
+    dil.add_argument('--reagent-dist', action='store_true', default=False,
+                     help='Use Reagent_distribution (R) commands for runs of uniform reagent dispenses; requires FCA waste source labware (default: %(default)s)')
         
     ## destination plate
     dest = parser.add_argument_group('Destination labware')
@@ -142,11 +146,16 @@ def main(args=None):
                  src_labware_name=args.dil_labware_name,
                  src_labware_type=args.dil_labware_type,
                  liq_cls=args.dil_liq,
-                 reuse_tips=args.reuse_tips)
+                 reuse_tips=args.reuse_tips,
+                 multi_disp=args.dil_multi_disp)
     ## Sample
     pip_samples(df_conc, gwl=gwl,
                 liq_cls=args.samp_liq)
     
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+    
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '.gwl'
     gwl.write(gwl_file)
@@ -427,55 +436,70 @@ def reorder_384well(df, reorder_col):
     return df
 
 def pip_dilutant(df_conc, gwl, src_labware_name, src_labware_type=None,
-                 liq_cls='Water Free Single', reuse_tips=False):
+                 liq_cls='Water Free Single', reuse_tips=False,
+                 multi_disp=False, disp_frac=0.95):
     """Commands for aliquoting dilutant.
+    multi_disp : multi-dispense dilutant (see Fluent.multi_disp); reuse_tips is ignored
+    disp_frac : fraction of the aspirated volume that is dispensed (multi-dispense)
     """
     gwl.add(Fluent.Comment('Dilutant'))
-    # filtering by volume range
-    DTH_vols = list(gwl.get_DTH_volumes().values())
-    DTH_vols = sorted(DTH_vols)
-    DTH_vols = zip([-1] + DTH_vols[:-1], DTH_vols)
+    # multi-dispense
+    if multi_disp is True:
+        md = Fluent.multi_disp()
+        md.SrcRackLabel = src_labware_name
+        md.SrcRackType = src_labware_type
+        md.SrcPosition = 1
+        md.DestRackLabel = df_conc['TECAN_dest_labware_name'].tolist()
+        md.DestRackType = df_conc['TECAN_dest_labware_type'].tolist()
+        md.DestPositions = df_conc['TECAN_dest_target_position']
+        md.Volume = df_conc['TECAN_dilutant_volume'].tolist()
+        md.LiquidClass = Utils.multi_disp_liq_cls(liq_cls, gwl)
+        md.add(gwl, disp_frac)
+        gwl.add(Fluent.Break())
+        return None
+    # tip policy: flush & reuse tips or new tip per transfer
+    if reuse_tips is True:
+        policy = Fluent.tip_flush()
+    else:
+        policy = Fluent.tip_new()
+    with gwl.using_tip_policy(policy):
+        # filtering by volume range
+        DTH_vols = list(gwl.get_DTH_volumes().values())
+        DTH_vols = sorted(DTH_vols)
+        DTH_vols = zip([-1] + DTH_vols[:-1], DTH_vols)
 
-    # filtering to just values for each DTH volume range
-    for DTH_vol in DTH_vols:
-        x = (df_conc['TECAN_dilutant_volume'] > DTH_vol[0]) & \
-            (df_conc['TECAN_dilutant_volume'] <= DTH_vol[1])
-        df_conc_tmp = df_conc.loc[x]
-        if df_conc_tmp.shape[0] <= 0:
-            continue
-        df_conc_tmp.reset_index(inplace=True)
-        # for each sample, transfer aliquot via asp-disp
-        for i in range(df_conc_tmp.shape[0]):
-            # skipping no-volume
-            volume = round(df_conc_tmp.loc[i,'TECAN_dilutant_volume'], 2)
-            if volume <= 0.0:
-                continue        
-            # aspiration
-            asp = Fluent.Aspirate()
-            asp.RackLabel = src_labware_name
-            asp.RackType = src_labware_type
-            asp.Position = 1
-            asp.Volume = volume
-            asp.LiquidClass = liq_cls
-            gwl.add(asp)        
-            # dispensing
-            disp = Fluent.Dispense()
-            disp.RackLabel = df_conc_tmp.loc[i,'TECAN_dest_labware_name']
-            disp.RackType = df_conc_tmp.loc[i,'TECAN_dest_labware_type']        
-            disp.Position = df_conc_tmp.loc[i,'TECAN_dest_target_position']
-            disp.Volume = volume
-            disp.LiquidClass = liq_cls
-            gwl.add(disp)
-            # end
-            if reuse_tips is True:
-                gwl.add(Fluent.Flush())
-            else:
-                gwl.add(Fluent.Waste())
-        # waste
-        if reuse_tips is True:
-            gwl.add(Fluent.Waste())        
-    # adding break
-    gwl.add(Fluent.Break())
+        # filtering to just values for each DTH volume range
+        for DTH_vol in DTH_vols:
+            x = (df_conc['TECAN_dilutant_volume'] > DTH_vol[0]) & \
+                (df_conc['TECAN_dilutant_volume'] <= DTH_vol[1])
+            df_conc_tmp = df_conc.loc[x]
+            if df_conc_tmp.shape[0] <= 0:
+                continue
+            df_conc_tmp.reset_index(inplace=True)
+            # for each sample, transfer aliquot via asp-disp
+            for i in range(df_conc_tmp.shape[0]):
+                # skipping no-volume
+                volume = round(df_conc_tmp.loc[i,'TECAN_dilutant_volume'], 2)
+                if volume <= 0.0:
+                    continue        
+                # aspiration
+                asp = Fluent.Aspirate()
+                asp.RackLabel = src_labware_name
+                asp.RackType = src_labware_type
+                asp.Position = 1
+                asp.Volume = volume
+                asp.LiquidClass = liq_cls
+                gwl.add(asp)        
+                # dispensing
+                disp = Fluent.Dispense()
+                disp.RackLabel = df_conc_tmp.loc[i,'TECAN_dest_labware_name']
+                disp.RackType = df_conc_tmp.loc[i,'TECAN_dest_labware_type']        
+                disp.Position = df_conc_tmp.loc[i,'TECAN_dest_target_position']
+                disp.Volume = volume
+                disp.LiquidClass = liq_cls
+                gwl.add(disp)
+        # adding break
+        gwl.add(Fluent.Break())
 
 def pip_samples(df_conc, gwl, liq_cls='Water Free Single'):
     """Commands for aliquoting samples into dilutant
@@ -483,30 +507,16 @@ def pip_samples(df_conc, gwl, liq_cls='Water Free Single'):
     gwl.add(Fluent.Comment('Samples'))
     
     # for each sample, transfer aliquot via asp-disp 
-    for i in range(df_conc.shape[0]):
-        # skipping no-volume
-        volume = round(df_conc.loc[i,'TECAN_sample_volume'], 2)
-        if volume <= 0:
-            continue        
-        # aspiration
-        asp = Fluent.Aspirate()
-        asp.RackLabel = df_conc.loc[i,'TECAN_labware_name']
-        asp.RackType = df_conc.loc[i,'TECAN_labware_type']
-        asp.Position = df_conc.loc[i,'TECAN_target_position']
-        asp.Volume = volume
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)        
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df_conc.loc[i,'TECAN_dest_labware_name']
-        disp.RackType = df_conc.loc[i,'TECAN_dest_labware_type']        
-        disp.Position = df_conc.loc[i,'TECAN_dest_target_position']
-        disp.Volume = volume
-        disp.LiquidClass = liq_cls
-        gwl.add(disp)
-
-        # waste
-        gwl.add(Fluent.Waste())
+    ## skipping no-volume
+    volume = df_conc['TECAN_sample_volume'].round(2)
+    gwl.add_transfers(df_conc.loc[volume > 0],
+                      'TECAN_labware_name',
+                      'TECAN_labware_type',
+                      'TECAN_target_position',
+                      'TECAN_dest_labware_name',
+                      'TECAN_dest_labware_type',
+                      'TECAN_dest_target_position',
+                      volume=volume.loc[volume > 0], liq_cls=liq_cls)
 
 # main
 if __name__ == '__main__':
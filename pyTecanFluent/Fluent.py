@@ -2,11 +2,24 @@ from __future__ import print_function
 
 # import
 import os
+import io
 import sys
 import re
 import json
+import codecs
 import collections
+import contextlib
+import tempfile
 import pkg_resources
+from array import array
+try:
+    from types import MappingProxyType
+except ImportError:     # python2
+    MappingProxyType = dict
+try:
+    from sys import intern
+except ImportError:     # python2 (builtin)
+    pass
 import numpy as np
 import pandas as pd
 
@@ -17,39 +30,146 @@ import pandas as pd
 # D;RackLabel;RackID;RackType;Position;TubeID;Volume;LiquidClass;Tip Type;TipMask;ForcedRackType
 ## 11 fields; 10 semicolons
 
+# number of decimals for volumes in gwl commands
+VOLUME_PRECISION = 2
+
 def xstr(x):
     if x is None:
         return ''
     else:
         return x
 
+def volume_str(x):
+    """Volume as written in the gwl file.
+    Floats are rounded to VOLUME_PRECISION decimals, so float noise
+    (eg., 0.1 + 0.2) never changes the output.
+    """
+    if x is None:
+        return ''
+    if isinstance(x, (float, np.floating)):
+        return str(round(float(x), VOLUME_PRECISION))
+    return str(x)
+
+def _field(name):
+    """Property for a gwl command field stored in the "_<name>" slot.
+    Setting the value resets the cached command string.
+    """
+    attr = '_' + name
+    def fget(self):
+        return getattr(self, attr)
+    def fset(self, value):
+        setattr(self, attr, value)
+        self._cmd = None
+    return property(fget, fset)
+
+def _intern(x):
+    """Interning strings that are repeated across many commands
+    (eg., RackLabel, RackType & LiquidClass)
+    """
+    if isinstance(x, str):
+        return intern(str(x))
+    return x
+
+
+def _write_text(outF, text, encoding=None):
+    """Writing text to a file-like object (text or binary mode)
+    """
+    try:
+        outF.write(text)
+    except TypeError:
+        if isinstance(text, bytes):
+            # python2 str written to a text (unicode) file object
+            outF.write(text.decode(encoding or 'utf-8'))
+        else:
+            # binary file object
+            outF.write(text.encode(encoding or 'utf-8'))
+
+def _open_out(file_name):
+    """Opening a file for writing with _write_text (binary mode, so the
+    line terminators are kept as-is on python 2 & 3)
+    """
+    return io.open(file_name, 'wb')
+
+
+# database registry: JSON files are loaded once per process
+## and shared (read-only) by all db() instances
+_DATABASE_DIR = os.path.join(os.path.split(__file__)[0], 'database')
+_DATABASE = {}
+
+def _replace_file(src, dest):
+    """Renaming src to dest (dest is overwritten)
+    """
+    try:
+        os.replace(src, dest)
+    except AttributeError:      # python2
+        if os.path.exists(dest):
+            os.remove(dest)
+        os.rename(src, dest)
+
+def _freeze(x):
+    """Read-only copy of a loaded JSON object (dicts => mapping proxies, lists => tuples)
+    """
+    if isinstance(x, dict):
+        return MappingProxyType({k:_freeze(v) for k,v in x.items()})
+    if isinstance(x, list):
+        return tuple(_freeze(v) for v in x)
+    return x
+
+def load_database(database_dir=None):
+    """Loading all database JSON files into the shared registry.
+    The files are only read the first time (or after reload_database).
+    database_dir : directory containing the JSON files (default: package database)
+    """
+    if database_dir is None:
+        database_dir = _DATABASE_DIR
+    try:
+        return _DATABASE[database_dir]
+    except KeyError:
+        pass
+    d = {}
+    for x in ('labware', 'tip_type', 'liquid_class', 'target_position', 'runtime'):
+        f = os.path.join(database_dir, x + '.json')
+        if x == 'runtime' and not os.path.isfile(f):
+            # optional; using the package default
+            f = os.path.join(_DATABASE_DIR, x + '.json')
+        with open(f) as inF:
+            d[x] = _freeze(json.load(inF))
+    _DATABASE[database_dir] = d
+    return d
+
+def reload_database(database_dir=None):
+    """Re-reading the database JSON files (eg., after they have been edited).
+    Only db() instances created after the reload will use the new values.
+    """
+    if database_dir is None:
+        _DATABASE.clear()
+    else:
+        _DATABASE.pop(database_dir, None)
+    return load_database(database_dir)
+
 
 class db(object):
     """Database of FluentControl labware, tip types, liquid classes, etc.
-    Database files are stored in JSON format
+    Database files are stored in JSON format.
+    The files are loaded once (see load_database) and shared by all instances.
     """
-    def __init__(self):
-        d = os.path.split(__file__)[0]
-        self.database_dir = os.path.join(d, 'database')
-        # labware
-        f = os.path.join(self.database_dir, 'labware.json')
-        with open(f) as inF:
-            self.labware = json.load(inF)
-        # tip type
-        f = os.path.join(self.database_dir, 'tip_type.json')
-        with open(f) as inF:
-            self.tip_type = json.load(inF)
-        # liquid class
-        f = os.path.join(self.database_dir, 'liquid_class.json')
-        with open(f) as inF:
-            self.liquid_class = json.load(inF)
+    def __init__(self, database_dir=None):
+        if database_dir is None:
+            database_dir = _DATABASE_DIR
+        self.database_dir = database_dir
+        d = load_database(database_dir)
+        self.labware = d['labware']
+        self.tip_type = d['tip_type']
+        self.liquid_class = d['liquid_class']
+        self.target_position = d['target_position']
+        self.runtime = d['runtime']
 
     def RackTypes(self):
         return list(self.labware.keys())
             
     def get_labware(self, value):
         try:
-            d = self.labware[value]
+            d = dict(self.labware[value])
             d['RackType'] = value
             return d
         except KeyError:
@@ -120,11 +240,18 @@ class db(object):
         
 class gwl(object):
     """Class for storing gwl commands
+    tip_policy : tip_policy object applied to commands as they are added (see tip_policy)
     """
-    def __init__(self, TipTypes=None):
+    def __init__(self, TipTypes=None, tip_policy=None):
         self.db = db()
+        self.tip_policy = tip_policy
+        self._min_tip_sizes = {}
+        self._tubes = {}
+        self._validated = {}
+        self._validation_counts = {'hits' : 0, 'misses' : 0}
         self.TipTypes = TipTypes
         self.last_asp = None
+        self._reset_indexes()
         self.commands = []
 
     def add(self, obj, default_liq_cls='Water Free Single'):
@@ -135,14 +262,12 @@ class gwl(object):
         ## check values for asp/disp commands
         if isinstance(obj, Aspirate) or isinstance(obj, Dispense):
             assert obj.RackType is not None
-            # check that RackType is in database
-            labware = self.db.get_labware(obj.RackType)
+            is_tube,liq_cls_ok = self._validate(obj.RackType, obj.LiquidClass)
             # check that tubes have target_position of 1 (only 1 position per tube)
-            if 'eppendorf' in set(labware['target_location']) and int(obj.Position) != 1:
+            if is_tube and obj.Position != 1:
                 obj.Position = 1
-                
-            # check that liquid class is in database (or use default)
-            if self.LiquidClass_exists(obj.LiquidClass) is False:
+            # use default liquid class if not in database
+            if liq_cls_ok is False:
                 obj.LiquidClass = default_liq_cls
                 
         # adding tip type for command based on volume; used for counting
@@ -155,22 +280,275 @@ class gwl(object):
         if isinstance(obj, Dispense):
             assert self.last_asp is not None
             obj.LiquidClass = self.last_asp.LiquidClass
+
+        # tip policy: reusing/flushing/dropping the mounted tip
+        if self.tip_policy is not None:
+            if isinstance(obj, Aspirate):
+                for x in self.tip_policy.before_aspirate(self._tip, obj):
+                    self._append(x)
+            elif isinstance(obj, (Comment, Break, Reagent_distribution)):
+                self.drop_tip()
                         
         # appending to list of commands
+        self._append(obj)
+
+    def drop_tip(self):
+        """Dropping the mounted tip (if any), as defined by the tip policy
+        (default: Waste command).
+        """
+        if self._tip is None:
+            return None
+        policy = self.tip_policy
+        if policy is None:
+            policy = tip_new()
+        for x in policy.drop():
+            self._append(x)
+
+    @contextlib.contextmanager
+    def using_tip_policy(self, policy):
+        """Context manager for applying a tip policy to a series of commands.
+        The mounted tip (if any) is dropped on exit, and the previous policy is restored.
+        """
+        old_policy = self.tip_policy
+        self.tip_policy = policy
+        try:
+            yield self
+            self.drop_tip()
+        finally:
+            self.tip_policy = old_policy
+
+    def _validate(self, RackType, LiquidClass):
+        """Checking a (RackType, LiquidClass) pair against the database.
+        Results are cached, so each distinct pair is only checked once.
+        Return: (is_tube, liquid class exists)
+        """
+        key = (RackType, LiquidClass)
+        try:
+            ret = self._validated[key]
+            self._validation_counts['hits'] += 1
+            return ret
+        except KeyError:
+            self._validation_counts['misses'] += 1
+        ret = (self._is_tube(RackType), self.LiquidClass_exists(LiquidClass))
+        self._validated[key] = ret
+        return ret
+
+    def _is_tube(self, RackType):
+        """Whether the RackType is a tube (just 1 target position).
+        Raises a KeyError if the RackType is not in the database.
+        """
+        try:
+            return self._tubes[RackType]
+        except KeyError:
+            pass
+        # check that RackType is in database
+        labware = self.db.get_labware(RackType)
+        is_tube = 'eppendorf' in set(labware['target_location'])
+        self._tubes[RackType] = is_tube
+        return is_tube
+
+    def validation_stats(self):
+        """Number of command validations (in add()) answered by the cache (hits)
+        or checked against the database (misses)
+        """
+        return dict(self._validation_counts)
+
+    def add_transfers(self, df, src_labware_name, src_labware_type, src_position,
+                      dest_labware_name, dest_labware_type, dest_position,
+                      volume, liq_cls='Water Free Single', liq_cls_col=None,
+                      n_tip_reuse=1, default_liq_cls='Water Free Single'):
+        """Adding asp-disp-waste commands for all transfers (rows) in a table.
+        The same checks as add() are applied, but column-wise.
+        df : pandas.DataFrame; 1 row per transfer (rows are pipetted in order)
+        src_labware_name, src_labware_type, src_position : source columns in `df`
+        dest_labware_name, dest_labware_type, dest_position : destination columns in `df`
+        volume : volume column in `df`, a list-like of volumes, or a single volume
+        liq_cls : liquid class for all transfers (or for NaN values in `liq_cls_col`)
+        liq_cls_col : column in `df` with a liquid class per transfer
+        n_tip_reuse : number of transfers per tip (waste after each n-th & the last transfer);
+                      just used if no tip_policy is set
+        default_liq_cls : liquid class used for liquid classes not in the database (as in add())
+        """
+        n = df.shape[0]
+        if n == 0:
+            return None
+        assert n_tip_reuse >= 1, 'n_tip_reuse must be >= 1'
+        # columns as lists (native python types)
+        src_name = df[src_labware_name].tolist()
+        dest_name = df[dest_labware_name].tolist()
+        src_type = df[src_labware_type].tolist()
+        dest_type = df[dest_labware_type].tolist()
+        if isinstance(volume, str):
+            volumes = df[volume].tolist()
+        elif hasattr(volume, '__iter__'):
+            volumes = np.asarray(volume).tolist()
+            assert len(volumes) == n, 'Number of volumes != number of transfers'
+        else:
+            volumes = [volume] * n
+        if liq_cls_col is None:
+            liq_clss = [liq_cls] * n
+        else:
+            liq_clss = df[liq_cls_col].where(pd.notnull(df[liq_cls_col]), liq_cls).tolist()
+
+        # checks
+        for x in (src_name, dest_name, src_type, dest_type):
+            assert not any(pd.isnull(x)), 'RackLabel/RackType cannot be None'
+        ## RackTypes in database; tubes just have 1 position
+        is_tube = {x:self._is_tube(x) for x in set(src_type + dest_type)}
+        src_pos = [1 if is_tube[t] else int(p) for t,p in
+                   zip(src_type, df[src_position].tolist())]
+        dest_pos = [1 if is_tube[t] else int(p) for t,p in
+                    zip(dest_type, df[dest_position].tolist())]
+        ## liquid classes not in database => default liquid class
+        liq_cls_ok = {x:self.LiquidClass_exists(x) for x in set(liq_clss)}
+        if not all(liq_cls_ok.values()):
+            liq_clss = [x if liq_cls_ok[x] else default_liq_cls for x in liq_clss]
+        ## tip types
+        TipTypes = self.set_TipTypes(volumes, src_type)
+        ## tip policy
+        policy = self.tip_policy
+        if policy is None:
+            policy = tip_reuse(n_tip_reuse, same_source=False)
+                
+        # commands
+        for i in range(n):
+            asp = Aspirate._new(RackLabel=src_name[i], RackType=src_type[i],
+                                Position=src_pos[i], Volume=volumes[i],
+                                LiquidClass=liq_clss[i],
+                                TipType=TipTypes[i])
+            for x in policy.before_aspirate(self._tip, asp):
+                self._append(x)
+            self._append(asp)
+            disp = Dispense._new(RackLabel=dest_name[i], RackType=dest_type[i],
+                                 Position=dest_pos[i], Volume=volumes[i],
+                                 LiquidClass=liq_clss[i])
+            self._append(disp)
+        for x in policy.drop():
+            self._append(x)
+        self.last_asp = asp
+
+    def _append(self, obj):
+        """Storing a (validated) command
+        """
+        self._update_indexes(obj)
         self.commands.append(obj)
 
-    def write(self, file_obj):
+    def _reset_indexes(self):
+        """Labware & tip indexes (updated as commands are added)
+        """
+        # RackLabel : RackType (first-seen order of RackLabels)
+        self._RackLabels = collections.OrderedDict()
+        # RackType : {RackLabel} (just asp/disp commands)
+        self._RackType_labels = {}
+        # TipType : number of tips used
+        self._tip_count = {}
+        # (source RackLabel, destination RackLabel) : number of dispenses
+        self._transfers = {}
+        # mounted tip (None if no tip)
+        self._tip = None
+
+    def _geometry(self, RackType):
+        """Labware geometry of a RackType (for counting Reagent_distribution tips)
+        """
+        # imported here; Labware imports this module
+        from pyTecanFluent import Labware
+        return Labware.get_geometry(RackType, labware=self.db.labware)
+
+    def _update_indexes(self, obj):
+        """Adding a command to the labware & tip indexes.
+        A tip (TipType of the Asp command) is counted for each Asp command
+        without a mounted tip; Waste commands drop the tip, while Flush
+        commands keep it.
+        """
+        if isinstance(obj, Reagent_distribution):
+            assert obj.SrcRackLabel is not None
+            assert obj.DestRackLabel is not None
+            assert obj.SrcRackType is not None
+            assert obj.DestRackType is not None
+            self._RackLabels[obj.SrcRackLabel] = obj.SrcRackType
+            self._RackLabels[obj.DestRackLabel] = obj.DestRackType
+            # tips used by the channels
+            assert obj.TipType is not None
+            n_tips = obj.n_tips(self._geometry(obj.DestRackType))
+            try: 
+                self._tip_count[obj.TipType] += n_tips
+            except KeyError:
+                self._tip_count[obj.TipType] = n_tips
+            self._add_transfers(obj.SrcRackLabel, obj.DestRackLabel,
+                                len(obj.dest_positions()))
+        elif isinstance(obj, asp_disp):
+            self._RackLabels[obj.RackLabel] = obj.RackType
+            try:
+                self._RackType_labels[obj.RackType].add(obj.RackLabel)
+            except KeyError:
+                self._RackType_labels[obj.RackType] = set([obj.RackLabel])
+            if isinstance(obj, Aspirate):
+                if self._tip is None:
+                    try:
+                        self._tip_count[obj.TipType] += 1
+                    except KeyError:
+                        self._tip_count[obj.TipType] = 1
+                    self._tip = {'TipType' : obj.TipType, 'n_asp' : 0}
+                self._tip['n_asp'] += 1
+                self._tip['source'] = (obj.RackLabel, obj.Position, obj.LiquidClass)
+            elif self._tip is not None:
+                self._add_transfers(self._tip['source'][0], obj.RackLabel)
+        elif isinstance(obj, Waste):
+            self._tip = None
+
+    def _add_transfers(self, src, dest, n=1):
+        key = (src, dest)
+        try:
+            self._transfers[key] += n
+        except KeyError:
+            self._transfers[key] = n
+
+    def list_labware(self):
+        """Labware used by the commands.
+        Return: OrderedDict of RackLabel : RackType (in the order first used)
+        """
+        return collections.OrderedDict(self._RackLabels)
+
+    def count_tips(self):
+        """Number of tips used by the commands (1 tip per tip pick-up; see _update_indexes).
+        Return: dict of TipType : count
+        """
+        return dict(self._tip_count)
+
+    def count_transfers(self):
+        """Number of dispenses between each pair of labware
+        (Dispense commands & Reagent_distribution wells).
+        Return: dict of (source RackLabel, destination RackLabel) : count
+        """
+        return dict(self._transfers)
+
+    def write(self, file_obj, line_terminator='\n', encoding=None):
         """Writing out gwl file.
         Commands written in the order of addition
+        file_obj : file name or file-like object (text or binary; not closed)
+        line_terminator : end of each line (eg., '\\r\\n' for FluentControl on Windows)
+        encoding : file encoding (default: utf-8; file objects in text mode use their own encoding)
         """
-        try:
-            outF = open(file_obj, 'w')
-        except IOError:
-            outF = file_obj
-            
-        for x in self.commands:
-            outF.write(x.cmd() + '\n')
-        outF.close()
+        lines = list(self._render())
+        if len(lines) == 0:
+            text = ''
+        else:
+            text = line_terminator.join(lines) + line_terminator
+        # single write of all lines
+        if hasattr(file_obj, 'write'):
+            _write_text(file_obj, text, encoding)
+            try:
+                file_obj.flush()
+            except AttributeError:
+                pass
+        else:
+            with _open_out(file_obj) as outF:
+                _write_text(outF, text, encoding)
+
+    def _render(self):
+        """Rendering all commands as gwl lines (in the order of addition)
+        """
+        return (x.cmd() for x in self.commands)
         
     def set_TipType(self, volume, racktype=None):
         """Setting which tip will be used.
@@ -181,18 +559,57 @@ class gwl(object):
         # check if racktype has min-volume tip
         ## if yes, set volume to that, which sets tip type
         if racktype is not None:
-            tip_sizes = self.db.get_labware_allowed_tips(racktype)
-            if tip_sizes is not None and min(tip_sizes) > volume:
-                volume = min(tip_sizes) * 0.75    # WARNING: 0.75 is a hack!
+            min_tip = self._min_tip_size(racktype)
+            if min_tip is not None and min_tip > volume:
+                volume = min_tip * 0.75    # WARNING: 0.75 is a hack!
 
-        # setting tip type
+        # setting tip type: 1st tip type with DTH > volume
         assert self.TipTypes is not None
-        func = lambda x: (x[1]['DTH'],x[0])
-        for k,v in sorted(self.TipTypes.items(), key=func):
-            if v['DTH'] - volume > 0:
-                return k            
-        msg = 'No TipType DTH value greater than {}'
-        raise ValueError(msg.format(volume))
+        DTHs,names = self._DTH_table
+        i = np.searchsorted(DTHs, volume, side='right')
+        if i >= len(names):
+            msg = 'No TipType DTH value greater than {}'
+            raise ValueError(msg.format(volume))
+        return names[i]
+
+    def set_TipTypes(self, volumes, racktypes=None):
+        """Batch version of set_TipType.
+        volumes : list-like of volumes
+        racktypes : list-like of RackTypes (same length as volumes) or 1 RackType for all
+        Return: list of tip types
+        """
+        volumes = np.array(volumes, dtype=float)
+        if len(volumes) == 0:
+            return []
+
+        # min-volume tip of each RackType (see set_TipType)
+        if racktypes is not None:
+            if isinstance(racktypes, str):
+                racktypes = [racktypes] * len(volumes)
+            min_tip = np.array([self._min_tip_size(x) for x in racktypes], dtype=float)
+            to_adjust = min_tip > volumes
+            volumes[to_adjust] = min_tip[to_adjust] * 0.75    # WARNING: 0.75 is a hack!
+
+        # setting tip types
+        assert self.TipTypes is not None
+        DTHs,names = self._DTH_table
+        idx = np.searchsorted(DTHs, volumes, side='right')
+        if (idx >= len(names)).any():
+            msg = 'No TipType DTH value greater than {}'
+            raise ValueError(msg.format(volumes[idx >= len(names)].max()))
+        return [names[i] for i in idx]
+
+    def _min_tip_size(self, racktype):
+        """Smallest allowed tip size for the RackType (None if no restriction)
+        """
+        try:
+            return self._min_tip_sizes[racktype]
+        except KeyError:
+            pass
+        tip_sizes = self.db.get_labware_allowed_tips(racktype)
+        min_tip = None if tip_sizes is None else min(tip_sizes)
+        self._min_tip_sizes[racktype] = min_tip
+        return min_tip
             
     def TipType_exists(self, volume, warn=False):
         """Does TipType exist?
@@ -217,17 +634,10 @@ class gwl(object):
     def RackType_count(self, RackType):
         """Counting labware with same RackType (different RackLabel, same RackType)
         """
-        cnt = {}
-        for x in self.commands:
-            # getting possible target locations for RackType
-            try:
-                cmd_RackLabel = x.RackLabel
-                cmd_RackType = x.RackType
-            except AttributeError:
-                continue
-            if RackType == cmd_RackType:
-                cnt[cmd_RackLabel] = 1
-        return len(cnt.keys())
+        try:
+            return len(self._RackType_labels[RackType])
+        except KeyError:
+            return 0
                 
     def LiquidClass_exists(self, liquid_class, warn=False):
         """Check that liquid class exists in the database.
@@ -245,6 +655,195 @@ class gwl(object):
         """List the commands added to the instance
         """
         return(self.commands)
+
+    def optimize(self, verbose=True):
+        """Reordering pipetting blocks to minimize switching between source labware.
+        A block is a series of Asp/Disp commands ending with a Waste command (1 tip).
+        Blocks are only reordered within sections (commands between Comment, Break
+        & Reagent_distribution commands), and only if no block in the section
+        aspirates from a well that another block in the section dispenses into,
+        so the volumes added to each well do not change.
+        Blocks are grouped by source labware (in order of first use);
+        blocks with the same source labware keep their order.
+        verbose : print the source labware switches before & after to STDERR
+        Return: (source labware switches before, after)
+        """
+        cmds = self.commands
+        before = _source_switches(cmds)
+        # optimizing each section
+        new_cmds = self._map_sections(_optimize_section)
+        assert len(new_cmds) == len(cmds)
+        self._replace_commands(new_cmds)
+        # status
+        after = _source_switches(new_cmds)
+        if verbose:
+            msg = 'Worklist optimization: source labware switches: {} => {} ({} saved)'
+            print(msg.format(before, after, before - after), file=sys.stderr)
+        return before, after
+
+    def collapse_reagent_runs(self, min_dispenses=8, verbose=True):
+        """Replacing runs of uniform reagent dispenses with Reagent_distribution (R) commands.
+        A run is a series of pipetting blocks (Asp/Disp ... Waste) within a section
+        (see optimize()) that all:
+          * aspirate from the same source, which must be an FCA waste labware (eg., '25ml_1 waste')
+          * dispense the same volume (same liquid class) into the same plate
+          * dispense into each well just once
+        Each run with >= min_dispenses dispenses is replaced by 1 R command
+        (R commands use all 8 channels, so shorter runs are left as-is by default).
+        The wells in the dispense range that are not targeted are excluded (ExcludedDestWell),
+        and the numbers of tip reuses & multi-dispenses are taken from the run.
+        verbose : print the number of commands before & after to STDERR
+        Return: number of R commands added
+        """
+        n_before = len(self.commands)
+        n_rd = [0]
+        def func(section):
+            new_section,n = self._collapse_section(section, min_dispenses)
+            n_rd[0] += n
+            return new_section
+        new_cmds = self._map_sections(func)
+        self._replace_commands(new_cmds)
+        # status
+        if verbose:
+            msg = 'Reagent distribution: {} R commands added; number of commands: {} => {}'
+            print(msg.format(n_rd[0], n_before, len(new_cmds)), file=sys.stderr)
+        return n_rd[0]
+
+    def _collapse_section(self, commands, min_dispenses=8):
+        """Replacing runs of uniform pipetting blocks in a section with R commands.
+        Return: (new commands, number of R commands)
+        """
+        blocks,rest = _split_blocks(commands)
+        new_commands = []
+        n_rd = 0
+        run = []      # [(block, block info)]
+        run_wells = set()
+        for block in blocks + [None]:
+            info = None if block is None else self._reagent_block(block)
+            # continue the run?
+            if (info is not None and len(run) > 0 and info['key'] == run[0][1]['key']
+                and run_wells.isdisjoint(info['positions'])):
+                run.append((block, info))
+                run_wells.update(info['positions'])
+                continue
+            # end of run
+            if sum(len(x[1]['positions']) for x in run) >= min_dispenses:
+                new_commands.append(self._reagent_distribution(run))
+                n_rd += 1
+            else:
+                for x in run:
+                    new_commands += x[0]
+            run = []
+            run_wells = set()
+            # new run
+            if info is not None:
+                run = [(block, info)]
+                run_wells.update(info['positions'])
+            elif block is not None:
+                new_commands += block
+        return new_commands + rest, n_rd
+
+    def _reagent_block(self, block):
+        """Info on a pipetting block (Asp/Disp ... Waste) that can be part of an R command.
+        Return: dict (None if the block can't be used)
+        """
+        body = block[:-1]
+        if len(body) < 2 or not isinstance(body[0], Aspirate):
+            return None
+        n_asp = 0
+        n_disp = []
+        src = set()
+        dest = set()
+        volumes = set()
+        liq_cls = set()
+        positions = []
+        for cmd in body:
+            if isinstance(cmd, Aspirate):
+                n_asp += 1
+                n_disp.append(0)
+                src.add((cmd.RackLabel, cmd.RackType, cmd.Position))
+            elif isinstance(cmd, Dispense):
+                n_disp[-1] += 1
+                dest.add((cmd.RackLabel, cmd.RackType))
+                volumes.add(cmd.Volume)
+                positions.append(cmd.Position)
+            else:
+                return None
+            liq_cls.add(cmd.LiquidClass)
+        if (len(src) > 1 or len(dest) > 1 or len(volumes) > 1 or len(liq_cls) > 1
+            or min(n_disp) == 0 or len(set(positions)) < len(positions)):
+            return None
+        src = src.pop()
+        dest = dest.pop()
+        # source must be FCA waste labware; destination must be a plate
+        if not src[1].endswith(' waste'):
+            return None
+        try:
+            if self.db.labware[dest[1]]['category'] != 'plate':
+                return None
+        except KeyError:
+            return None
+        return {'key' : (src, dest, volumes.pop(), liq_cls.pop()),
+                'positions' : positions,
+                'n_asp' : n_asp,
+                'n_disp' : max(n_disp)}
+
+    def _reagent_distribution(self, run):
+        """Creating an R command for a run of pipetting blocks (see _collapse_section)
+        """
+        src,dest,volume,liq_cls = run[0][1]['key']
+        positions = set()
+        for block,info in run:
+            positions.update(info['positions'])
+        rd = Reagent_distribution()
+        # aspirate parameters
+        rd.SrcRackLabel = src[0]
+        rd.SrcRackType = src[1]
+        rd.SrcPosStart = src[2]
+        rd.SrcPosEnd = src[2]
+        # dispense parameters
+        rd.DestRackLabel = dest[0]
+        rd.DestRackType = dest[1]
+        rd.DestPosStart = min(positions)
+        rd.DestPosEnd = max(positions)
+        # other
+        rd.Volume = volume
+        rd.LiquidClass = liq_cls
+        rd.NoOfDiTiReuses = max(info['n_asp'] for block,info in run)
+        rd.NoOfMultiDisp = max(info['n_disp'] for block,info in run)
+        rd.Direction = 0
+        to_exclude = set(range(rd.DestPosStart, rd.DestPosEnd + 1)) - positions
+        if len(to_exclude) > 0:
+            rd.ExcludedDestWell = ';'.join([str(x) for x in sorted(to_exclude)])
+        rd.TipType = self.set_TipType(rd.volume_per_aspirate())
+        return rd
+
+    def _map_sections(self, func):
+        """Applying func to each section of commands
+        (commands between Comment, Break & Reagent_distribution commands).
+        Return: list of all commands
+        """
+        if isinstance(self, gwl_stream):
+            raise ValueError('Commands are not stored; cannot edit commands')
+        new_cmds = []
+        section = []
+        for cmd in self.commands:
+            if isinstance(cmd, (Comment, Break, Reagent_distribution)):
+                new_cmds += func(section)
+                new_cmds.append(cmd)
+                section = []
+            else:
+                section.append(cmd)
+        new_cmds += func(section)
+        return new_cmds
+
+    def _replace_commands(self, commands):
+        """Replacing all commands (the indexes are rebuilt)
+        """
+        self.commands = []
+        self._reset_indexes()
+        for cmd in commands:
+            self._append(cmd)
         
     # get/set the available tip types (& their attributes) 
     @property
@@ -254,10 +853,296 @@ class gwl(object):
     def TipTypes(self, types):
         if types is None:
             self._TipTypes = None
+            self._DTH_table = None
         else:
             types = [x for x in types if x is not None]  
             self._TipTypes = {x:self.db.get_tip_type(x) for x in types}
+            # tip types sorted by DTH volume (used for tip selection)
+            func = lambda x: (x[1]['DTH'],x[0])
+            x = sorted(self._TipTypes.items(), key=func)
+            self._DTH_table = (np.array([v['DTH'] for k,v in x], dtype=float),
+                               [k for k,v in x])
                 
+def _source_switches(commands):
+    """Counting changes of source labware between consecutive Asp commands
+    (used as an estimate of arm travel)
+    """
+    switches = 0
+    last = None
+    for cmd in commands:
+        if isinstance(cmd, Aspirate):
+            if last is not None and cmd.RackLabel != last:
+                switches += 1
+            last = cmd.RackLabel
+    return switches
+
+def _split_blocks(commands):
+    """Splitting commands into pipetting blocks (1 per tip; each ending with a Waste command)
+    Return: ([blocks], [commands after the last Waste command])
+    """
+    blocks = []
+    block = []
+    for cmd in commands:
+        block.append(cmd)
+        if isinstance(cmd, Waste):
+            blocks.append(block)
+            block = []
+    return blocks, block
+
+def _optimize_section(commands):
+    """Grouping the pipetting blocks (Asp/Disp ... Waste) of a section by source labware.
+    The section is not changed if any block aspirates from a well that is
+    dispensed into within the section.
+    """
+    blocks,block = _split_blocks(commands)
+    if len(blocks) < 2:
+        return commands
+    # checking that blocks are independent
+    src_wells = set()
+    dest_wells = set()
+    for cmd in commands:
+        if isinstance(cmd, Aspirate):
+            src_wells.add((cmd.RackLabel, cmd.Position))
+        elif isinstance(cmd, Dispense):
+            dest_wells.add((cmd.RackLabel, cmd.Position))
+    if len(src_wells & dest_wells) > 0:
+        return commands
+    # grouping by source labware (1st aspirate of each block)
+    src_order = {}
+    keys = []
+    for i,x in enumerate(blocks):
+        src = None
+        for cmd in x:
+            if isinstance(cmd, Aspirate):
+                src = cmd.RackLabel
+                break
+        try:
+            keys.append((src_order[src], i))
+        except KeyError:
+            src_order[src] = len(src_order)
+            keys.append((src_order[src], i))
+    # commands in new block order (+ any commands after the last Waste)
+    new_commands = []
+    for k,i in sorted(keys):
+        new_commands += blocks[i]
+    return new_commands + block
+
+class gwl_columnar(gwl):
+    """Class for storing gwl commands as parallel columns.
+    Asp/disp commands are stored as one categorical column per gwl field
+    (integer codes + the distinct values) instead of one object per command.
+    On writing, each distinct value is converted to a string just once and
+    all asp/disp lines are rendered in one pass.
+    Other commands (Comment, Waste, Reagent_distribution, etc.) are stored as-is.
+    The `commands` attribute is a row view: command objects are re-created
+    from the columns when accessed (changes to those objects are not stored).
+    """
+    _fields = ('_ID',
+               'RackLabel', 'RackID', 'RackType',
+               'Position', 'TubeID', 'Volume',
+               'LiquidClass', 'TipType', 'TipMask',
+               'ForceRackType')
+
+    def _append(self, obj):
+        """Storing a (validated) command in the columns
+        """
+        self._update_indexes(obj)
+        if isinstance(obj, asp_disp):
+            for x in self._fields:
+                value = getattr(obj, x)
+                # volumes: 2 & 2.0 must be kept distinct
+                key = (value.__class__, value) if x == 'Volume' else value
+                idx = self._index[x]
+                try:
+                    code = idx[key]
+                except KeyError:
+                    code = idx[key] = len(self._values[x])
+                    self._values[x].append(value)
+                self._codes[x].append(code)
+            self._other.append(None)
+        else:
+            for x in self._fields:
+                self._codes[x].append(0)
+            self._other.append(obj)
+
+    def _column(self, x):
+        """Values of 1 column (None for non-asp/disp commands)
+        """
+        values = self._values[x]
+        return [values[i] for i in self._codes[x]]
+            
+    @property
+    def commands(self):
+        cols = {x:self._column(x) for x in self._fields}
+        cmds = []
+        for i,obj in enumerate(self._other):
+            if obj is None:
+                obj = Aspirate.__new__(Aspirate if cols['_ID'][i] == 'A' else Dispense)
+                for x in self._fields[1:]:
+                    setattr(obj, x if x != 'LiquidClass' else '_LiquidClass', cols[x][i])
+            cmds.append(obj)
+        return cmds
+
+    @commands.setter
+    def commands(self, values):
+        self._reset_indexes()
+        # code 0 = None (used for all non-asp/disp commands)
+        self._codes = {x:array('l') for x in self._fields}
+        self._values = {x:[None] for x in self._fields}
+        self._index = {x:{None:0} for x in self._fields}
+        self._other = []
+        for x in values:
+            self._append(x)
+
+    def __len__(self):
+        return len(self._other)
+
+    def table(self):
+        """Asp/disp commands as a pandas DataFrame (1 column per gwl field).
+        String fields are categorical; Position & Volume are numeric.
+        Other commands (Comment, Waste, etc.) are not included.
+        """
+        is_cmd = np.array([x is None for x in self._other], dtype=bool)
+        df = {}
+        for x in self._fields:
+            values = np.empty(len(self._values[x]), dtype=object)
+            values[:] = self._values[x]
+            values = values[np.frombuffer(self._codes[x], dtype=self._codes[x].typecode)]
+            if x in ('Position', 'Volume'):
+                df[x] = pd.to_numeric(pd.Series(values[is_cmd]))
+            else:
+                df[x] = pd.Series(values[is_cmd]).astype('category')
+        return pd.DataFrame(df, columns=self._fields).set_index(np.flatnonzero(is_cmd))
+
+    def _render(self):
+        """Rendering all commands as gwl lines in one pass.
+        """
+        if len(self) == 0:
+            return []
+        is_cmd = np.array([x is None for x in self._other], dtype=bool)
+        # asp/disp columns; each distinct value converted to a string once
+        str_cols = []
+        for x in self._fields:
+            codes = np.frombuffer(self._codes[x], dtype=self._codes[x].typecode)
+            if x in ('RackLabel', 'RackType'):
+                # same as asp_disp.cmd (code 0 = None)
+                assert not (codes[is_cmd] == 0).any(), '{} cannot be None'.format(x)
+            if x == 'Volume':
+                strs = [volume_str(y) for y in self._values[x]]
+            else:
+                strs = [str(xstr(y)) for y in self._values[x]]
+            strs = np.array(strs, dtype=object)
+            str_cols.append(strs[codes])
+        lines = [';'.join(x) for x in zip(*str_cols)]
+        # other commands
+        for i in np.flatnonzero(~is_cmd):
+            lines[i] = self._other[i].cmd()
+        return lines
+
+
+class gwl_stream(gwl):
+    """Class for writing gwl commands as they are added (streaming).
+    Each command is rendered and written to a buffered file sink by add(),
+    so commands are not kept in memory (`commands` stays empty) and
+    memory usage does not grow with the number of commands.
+    If a Labware.labware object is provided, the labware & tips of all
+    commands are added to it on close() (from the gwl indexes).
+    Use close() (or a `with` statement) to flush the sink.
+    If a file name is provided, the commands are written to a temporary file
+    that is renamed to the file name on close(); discard() (or an error in
+    the `with` statement) removes the temporary file, so an existing file
+    is never replaced by an incomplete worklist.
+    """
+    def __init__(self, file_obj, TipTypes=None, labware=None, buffer_size=10000,
+                 line_terminator='\n', encoding=None):
+        gwl.__init__(self, TipTypes)
+        if hasattr(file_obj, 'write'):
+            self._outF = file_obj
+            self._close_outF = False
+            self._file = self._tmp_file = None
+        else:
+            self._file = file_obj
+            fd,self._tmp_file = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(file_obj) + '.',
+                                                 dir=os.path.dirname(os.path.abspath(file_obj)))
+            os.close(fd)
+            self._outF = _open_out(self._tmp_file)
+            self._close_outF = True
+        self.line_terminator = line_terminator
+        self.encoding = encoding
+        self.labware = labware
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._n_commands = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
+
+    def __len__(self):
+        return self._n_commands
+
+    def _append(self, obj):
+        """Rendering a (validated) command and adding it to the sink
+        """
+        self._buffer.append(obj.cmd())
+        self._n_commands += 1
+        self._update_indexes(obj)
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Writing all buffered lines to the sink
+        """
+        if len(self._buffer) > 0:
+            text = self.line_terminator.join(self._buffer) + self.line_terminator
+            _write_text(self._outF, text, self.encoding)
+            self._buffer = []
+
+    def close(self):
+        """Flushing & closing the sink (file objects provided by the user are not closed).
+        Labware & tip boxes are added to the labware object (if provided).
+        """
+        if self._outF is None:
+            return None
+        self.flush()
+        if self._close_outF:
+            self._outF.close()
+        else:
+            try:
+                self._outF.flush()
+            except AttributeError:
+                pass
+        self._outF = None
+        if self._tmp_file is not None:
+            _replace_file(self._tmp_file, self._file)
+            self._tmp_file = None
+        if self.labware is not None:
+            self.labware.add_gwl(self)
+
+    def discard(self):
+        """Closing the sink without completing the worklist; the temporary
+        file is removed (file objects provided by the user are not closed).
+        """
+        if self._outF is None:
+            return None
+        self._buffer = []
+        if self._close_outF:
+            self._outF.close()
+        self._outF = None
+        if self._tmp_file is not None:
+            os.remove(self._tmp_file)
+            self._tmp_file = None
+
+    def write(self, file_obj, line_terminator='\n', encoding=None):
+        msg = 'Commands are written as they are added; use close()'
+        raise ValueError(msg)
+
+    
 class asp_disp(object):
     """Commands for aliquoting mastermix
     *Parameters*
@@ -271,13 +1156,24 @@ class asp_disp(object):
     TipType
     TipMask
     ForceRackType
+    Note: __slots__ are used to keep the per-command memory footprint small
+    Note: the rendered command is cached (reset whenever a field is set)
     """
+    __slots__ = ('_RackLabel', '_RackID', '_RackType', '_Position',
+                 '_TubeID', '_Volume', '_LiquidClass', '_TipType',
+                 '_TipMask', '_ForceRackType', '_cmd')
+    _ID = ''
+    # gwl field order (shared by all instances)
+    field_order = ('_ID',
+                   'RackLabel', 'RackID', 'RackType',
+                   'Position', 'TubeID', 'Volume',
+                   'LiquidClass', 'TipType', 'TipMask',
+                   'ForceRackType')
+    
     def __init__(self, RackLabel=None, RackID=None, RackType=None,
                  Position=1, TubeID=None, Volume=None,
                  LiquidClass = 'Water Free Single', TipType=None,
                  TipMask=None, ForceRack=None):
-        self._ID = ''
-        self.db = db()
         # aspirate parameters
         self.RackLabel = RackLabel
         self.RackID = RackID
@@ -289,25 +1185,72 @@ class asp_disp(object):
         self.TipType = TipType        # doesn't actually work!
         self.TipMask = TipMask
         self.ForceRackType = ForceRack
-        self.field_order = ['_ID',
-                            'RackLabel', 'RackID', 'RackType',
-                            'Position', 'TubeID', 'Volume',
-                            'LiquidClass', 'TipType', 'TipMask',
-                            'ForceRackType']
         
     def cmd(self):
+        # cached
+        try:
+            if self._cmd is not None:
+                return self._cmd
+        except AttributeError:
+            pass
         # assertions
         assert self.RackLabel is not None, 'RackLabel cannot be None'
         assert self.RackType is not None, 'RackType cannot be None'
-        # list of values in correct order
-        vals = [getattr(self, x) for x in self.field_order]
-        # None to blank string
-        vals = [xstr(x) for x in vals]
-        # convert all to strings
-        vals = [str(x) for x in vals]
-        # return
-        return ';'.join(vals)
+        # list of values in correct order (see field_order)
+        vals = [self._ID, self._RackLabel, self._RackID, self._RackType,
+                self._Position, self._TubeID, None, self._LiquidClass,
+                self._TipType, self._TipMask, self._ForceRackType]
+        # None to blank string; convert all to strings
+        vals = [str(xstr(x)) for x in vals]
+        vals[6] = volume_str(self._Volume)
+        # caching & return
+        self._cmd = ';'.join(vals)
+        return self._cmd
+
+    @classmethod
+    def _new(cls, RackLabel, RackType, Position, Volume, LiquidClass,
+             TipType=None):
+        """Creating a command from already-checked values.
+        The liquid class is not looked up in the database.
+        """
+        obj = cls.__new__(cls)
+        # setting slots directly (skipping the property setters)
+        obj._RackLabel = _intern(RackLabel)
+        obj._RackID = None
+        obj._RackType = _intern(RackType)
+        obj._Position = int(Position)
+        obj._TubeID = None
+        obj._Volume = Volume
+        obj._LiquidClass = _intern(LiquidClass)
+        obj._TipType = TipType
+        obj._TipMask = None
+        obj._ForceRackType = None
+        obj._cmd = None
+        return obj
+
+    @property
+    def db(self):
+        """Shared database"""
+        return db()
+
+    @property
+    def RackLabel(self):
+        return self._RackLabel
+
+    @RackLabel.setter
+    def RackLabel(self, value):
+        self._RackLabel = _intern(value)
+        self._cmd = None
 
+    @property
+    def RackType(self):
+        return self._RackType
+
+    @RackType.setter
+    def RackType(self, value):
+        self._RackType = _intern(value)
+        self._cmd = None
+    
     @property
     def Position(self):
         return self._Position
@@ -315,6 +1258,7 @@ class asp_disp(object):
     @Position.setter
     def Position(self, value):
         self._Position = int(value)
+        self._cmd = None
 
     @property
     def LiquidClass(self):
@@ -322,43 +1266,52 @@ class asp_disp(object):
 
     @LiquidClass.setter
     def LiquidClass(self, value):
-        self.db.get_liquid_class(value)
-        self._LiquidClass = value
+        if value not in load_database()['liquid_class']:
+            self.db.get_liquid_class(value)   # KeyError
+        self._LiquidClass = _intern(value)
+        self._cmd = None
+
+    # other gwl fields (setting a value resets the cached command)
+    RackID = _field('RackID')
+    TubeID = _field('TubeID')
+    Volume = _field('Volume')
+    TipType = _field('TipType')
+    TipMask = _field('TipMask')
+    ForceRackType = _field('ForceRackType')
         
 class Aspirate(asp_disp):
     """gwl aspirate command: "A;"
     """
-    def __init__(self):
-        asp_disp.__init__(self)
-        self._ID = 'A'
+    __slots__ = ()
+    _ID = 'A'
 
 class Dispense(asp_disp):
     """gwl dispense command: "D;"
     """
-    def __init__(self):
-        asp_disp.__init__(self)
-        self._ID = 'D'
+    __slots__ = ()
+    _ID = 'D'
 
-class Comment():
+class Comment(object):
     """gwl comment command: "C;"
     """
+    __slots__ = ('comment',)
+    
     def __init__(self, comment=''):
         self.comment = comment
 
     def cmd(self):
         return 'C;' + self.comment.lstrip('C;')
 
-class Waste():
+class Waste(object):
     """gwl waste command: "W;"
     Used for ejecting tip. 
     """
-    def __init__(self):
-        pass
+    __slots__ = ()
 
     def cmd(self):
         return 'W;'
 
-class Flush():
+class Flush(object):
     """gwl flush command: "F;"
     This is useful for re-using tips.
     The flush command will flush the extra
@@ -366,23 +1319,87 @@ class Flush():
     Note: the source labware must have the variable: "IsFCAWaste = True"
     Using the following worklist command structure : "A; D; F; ... W; B;"
     """
-    def __init__(self):
-        pass
+    __slots__ = ()
 
     def cmd(self):
         return 'F;'
     
-class Break():
+class Break(object):
     """gwl break command: "B;"
     Useful for forcing tip ejects and preventing errors 
     transitioning between pipetting tasks (eg., mastermix & water)
     """
-    def __init__(self):
-        pass
+    __slots__ = ()
 
     def cmd(self):
         return 'B;'
     
+class tip_policy(object):
+    """Base class for tip policies: what to do with the mounted tip before each
+    aspiration (see gwl.tip_policy). The tip is either reused (see reuse())
+    or dropped (Waste command).
+    flush : flush the extra volume back into the source labware (Flush command)
+            after each asp-disp cycle; the source labware must be FCA waste labware
+    """
+    flush = False
+
+    def reuse(self, tip, asp):
+        """Whether the mounted tip can be used for the aspiration.
+        tip : mounted tip (dict: TipType, n_asp, source=(RackLabel,Position,LiquidClass))
+        asp : Aspirate object
+        """
+        return False
+
+    def before_aspirate(self, tip, asp):
+        """Commands to add before an aspiration.
+        tip : mounted tip (None if no tip mounted)
+        asp : Aspirate object
+        """
+        if tip is None:
+            return []
+        if self.reuse(tip, asp):
+            return [Flush()] if self.flush else []
+        return self.drop()
+
+    def drop(self):
+        """Commands for dropping the mounted tip
+        """
+        return [Flush(), Waste()] if self.flush else [Waste()]
+
+class tip_new(tip_policy):
+    """Tip policy: new tip for each aspiration
+    """
+    pass
+
+class tip_reuse(tip_policy):
+    """Tip policy: reusing a tip for up to n_tip_reuse aspirations.
+    The tip must be the same TipType.
+    same_source : the tip is just reused for the same source & liquid class
+    """
+    def __init__(self, n_tip_reuse=1, same_source=True):
+        assert n_tip_reuse is None or n_tip_reuse >= 1, 'n_tip_reuse must be >= 1'
+        self.n_tip_reuse = n_tip_reuse
+        self.same_source = same_source
+
+    def reuse(self, tip, asp):
+        if self.n_tip_reuse is not None and tip['n_asp'] >= self.n_tip_reuse:
+            return False
+        if tip['TipType'] != asp.TipType:
+            return False
+        if self.same_source:
+            return tip['source'] == (asp.RackLabel, asp.Position, asp.LiquidClass)
+        return True
+
+class tip_flush(tip_reuse):
+    """Tip policy: reusing a tip for the same source (up to n_tip_reuse
+    aspirations; None = no limit), flushing after each asp-disp cycle.
+    The source labware must be FCA waste labware (see Flush).
+    """
+    flush = True
+    
+    def __init__(self, n_tip_reuse=None):
+        tip_reuse.__init__(self, n_tip_reuse, same_source=True)
+
 class multi_disp(object):
     """Commands for aliquoting reagent to multiple labware positions
     *AspirateParameters*
@@ -401,7 +1418,8 @@ class multi_disp(object):
     *Other*
     Volume = How much volume per dispense?
     LiquidClass = Which liquid class to use? Default: 'Water Free Multi'
-    NoOfMultiDisp = How many multi-dispenses?
+    NoOfMultiDisp = Max number of multi-dispenses per aspiration (None = limited just by tip volume)
+    TipType = Tip type used for determining the max volume per aspiration (None = largest tip type)
     Labware_tracker = Labware object that tracks what labware is needed
     Returns
     * string of commands
@@ -423,73 +1441,76 @@ class multi_disp(object):
         self.Volume = 1.0
         self.TipType = None       
         self.LiquidClass = 'Water Free Multi'
-        self.NoOfMultiDisp = 2
+        self.NoOfMultiDisp = None
 
     def add(self, gwl, disp_frac):
+        """Adding asp-disp cycles (1 tip each) to the gwl object.
+        Each aspiration is packed with as many dispenses as fit in the tip:
+        the DTH volume of TipType (default: largest tip type of the gwl object),
+        minus the excess aspirated for disp_frac. NoOfMultiDisp (if not None)
+        is an additional limit on the number of dispenses per aspiration.
+        """
         # volume as iterable
         if hasattr(self.Volume, '__iter__'):
             self.Volumes = self.Volume
         else:
             self.Volumes = [self.Volume] * len(self.DestPositions)
-                    
+        assert len(self.Volumes) == len(self.DestPositions)
+        # skipping 0-volumes
+        volumes = np.round(np.array(self.Volumes, dtype=float), 2)
+        idx = np.flatnonzero(volumes > 0)
+        volumes = volumes[idx]
+        if len(volumes) == 0:
+            return None
+        # max dispense volume per aspiration
+        if self.TipType is None:
+            DTH = gwl._DTH_table[0][-1]
+        else:
+            DTH = gwl.db.get_tip_DTH_volume(self.TipType)
+        max_volume = DTH / (1 - disp_frac + 1)
+        # aspiration volume of dispenses i:ii (rounded)
+        asp_volume = lambda i,ii: round(sum([round(self.Volumes[j], 2) for j in idx[i:ii]])
+                                        * (1-disp_frac+1), 2)
+        # chunking by cumulative volume
+        csum = np.cumsum(volumes)
+        chunks = []
+        i = 0
+        while i < len(volumes):
+            base = csum[i-1] if i > 0 else 0
+            ii = np.searchsorted(csum, base + max_volume, side='left')
+            if self.NoOfMultiDisp is not None:
+                ii = min(ii, i + self.NoOfMultiDisp)
+            ## the rounded aspiration volume must also fit in the tip
+            while ii > i + 1 and asp_volume(i, ii) >= DTH:
+                ii -= 1
+            ii = max(ii, i + 1)  # volume larger than the tip: 1 dispense
+            chunks.append((i, ii))
+            i = ii
+            
         # each multi-disp
-        sample_cnt = 0
-        while 1:
-            # single-asp
-            asp = Aspirate()
-            # determining total volume for this asp            
-            dispenses_tmp = 0
-            sample_cnt_tmp = sample_cnt
-            total_asp_volume = 0
-            while 1:
-                sample_cnt_tmp += 1
-                # Total samples reached
-                if sample_cnt_tmp > len(self.DestPositions):
-                    break
-                # Number of multi-disp reached
-                if dispenses_tmp >= self.NoOfMultiDisp:
-                    sample_cnt_tmp -= 1 
-                    break
-                # Skipping 0-volumes
-                if self.Volumes[sample_cnt_tmp-1] <= 0:
-                    continue
-                disp_volume = round(self.Volumes[sample_cnt_tmp-1], 2)
-                if disp_volume > 0:
-                    total_asp_volume += disp_volume
-                    dispenses_tmp += 1
-            # loading dispenses
+        for i,ii in chunks:
             dispenses = []
-            while 1:
-                sample_cnt += 1
-                # Total samples reached
-                if sample_cnt > len(self.DestPositions):
-                    break
-                # Number of multi-disp reached
-                if len(dispenses) >= self.NoOfMultiDisp:
-                    sample_cnt -= 1 
-                    break
-                # Skipping 0-volumes
-                if self.Volumes[sample_cnt-1] <= 0:
-                    continue 
+            for j in idx[i:ii]:
                 disp = Dispense()
-                disp.RackLabel = self.DestRackLabel[sample_cnt-1]
-                disp.RackType = self.DestRackType[sample_cnt-1]
-                disp.Position = self.DestPositions[sample_cnt-1]
-                disp.Volume = round(self.Volumes[sample_cnt-1], 2)
+                disp.RackLabel = self.DestRackLabel[j]
+                disp.RackType = self.DestRackType[j]
+                disp.Position = self.DestPositions[j]
+                disp.Volume = round(self.Volumes[j], 2)
                 disp.LiquidClass = self.LiquidClass
-                if disp.Volume > 0:
-                    dispenses.append(disp)
-            # break if no more dispenses
-            if len(dispenses) <= 0:
-                break
+                dispenses.append(disp)
             # adding asp-disp cycle
-            asp.Volume = round(sum([x.Volume for x in dispenses]) * (1-disp_frac+1), 2)
-
+            asp = Aspirate()
+            asp.RackLabel = self.SrcRackLabel
+            asp.RackID = self.SrcRackID
+            asp.RackType = self.SrcRackType
+            asp.Position = self.SrcPosition
+            asp.Volume = asp_volume(i, ii)
+            asp.LiquidClass = self.LiquidClass
             # appending to gwl-obj
             gwl.add(asp)
             for x in dispenses:
                 gwl.add(x)
-            gwl.add(Waste())                       
+            gwl.add(Waste())
 
     @property
     def DestPositions(self):
@@ -573,21 +1594,394 @@ class Reagent_distribution(object):
                           'Volume', 'LiquidClass', 'NoOfDiTiReuses',
                           'NoOfMultiDisp', 'Direction', 'ExcludedDestWell']
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # any change resets the rendered command
+        object.__setattr__(self, '_cmd', None)
+
     def cmd(self):
+        # cached
+        if self._cmd is not None:
+            return self._cmd
         # list of values in correct order
         vals = [getattr(self, x) for x in self.key_order]
-        # None to blank string
-        vals = [xstr(x) for x in vals]
-        # convert all to strings
-        vals = [str(x) for x in vals]
-        # return
-        return ';'.join(vals)
+        # None to blank string; convert all to strings
+        vals = [volume_str(x) if k == 'Volume' else str(xstr(x))
+                for k,x in zip(self.key_order, vals)]
+        # caching & return
+        line = ';'.join(vals)
+        object.__setattr__(self, '_cmd', line)
+        return line
 
     def volume_per_aspirate(self):
         """Get the volume per aspiration for the multi-dispense
         """
         return self.Volume * self.NoOfMultiDisp
 
+    def dest_positions(self):
+        """Destination positions of the dispenses (DestPosStart to DestPosEnd,
+        without the ExcludedDestWell positions)
+        Return: list of positions
+        """
+        excluded = self.ExcludedDestWell
+        if excluded is None or excluded == '':
+            excluded = set()
+        else:
+            excluded = set([int(x) for x in str(excluded).split(';') if x != ''])
+        return [x for x in range(int(self.DestPosStart), int(self.DestPosEnd) + 1)
+                if x not in excluded]
+
+    def n_tips(self, geometry=None, n_channels=8):
+        """Number of tips used by the command.
+        Each channel dispenses to its own rows of the destination (column-wise),
+        aspirating once per NoOfMultiDisp dispenses and getting a new tip
+        after NoOfDiTiReuses aspirations.
+        geometry : Labware.geometry of the destination (default: 1 row per channel)
+        """
+        pos = np.array(self.dest_positions(), dtype=int) - 1
+        if len(pos) == 0:
+            return 0
+        if geometry is None:
+            nrows,step = n_channels,1
+        else:
+            nrows,step = geometry.nrows,geometry.channel_step(n_channels)
+        channel = (pos % nrows // step) % n_channels
+        n_disp = np.bincount(channel)
+        n_disp = n_disp[n_disp > 0]
+        ## aspirations per channel, then tips per channel
+        n_multi = max(int(self.NoOfMultiDisp), 1)
+        n_reuse = max(int(self.NoOfDiTiReuses), 1)
+        n_asp = -(-n_disp // n_multi)
+        return int((-(-n_asp // n_reuse)).sum())
+
+
+# reading gwl files
+## Reagent_distribution fields with numeric values
+_R_NUMERIC = ('SrcPosStart', 'SrcPosEnd', 'DestPosStart', 'DestPosEnd',
+              'Volume', 'NoOfDiTiReuses', 'NoOfMultiDisp', 'Direction')
+
+def _parse_value(x, numeric=False):
+    """gwl field value (blank => None; numbers => int or float)
+    """
+    if x == '':
+        return None
+    if numeric:
+        if x.isdigit() or (x[0] == '-' and x[1:].isdigit()):
+            return int(x)
+        return float(x)
+    return x
+
+def _parse_line(line):
+    """Converting 1 gwl line to a command object
+    """
+    ID = line[:2]
+    if ID in ('A;', 'D;'):
+        vals = line.split(';')
+        if len(vals) != 11:
+            msg = 'Asp/Disp commands must have 11 fields (found {})'
+            raise ValueError(msg.format(len(vals)))
+        cls = Aspirate if ID == 'A;' else Dispense
+        obj = cls._new(RackLabel=_parse_value(vals[1]),
+                       RackType=_parse_value(vals[3]),
+                       Position=vals[4],
+                       Volume=_parse_value(vals[6], numeric=True),
+                       LiquidClass=_parse_value(vals[7]),
+                       TipType=_parse_value(vals[8]))
+        for i,x in ((2, 'RackID'), (5, 'TubeID'), (9, 'TipMask'), (10, 'ForceRackType')):
+            if vals[i] != '':
+                setattr(obj, x, vals[i])
+        return obj
+    elif ID == 'R;':
+        obj = Reagent_distribution()
+        n_fields = len(obj.key_order)
+        # ExcludedDestWell (last field) can include semicolons
+        vals = line.split(';', n_fields - 1)
+        if len(vals) == n_fields - 1:
+            # no ExcludedDestWell
+            vals.append('')
+        if len(vals) != n_fields:
+            msg = 'Reagent distribution commands must have {} fields (found {})'
+            raise ValueError(msg.format(n_fields, len(vals)))
+        for x,v in zip(obj.key_order[1:], vals[1:]):
+            setattr(obj, x, _parse_value(v, numeric=x in _R_NUMERIC))
+        return obj
+    elif ID == 'C;':
+        return Comment(line[2:])
+    elif line == 'W;':
+        return Waste()
+    elif line == 'F;':
+        return Flush()
+    elif line == 'B;':
+        return Break()
+    msg = 'Not a valid gwl command: "{}"'
+    raise ValueError(msg.format(line))
+
+def _iter_line_chunks(file_obj, chunk_size=1048576):
+    """Reading lines from a file in chunks.
+    file_obj : file name or file-like object (text or binary)
+    chunk_size : number of characters read at a time
+    Yields: (line number of 1st line, [lines]); line breaks are removed
+    """
+    if hasattr(file_obj, 'read'):
+        inF = file_obj
+    else:
+        inF = open(file_obj)
+    try:
+        line_num = 1
+        rest = ''
+        # multi-byte characters can be split between chunks
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while 1:
+            chunk = inF.read(chunk_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                chunk = decoder.decode(chunk)
+            text = rest + chunk
+            lines = text.split('\n')
+            # last line might be incomplete
+            rest = lines.pop()
+            # '\r\n' can be split between chunks
+            if '\r' in text:
+                lines = [x.rstrip('\r') for x in lines]
+            yield line_num, lines
+            line_num += len(lines)
+        rest = (rest + decoder.decode(b'', final=True)).rstrip('\r')
+        if rest != '':
+            yield line_num, [rest]
+    finally:
+        if inF is not file_obj:
+            inF.close()
+
+def iter_gwl(file_obj, chunk_size=1048576):
+    """Reading gwl commands from a file (streaming).
+    The file is read in chunks, so memory usage does not depend on the file size.
+    file_obj : file name or file-like object
+    chunk_size : number of characters read at a time
+    Yields: command objects (Aspirate, Dispense, Reagent_distribution, Comment, etc.)
+    """
+    for line_num,lines in _iter_line_chunks(file_obj, chunk_size):
+        for i,line in enumerate(lines):
+            if line == '':
+                continue
+            try:
+                yield _parse_line(line)
+            except ValueError as e:
+                msg = 'Line {}: {}'
+                raise ValueError(msg.format(line_num + i, e))
+
+def read_gwl(file_obj, TipTypes=None, columnar=False):
+    """Loading a gwl file into a gwl object.
+    Commands are added with gwl.add(), so labware is checked against the database
+    and tip types are (re-)assigned, which allows tips & labware to be re-counted.
+    file_obj : file name or file-like object
+    TipTypes : tip types used for the commands (default: standard FCA tips)
+    columnar : return a gwl_columnar object (use .table() for a pandas DataFrame)
+    Return: gwl object
+    """
+    if TipTypes is None:
+        TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
+                    'FCA, 50ul SBS', 'FCA, 10ul SBS']
+    gwl_obj = gwl_columnar(TipTypes) if columnar else gwl(TipTypes)
+    for obj in iter_gwl(file_obj):
+        gwl_obj.add(obj)
+    return gwl_obj
+
+
+class gwl_validator(object):
+    """Checking all fields of gwl files against the database.
+    Each command type has a schema: (min & max number of fields,
+    [(field index, field name, field type)], [(RackType index, Position index)]).
+    Each distinct field value is only checked once, so large worklists
+    (with many repeated values) are checked quickly.
+    Blank RackType & LiquidClass fields are allowed (optional in gwl files).
+    """
+    _asp_disp_schema = (10, 11,
+                        [(1, 'RackLabel', 'label'),
+                         (3, 'RackType', 'RackType'),
+                         (4, 'Position', 'position'),
+                         (6, 'Volume', 'volume'),
+                         (7, 'LiquidClass', 'LiquidClass')],
+                        [(3, 4)])
+    schemas = {'A' : _asp_disp_schema,
+               'D' : _asp_disp_schema,
+               'R' : (16, 17,
+                      [(1, 'SrcRackLabel', 'label'),
+                       (3, 'SrcRackType', 'RackType'),
+                       (4, 'SrcPosStart', 'position'),
+                       (5, 'SrcPosEnd', 'position'),
+                       (6, 'DestRackLabel', 'label'),
+                       (8, 'DestRackType', 'RackType'),
+                       (9, 'DestPosStart', 'position'),
+                       (10, 'DestPosEnd', 'position'),
+                       (11, 'Volume', 'volume'),
+                       (12, 'LiquidClass', 'LiquidClass'),
+                       (13, 'NoOfDiTiReuses', 'count'),
+                       (14, 'NoOfMultiDisp', 'count'),
+                       (15, 'Direction', 'count')],
+                      [(3, 4), (3, 5), (8, 9), (8, 10)])}
+
+    def __init__(self, database_dir=None):
+        self.db = db(database_dir)
+        self._checks = {'label' : self._check_label,
+                        'RackType' : self._check_RackType,
+                        'position' : self._check_position,
+                        'volume' : self._check_volume,
+                        'LiquidClass' : self._check_LiquidClass,
+                        'count' : self._check_count}
+        # field type : {value : error message (None = valid)}
+        self._cache = {x:{} for x in self._checks.keys()}
+        self._wells_cache = {}
+
+    def validate(self, file_obj, chunk_size=1048576):
+        """Checking all lines of a gwl file.
+        file_obj : file name or file-like object
+        Return: list of errors: [(line number, message)]
+        """
+        errors = []
+        for line_num,lines in _iter_line_chunks(file_obj, chunk_size):
+            errors += self.validate_lines(lines, line_num)
+        return errors
+
+    def validate_lines(self, lines, line_num=1):
+        """Checking gwl lines.
+        Each distinct line is only checked once.
+        lines : list of gwl lines (no line breaks)
+        line_num : line number of the 1st line
+        Return: list of errors: [(line number, message)]
+        """
+        # distinct lines grouped by command type
+        groups = {}
+        for x in set(lines):
+            try:
+                groups[x[:2]].append(x)
+            except KeyError:
+                groups[x[:2]] = [x]
+        # line : [error messages]
+        bad = {}
+        for ID,x in groups.items():
+            if ID in ('A;', 'D;', 'R;'):
+                bad.update(self._validate_fields(ID[0], x))
+            elif ID == 'C;':
+                continue
+            elif ID in ('W;', 'F;', 'B;'):
+                for y in x:
+                    if y != ID:
+                        bad[y] = ['Not a valid gwl command: "{}"'.format(y)]
+            else:
+                for y in x:
+                    if y == '':
+                        bad[y] = ['Empty lines not allowed in gwl files']
+                    else:
+                        bad[y] = ['Not a valid gwl command: "{}"'.format(y)]
+        # line numbers of errors
+        errors = []
+        if len(bad) > 0:
+            for i,x in enumerate(lines):
+                if x in bad:
+                    errors += [(i + line_num, msg) for msg in bad[x]]
+        return errors
+
+    def _validate_fields(self, ID, lines):
+        """Checking fields of (distinct) lines with the same command type
+        Return: dict of line : [error messages]
+        """
+        min_fields,max_fields,fields,wells = self.schemas[ID]
+        if ID == 'R':
+            # ExcludedDestWell (last field) can contain ';'
+            rows = [x.split(';', max_fields - 1) for x in lines]
+        else:
+            rows = [x.split(';') for x in lines]
+        bad = {}
+        # number of fields
+        n_fields = [len(x) for x in rows]
+        if min(n_fields) < min_fields or max(n_fields) > max_fields:
+            msg = '{} command has {} fields (expected {}-{})'
+            for x,row in zip(lines, rows):
+                if len(row) < min_fields or len(row) > max_fields:
+                    bad[x] = [msg.format(ID, len(row), min_fields, max_fields)]
+            keep = [i for i,x in enumerate(rows) if min_fields <= len(x) <= max_fields]
+            lines = [lines[i] for i in keep]
+            rows = [rows[i] for i in keep]
+            if len(rows) == 0:
+                return bad
+        # field values; each distinct value checked once
+        bad_values = {}
+        for i,name,field_type in fields:
+            values = [x[i] for x in rows]
+            check = self._checks[field_type]
+            cache = self._cache[field_type]
+            bad_values[i] = {}
+            for x in set(values):
+                try:
+                    msg = cache[x]
+                except KeyError:
+                    msg = cache[x] = check(x)
+                if msg is not None:
+                    bad_values[i][x] = '{} {}'.format(name, msg)
+            if len(bad_values[i]) > 0:
+                for x,line in zip(values, lines):
+                    if x in bad_values[i]:
+                        bad.setdefault(line, []).append(bad_values[i][x])
+        # positions within the number of wells of the labware
+        for i,j in wells:
+            pairs = [(x[i], x[j]) for x in rows]
+            bad_pairs = {}
+            for x in set(pairs):
+                if x[0] in bad_values[i] or x[1] in bad_values[j]:
+                    continue
+                try:
+                    msg = self._wells_cache[x]
+                except KeyError:
+                    msg = self._wells_cache[x] = self._check_wells(*x)
+                if msg is not None:
+                    bad_pairs[x] = msg
+            if len(bad_pairs) > 0:
+                for x,line in zip(pairs, lines):
+                    if x in bad_pairs:
+                        bad.setdefault(line, []).append(bad_pairs[x])
+        return bad
+
+    def _check_label(self, x):
+        if x == '':
+            return 'cannot be blank'
+        
+    def _check_RackType(self, x):
+        if x != '' and x not in self.db.labware:
+            return 'not in database: "{}"'.format(x)
+
+    def _check_LiquidClass(self, x):
+        if x != '' and x not in self.db.liquid_class:
+            return 'not in database: "{}"'.format(x)
+
+    def _check_position(self, x):
+        if not x.isdigit() or int(x) < 1:
+            return 'must be an integer >= 1: "{}"'.format(x)
+
+    def _check_count(self, x):
+        if not x.isdigit():
+            return 'must be an integer >= 0: "{}"'.format(x)
+
+    def _check_volume(self, x):
+        try:
+            volume = float(x)
+        except ValueError:
+            return 'is not a number: "{}"'.format(x)
+        if not volume >= 0:
+            return 'must be >= 0: "{}"'.format(x)
+
+    def _check_wells(self, RackType, Position):
+        if RackType == '':
+            return None
+        try:
+            wells = self.db.labware[RackType]['wells']
+        except KeyError:
+            return None
+        if int(Position) > wells:
+            msg = 'Position {} > number of wells ({}) of labware: "{}"'
+            return msg.format(Position, wells, RackType)
+
+
 # main
 if __name__ == '__main__':
     pass
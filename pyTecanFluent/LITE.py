@@ -13,6 +13,8 @@ import pandas as pd
 from pyTecanFluent import Utils
 from pyTecanFluent import Fluent
 from pyTecanFluent import Labware
+from pyTecanFluent import Runtime
+from pyTecanFluent import Tune
 
 
 # functions
@@ -116,6 +118,9 @@ def parse_args(test_args=None, subparsers=None):
                      help='Tagmentation: number of tip reuses for multi-dispense (default: %(default)s)')
     liq.add_argument('--pcr-n-tip-reuse', type=int, default=4,
                      help='PCR: number of tip reuses for multi-dispense (default: %(default)s)')
+    liq.add_argument('--reagent-dist', action='store_true', default=False,
+                     help='Use Reagent_distribution (R) commands for runs of uniform reagent dispenses; requires FCA waste source labware (default: %(default)s)')
+    Tune.add_args(liq)
     
     # running test args
     if test_args:
@@ -149,8 +154,9 @@ def main(args=None):
     # Return
     return gwl_file, lw_file, report_file, df_file
 
-def main_tagmentation(df_map, args):
-    """Tagmentation step of the LITE method
+def make_tag_gwl(df_map, args):
+    """Creating the tagmentation gwl object (in memory)
+    Return: (df_map, gwl)
     """
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
@@ -165,7 +171,7 @@ def main_tagmentation(df_map, args):
 
     # dispensing reagents (greater volume first)
     if args.tag_mm_volume <= 0 and args.sample_volume <= 0:
-        return df_map
+        return df_map, gwl
     elif args.tag_mm_volume >= args.sample_volume:
         ## mastermix
         pip_mastermix(df_map, gwl,
@@ -185,6 +191,26 @@ def main_tagmentation(df_map, args):
                       liq_cls=args.tag_mm_liq,
                       n_tip_reuse=args.tag_n_tip_reuse)
 
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+
+    return df_map, gwl
+
+def main_tagmentation(df_map, args):
+    """Tagmentation step of the LITE method
+    """
+    # tuning tip reuse
+    if args.tune:
+        grid = {'tag_n_tip_reuse' : Tune.GRID['n_tip_reuse']}
+        tune_file = args.prefix + '_tag_tune.txt'
+        Tune.tune_args(make_tag_gwl, df_map, args, grid, tune_file, n_jobs=args.tune_jobs)
+    
+    # gwl construction
+    df_map, gwl = make_tag_gwl(df_map, args)
+    if len(gwl.commands) == 0:
+        return df_map
+    
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '_tag.gwl'
     gwl.write(gwl_file)
@@ -195,6 +221,7 @@ def main_tagmentation(df_map, args):
         write_report(df_map, outFH=repFH,
                      mm_volume=args.tag_mm_volume,
                      error_perc=args.error_perc)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
         
     # making labware table
     lw = Labware.labware()
@@ -213,12 +240,15 @@ def main_tagmentation(df_map, args):
     Utils.file_written(lw_file)
     Utils.file_written(report_file)
     Utils.file_written(df_file)
+    if args.tune:
+        Utils.file_written(tune_file)
 
     # returning modified df_map
     return df_map
 
-def main_PCR(df_map, args):
-    """PCR step of the LITE method
+def make_pcr_gwl(df_map, args):
+    """Creating the PCR gwl object (in memory)
+    Return: (df_map, gwl)
     """
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
@@ -244,6 +274,24 @@ def main_PCR(df_map, args):
                     prm_volume=args.primer_volume,
                     liq_cls=args.primer_liq)
     
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+
+    return df_map, gwl
+
+def main_PCR(df_map, args):
+    """PCR step of the LITE method
+    """
+    # tuning tip reuse
+    if args.tune:
+        grid = {'pcr_n_tip_reuse' : Tune.GRID['n_tip_reuse']}
+        tune_file = args.prefix + '_pcr_tune.txt'
+        Tune.tune_args(make_pcr_gwl, df_map, args, grid, tune_file, n_jobs=args.tune_jobs)
+    
+    # gwl construction
+    df_map, gwl = make_pcr_gwl(df_map, args)
+    
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '_pcr.gwl'
     gwl.write(gwl_file)
@@ -255,6 +303,7 @@ def main_PCR(df_map, args):
                      mm_volume=args.pcr_mm_volume,
                      prm_volume=args.primer_volume,
                      error_perc=args.error_perc)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
         
     # making labware table
     lw = Labware.labware()
@@ -276,6 +325,8 @@ def main_PCR(df_map, args):
     Utils.file_written(lw_file)
     Utils.file_written(report_file)
     Utils.file_written(df_file)
+    if args.tune:
+        Utils.file_written(tune_file)
     for F in biorad_files:
         Utils.file_written(F)
 
@@ -497,80 +548,52 @@ def pip_mastermix(df_map, gwl,  mm_labware_type='25ml_1 waste',
 
     # copying df
     df = df_map.copy()
-    x = cycle(range(8))
-    df['CHANNEL_ORDER'] = [next(x) for y in range(df.shape[0])]
-    x = cycle(range(n_tip_reuse))
-    df['TIP_BATCH'] = Utils.tip_batch(df['CHANNEL_ORDER'], n_tip_reuse)
-    df.sort_values(by=['TIP_BATCH',
-                       'CHANNEL_ORDER',
-                       'TECAN_dest_target_position'], inplace=True)
-    df.reset_index(inplace=True)
+    df = Utils.channel_batches(df, gwl,
+                               'TECAN_dest_labware_name',
+                               'TECAN_dest_labware_type',
+                               'TECAN_dest_target_position',
+                               n_tip_reuse=n_tip_reuse)
     
-    # for each Sample-PCR, write out asp/dispense commands
-    for i in range(df.shape[0]):
-        # aspiration
-        asp = Fluent.Aspirate()
-        asp.RackLabel = 'Mastermix[{0:0>3}]'.format(1)
-        asp.RackType = mm_labware_type
-        asp.Position = 1
-        asp.Volume = mm_volume
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)
-
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df.loc[i,'TECAN_dest_labware_name']
-        disp.RackType = df.loc[i,'TECAN_dest_labware_type']
-        disp.Position = df.loc[i,'TECAN_dest_target_position']
-        disp.Volume = mm_volume
-        disp.LiquidClass = liq_cls
-        gwl.add(disp)
-
-        # tip waste
-        if (i + 1) % n_tip_reuse == 0 or i + 1 == df.shape[0]:
-            gwl.add(Fluent.Waste())
+    with gwl.using_tip_policy(Fluent.tip_reuse(n_tip_reuse)):
+        # for each Sample-PCR, write out asp/dispense commands
+        for i in range(df.shape[0]):
+            # new tip for each channel of a tip batch
+            if i > 0 and df.loc[i,'TIP'] != df.loc[i-1,'TIP']:
+                gwl.drop_tip()
+            # aspiration
+            asp = Fluent.Aspirate()
+            asp.RackLabel = 'Mastermix[{0:0>3}]'.format(1)
+            asp.RackType = mm_labware_type
+            asp.Position = 1
+            asp.Volume = mm_volume
+            asp.LiquidClass = liq_cls
+            gwl.add(asp)
+
+            # dispensing
+            disp = Fluent.Dispense()
+            disp.RackLabel = df.loc[i,'TECAN_dest_labware_name']
+            disp.RackType = df.loc[i,'TECAN_dest_labware_type']
+            disp.Position = df.loc[i,'TECAN_dest_target_position']
+            disp.Volume = mm_volume
+            disp.LiquidClass = liq_cls
+            gwl.add(disp)
             
-    # adding break
-    gwl.add(Fluent.Break())
+        # adding break
+        gwl.add(Fluent.Break())
 
-def pip_primer(i, gwl, df_map, primer_labware_name, 
-               primer_labware_type, primer_target_position,
-               primer_volume, liq_cls):
-    """Pipetting a single primer
-    """
-    # aspiration
-    asp = Fluent.Aspirate()
-    asp.RackLabel = df_map.loc[i, primer_labware_name]
-    asp.RackType = df_map.loc[i, primer_labware_type]
-    asp.Position = df_map.loc[i, primer_target_position]
-    asp.Volume = primer_volume
-    asp.LiquidClass = liq_cls
-    gwl.add(asp)
-
-    # dispensing
-    disp = Fluent.Dispense()
-    disp.RackLabel = df_map.loc[i,'TECAN_dest_labware_name']
-    disp.RackType = df_map.loc[i,'TECAN_dest_labware_type']
-    disp.Position = df_map.loc[i,'TECAN_dest_target_position']
-    disp.Volume = primer_volume
-    asp.LiquidClass = liq_cls
-    gwl.add(disp)
-
-    # waste
-    gwl.add(Fluent.Waste())
-    
 def pip_primers(df_map, gwl, prm_volume=0, liq_cls='Water Free Single'):
     """Commands for aliquoting primers
     """
     gwl.add(Fluent.Comment('Primers'))    
-    for i in range(df_map.shape[0]):
-        if prm_volume <= 0:
-            continue
-        pip_primer(i, gwl, df_map,
-                   'TECAN_primer_labware_name', 
-                   'TECAN_primer_labware_type',
-                   'TECAN_primer_target_position',
-                   prm_volume, liq_cls)
+    if prm_volume > 0:
+        gwl.add_transfers(df_map,
+                          'TECAN_primer_labware_name',
+                          'TECAN_primer_labware_type',
+                          'TECAN_primer_target_position',
+                          'TECAN_dest_labware_name',
+                          'TECAN_dest_labware_type',
+                          'TECAN_dest_target_position',
+                          volume=prm_volume, liq_cls=liq_cls)
         
     # adding break
     gwl.add(Fluent.Break())
@@ -580,30 +603,15 @@ def pip_samples(df_map, gwl, sample_volume, liq_cls='Water Free Single'):
     """
     gwl.add(Fluent.Comment('Samples'))
     # for each Sample-PCR, write out asp/dispense commands
-    for i in range(df_map.shape[0]):
-        if sample_volume <= 0:
-            continue
-        
-        # aspiration
-        asp = Fluent.Aspirate()
-        asp.RackLabel = df_map.loc[i,'TECAN_sample_labware_name']
-        asp.RackType = df_map.loc[i,'TECAN_sample_labware_type']
-        asp.Position = df_map.loc[i,'TECAN_sample_target_position']
-        asp.Volume = sample_volume
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)
-
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df_map.loc[i,'TECAN_dest_labware_name']
-        disp.RackType = df_map.loc[i,'TECAN_dest_labware_type']
-        disp.Position = df_map.loc[i,'TECAN_dest_target_position']
-        disp.Volume = sample_volume
-        disp.LiquidClass = liq_cls
-        gwl.add(disp)
-
-        # waste
-        gwl.add(Fluent.Waste())
+    if sample_volume > 0:
+        gwl.add_transfers(df_map,
+                          'TECAN_sample_labware_name',
+                          'TECAN_sample_labware_type',
+                          'TECAN_sample_target_position',
+                          'TECAN_dest_labware_name',
+                          'TECAN_dest_labware_type',
+                          'TECAN_dest_target_position',
+                          volume=sample_volume, liq_cls=liq_cls)
         
     # adding break
     gwl.add(Fluent.Break())
@@ -619,9 +627,7 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     Return: list of pandas dataframes (1 dataframe per file)
     """
     # Plate import file for Bio-Rad PrimePCR software
-    dest_pos_max = 96 if df_map['TECAN_dest_target_position'].max() <= 96 else 384
-    f = functools.partial(map2biorad, positions=dest_pos_max)
-    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(f)
+    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(map2biorad)
     biorad_files = []
     if isinstance(df_biorad.index, pd.core.index.MultiIndex):
         for labware in df_biorad.index.get_level_values(0).unique():
@@ -635,10 +641,10 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     
     return biorad_files
         
-def map2biorad(df_map, positions):
+def map2biorad(df_map, positions=None):
     """Making a table for loading into the Bio-Rad PrimePCR software
     columns are:  Row,Column,*Target Name,*Sample Name
-    positions = max number of positions on qPCR plate
+    positions = max number of positions on qPCR plate (default: from the destination labware type)
     Notes:
       Row = letter format
       Column = numeric
@@ -647,11 +653,13 @@ def map2biorad(df_map, positions):
     df_biorad = df_biorad[['SampleID', 'TECAN_dest_target_position']]
     df_biorad.columns = ['*Sample Name', 'TECAN_dest_target_position']
     lw_utils = Labware.utils()
-    f = functools.partial(lw_utils.position2well, wells = positions)
-    x = df_map['TECAN_dest_target_position'].apply(f)
-    x = pd.DataFrame([y for y in x], columns=['Row', 'Column'])
-    df_biorad['Row'] = x.iloc[:,0].tolist()
-    df_biorad['Column'] = x.iloc[:,1].tolist()
+    RackType = None
+    if positions is None:
+        RackType = df_map['TECAN_dest_labware_type'].iloc[0]
+    rows,cols = lw_utils.positions2wells(df_map['TECAN_dest_target_position'],
+                                         wells=positions, RackType=RackType)
+    df_biorad['Row'] = rows
+    df_biorad['Column'] = cols
 
     df_biorad['*Target Name'] = np.nan
     df_biorad = df_biorad[['Row', 'Column', '*Target Name', '*Sample Name']]
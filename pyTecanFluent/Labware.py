@@ -20,11 +20,8 @@ class utils(object):
     """
 
     def __init__(self):
-        # target position
-        d = os.path.join(os.path.split(__file__)[0],  'database')
-        f = os.path.join(d, 'labware.json')
-        with open(f) as inF:
-            self.labware = json.load(inF)
+        # labware (shared database)
+        self.labware = Fluent.db().labware
 
     def get_wells(self, RackType):
         """Getting wells of RackType
@@ -37,33 +34,14 @@ class utils(object):
             return None
         return wells
             
-    def position2well(self, position, wells=96, just_row=False, just_col=False):
+    def position2well(self, position, wells=96, just_row=False, just_col=False,
+                      RackType=None):
         """Convert position to well
         Note: assuming column-wise ordering
         Return: list with row & column IDs => [row,column]
         """
-        # making plate index
-        wells = int(wells)
-        if wells == 96:
-            nrows = 8
-            ncols = 12
-        elif wells == 384:
-            nrows = 16
-            ncols = 24
-        else:
-            msg = 'Number of wells ({}) not recognized'
-            raise ValueError(msg.format(wells))
-    
-        rows = list(string.ascii_uppercase[:nrows])
-        cols = [x + 1 for x in range(ncols)]
-        # position : [row, col]
-        pos_idx = {i+1:x for i,x in enumerate(itertools.product(cols, rows))}
-        # getting row-col
-        try:
-            col,row = pos_idx[position]
-        except KeyError:
-            msg = 'Cannot find well for position: {}'
-            raise KeyError(msg.format(position))
+        rows,cols = self.positions2wells([position], wells=wells, RackType=RackType)
+        row,col = str(rows[0]),int(cols[0])
         if just_row == True:
             return row
         elif just_col == True:
@@ -79,39 +57,284 @@ class utils(object):
             return int(well)
         except ValueError:
             pass
-        # if RackType provided, selecting wells from database
-        if RackType is not None:
-            try:
-                wells = self.labware[RackType]['wells']
-            except KeyError:
-                msg = 'No wells found for RackType: "{}"'
-                raise KeyError(msg.format(RackType))
-        # well --> position index
-        wells = int(wells)
-        if wells == 96:
-            nrows = 8
-            ncols = 12
-        elif wells == 384:
-            nrows = 16
-            ncols = 24
+        return int(self.wells2positions([well], wells=wells, RackType=RackType)[0])
+
+    def positions2wells(self, positions, wells=96, RackType=None):
+        """Convert column-wise positions to wells (vectorized)
+        positions : array-like of positions (1 to n-wells)
+        wells : number of wells of the plate
+        RackType : labware type used instead of `wells`
+        Return: (numpy array of row IDs, numpy array of column numbers)
+        """
+        geom = get_geometry(RackType, wells=wells, labware=self.labware)
+        return geom.positions2wells(positions)
+
+    def wells2positions(self, well_ids, wells=96, RackType=None):
+        """Convert well IDs (eg., "A01" or "A1") to column-wise positions (vectorized).
+        Integer values are returned as-is.
+        well_ids : array-like of well IDs
+        wells : number of wells of the plate
+        RackType : labware type (or array-like of types; 1 per well) used instead of `wells`
+        Return: numpy array of positions
+        """
+        well_ids = pd.Series(np.asarray(well_ids, dtype=object))
+        if RackType is None:
+            return get_geometry(wells=wells).wells2positions(well_ids)
+        RackType = np.asarray(RackType, dtype=object)
+        if RackType.ndim == 0:
+            RackType = np.repeat(RackType, well_ids.shape[0])
+        positions = np.zeros(well_ids.shape[0], dtype=int)
+        for x in pd.unique(RackType):
+            idx = RackType == x
+            geom = get_geometry(x, labware=self.labware)
+            positions[idx] = geom.wells2positions(well_ids[idx])
+        return positions
+
+
+# spacing (mm) of the FCA channels
+CHANNEL_PITCH = 9.0
+
+class geometry(object):
+    """Layout of the wells of a labware type (rows x columns; column-wise positions),
+    with lookup tables for converting between positions (1 to n-wells)
+    and well IDs (row letter(s) + column number).
+    pitch = distance between wells (mm); None if unknown.
+    Use get_geometry() to get the (cached) geometry of a labware type.
+    """
+    __slots__ = ('nrows', 'ncols', 'wells', 'pitch', 'rows', 'cols',
+                 '_row_idx', '_positions')
+
+    def __init__(self, nrows, ncols, pitch=None):
+        self.nrows = int(nrows)
+        self.ncols = int(ncols)
+        self.wells = self.nrows * self.ncols
+        self.pitch = pitch
+        # position - 1 : row & column
+        row_ids = row_labels(self.nrows)
+        idx = np.arange(self.wells)
+        self.rows = np.array(row_ids, dtype=object)[idx % self.nrows]
+        self.cols = idx // self.nrows + 1
+        self._row_idx = {x:i for i,x in enumerate(row_ids)}
+        # well ID : position (with & without zero-padding)
+        self._positions = {}
+        for i,(row,col) in enumerate(zip(self.rows, self.cols)):
+            self._positions['{0}{1:0>2}'.format(row, col)] = i + 1
+            self._positions['{0}{1}'.format(row, col)] = i + 1
+
+    def __repr__(self):
+        msg = 'geometry(nrows={}, ncols={}, pitch={})'
+        return msg.format(self.nrows, self.ncols, self.pitch)
+
+    def channel_step(self, n_channels=8):
+        """Number of rows between wells reached by adjacent channels
+        (eg., 2 for a 384-well plate; every other row).
+        Based on the well pitch (if known), else on the number of rows.
+        """
+        if self.pitch:
+            step = int(round(CHANNEL_PITCH / float(self.pitch)))
         else:
-            raise ValueError('Number of wells ({}) not recognized'.format(wells))    
-        rows = list(string.ascii_uppercase[:nrows])
-        cols = [x + 1 for x in range(ncols)]
-        well_idx = {'{0}{1:0>2}'.format(x[1], x[0]):i+1 for i,x in enumerate(itertools.product(cols, rows))}
-        # getting position
+            step = self.nrows // n_channels
+        return max(step, 1)
+
+    def positions2rows(self, positions):
+        """Row indexes (0-indexed) of column-wise positions (vectorized)
+        """
+        return (np.asarray(positions, dtype=int) - 1) % self.nrows
+
+    def positions2wells(self, positions):
+        """Return: (numpy array of row IDs, numpy array of column numbers)
+        """
+        positions = np.asarray(positions)
         try:
-            position = well_idx[well]
+            idx = positions.astype(int)
+        except (TypeError, ValueError):
+            idx = np.zeros(positions.shape, dtype=int)
+        bad = (idx != positions) | (idx < 1) | (idx > self.wells)
+        if bad.any():
+            msg = 'Cannot find well for position: {}'
+            raise KeyError(msg.format(positions[bad][0]))
+        return self.rows[idx - 1], self.cols[idx - 1]
+
+    def wells2positions(self, well_ids):
+        """Return: numpy array of positions (integer values returned as-is)
+        """
+        well_ids = pd.Series(np.asarray(well_ids, dtype=object))
+        positions = pd.to_numeric(well_ids, errors='coerce')
+        is_id = positions.isnull()
+        positions[is_id] = well_ids[is_id].astype(str).map(self._positions)
+        if positions.isnull().any():
+            msg = 'Cannot find well "{}"'
+            raise KeyError(msg.format(well_ids[positions.isnull()].iloc[0]))
+        return positions.values.astype(int)
+
+    def rowcol2positions(self, rows, cols):
+        """Row IDs & column numbers to positions (vectorized)
+        Return: numpy array of positions
+        """
+        row_ids = np.asarray(rows, dtype=object)
+        rows = pd.Series(row_ids).map(self._row_idx)
+        cols = np.asarray(cols, dtype=int)
+        bad = rows.isnull().values | (cols < 1) | (cols > self.ncols)
+        if bad.any():
+            i = np.flatnonzero(bad)[0]
+            msg = 'Destination location "{}{}" is out of range'
+            raise ValueError(msg.format(row_ids[i], cols[i]))
+        return (cols - 1) * self.nrows + rows.values.astype(int) + 1
+
+
+_GEOMETRY = {}
+
+def get_geometry(RackType=None, wells=96, labware=None):
+    """Geometry of a labware type (rows, columns & pitch from the labware database).
+    If no RackType is provided (or the labware has no rows/columns),
+    a standard plate format (2:3 ratio) with `wells` wells is used.
+    Geometries are created once & cached.
+    labware : labware database (default: the shared database)
+    """
+    pitch = None
+    nrows = ncols = None
+    if RackType is not None:
+        if labware is None:
+            labware = Fluent.db().labware
+        try:
+            d = labware[RackType]
         except KeyError:
-            try:
-                # adding zero-padding
-                position = well_idx[well[0] + '0' + well[1:]]
-            except KeyError:
-                msg = 'Cannot find well "{}"'
-                raise KeyError(msg.format(well))
-        # return 
-        return position
-    
+            msg = 'No wells found for RackType: "{}"'
+            raise KeyError(msg.format(RackType))
+        wells = d['wells']
+        nrows,ncols = d.get('rows'),d.get('columns')
+        pitch = d.get('pitch')
+        if nrows is not None and nrows * ncols != wells:
+            msg = 'Rows x columns != wells for RackType: "{}"'
+            raise ValueError(msg.format(RackType))
+    if nrows is None:
+        nrows,ncols = plate_shape(wells)
+    key = (nrows, ncols, pitch)
+    try:
+        return _GEOMETRY[key]
+    except KeyError:
+        _GEOMETRY[key] = geometry(nrows, ncols, pitch)
+        return _GEOMETRY[key]
+
+def plate_shape(wells):
+    """Number of rows & columns of a plate format (2:3 ratio; eg., 96 => (8,12))
+    """
+    wells = int(wells)
+    nrows = max(int(round((wells * 2 / 3.0) ** 0.5)), 1)
+    if wells < 1 or wells % nrows != 0:
+        msg = 'Number of wells ({}) not recognized'
+        raise ValueError(msg.format(wells))
+    return nrows, wells // nrows
+
+def row_labels(nrows):
+    """Row IDs: A-Z, then AA, AB, etc. (eg., 1536-well plates)
+    """
+    letters = string.ascii_uppercase
+    labels = list(letters[:nrows])
+    for i in range(nrows - len(labels)):
+        labels.append(letters[i // 26] + letters[i % 26])
+    return labels
+
+def free_positions(target):
+    """Positions of a target location that labware can be placed on
+    (1 to position_count - 1, without the keep_empty positions;
+    the last position is not used, as in the original worktable layouts)
+    target : target_position database entry
+    """
+    try:
+        position_count = target['position_count']
+    except KeyError:
+        position_count = 1
+    keep_empty = set(target.get('keep_empty', []))
+    return [x for x in range(1, position_count) if x not in keep_empty]
+
+def solve_layout(racks, target_position, transfers=None):
+    """Placing all labware on the worktable at once.
+    Labware is assigned to the free positions of its target location in order of
+    priority, so any labware that does not fit is the lowest priority. On each
+    target location, the labware pairs with the most transfers are then placed
+    closest together (shortest arm travel).
+    racks : list of (RackLabel, labware database entry); in order of priority
+    target_position : target position database (position_count & keep_empty)
+    transfers : dict of (RackLabel, RackLabel) : number of transfers (eg., gwl.count_transfers())
+    Return: dict of RackLabel : (target_location, target_position)
+    Raises: ValueError listing all labware that does not fit
+    """
+    # grouping labware by target location
+    locations = collections.OrderedDict()
+    no_location = []
+    for RackLabel,v in racks:
+        try:
+            psbl_targets = v['target_location']
+        except KeyError:
+            msg = 'Cannot find "target_location" for labware: {}'
+            raise KeyError(msg.format(RackLabel))
+        loc = None
+        for x in psbl_targets:
+            if x in target_position:
+                loc = x
+                break
+        if loc is None:
+            no_location.append(RackLabel)
+        else:
+            locations.setdefault(loc, []).append(RackLabel)
+    # assigning positions
+    layout = {}
+    overflow = []
+    for loc,labels in locations.items():
+        positions = free_positions(target_position[loc])
+        if len(labels) > len(positions):
+            overflow.append((loc, len(positions), labels[len(positions):]))
+            labels = labels[:len(positions)]
+        positions = positions[:len(labels)]
+        for RackLabel,pos in zip(_order_racks(labels, positions, transfers), positions):
+            layout[RackLabel] = (loc, pos)
+    # reporting all labware that does not fit
+    if len(no_location) > 0 or len(overflow) > 0:
+        msgs = ['Not all labware fits on the worktable:']
+        for RackLabel in no_location:
+            msg = '  No possible target location for labware: "{}"'
+            msgs.append(msg.format(RackLabel))
+        for loc,n_pos,labels in overflow:
+            msg = '  Not enough positions for target: "{}" ({} positions); labware not placed: {}'
+            msgs.append(msg.format(loc, n_pos, ', '.join(['"{}"'.format(x) for x in labels])))
+        raise ValueError('\n'.join(msgs))
+    return layout
+
+def _order_racks(labels, positions, transfers=None):
+    """Ordering labware on the positions of 1 target location to minimise
+    arm travel (number of transfers x distance between positions).
+    The priority order is kept unless swapping 2 labware lowers the travel.
+    Return: list of RackLabels (in order of the positions)
+    """
+    if not transfers or len(labels) < 3:
+        return list(labels)
+    # number of transfers between labware pairs (both directions)
+    weights = {x:{} for x in labels}
+    for (src,dest),n in transfers.items():
+        if src == dest or src not in weights or dest not in weights:
+            continue
+        weights[src][dest] = weights[src].get(dest, 0) + n
+        weights[dest][src] = weights[dest].get(src, 0) + n
+    if all(len(x) == 0 for x in weights.values()):
+        return list(labels)
+    # swapping pairs until the travel can't be lowered
+    idx = dict(zip(labels, positions))
+    def travel(x, pos, skip):
+        return sum([n * abs(pos - idx[y]) for y,n in weights[x].items() if y != skip])
+    improved = True
+    while improved:
+        improved = False
+        for a,b in itertools.combinations(labels, 2):
+            pa,pb = idx[a],idx[b]
+            delta = (travel(a, pb, b) + travel(b, pa, a) -
+                     travel(a, pa, b) - travel(b, pb, a))
+            if delta < 0:
+                idx[a],idx[b] = pb,pa
+                improved = True
+    return sorted(labels, key=idx.get)
+
+
 class labware(object):
     """Class for summarizing labware in a gwl object.
     Note: tip boxes are considered separate from other labware
@@ -121,40 +344,85 @@ class labware(object):
         self.tip_boxes = {}
         self.labware = {} 
         self.labware_order = {}
-        # target position
-        d = os.path.join(os.path.split(__file__)[0],  'database')
-        f = os.path.join(d, 'target_position.json')
-        with open(f) as inF:
-            self.target_position = json.load(inF)
+        self.transfers = {}
+        self._tip_mounted = False
+        self._src = None
+        # database (shared)
+        self.db = Fluent.db()
+        self.target_position = self.db.target_position
                 
     def add_gwl(self, gwl):
         """Adding labware from gwl object to labware object.
+        The gwl labware & tip indexes are used (the commands are not walked).
         Note: this can be used to sum up labware from multiple gwl objects.
         """
-        # counting tips
-        self._count_tips(gwl.commands)
+        self.db = gwl.db
+        # counting tips & transfers
+        self._add_tip_count(gwl.count_tips())
+        self._add_transfers(gwl.count_transfers())
         # adding labware 
-        for cmd in gwl.commands:
-            self._add_labware(cmd, gwl)
+        for RackLabel,RackType in gwl.list_labware().items():
+            self._add_rack(RackLabel, RackType, gwl)
         # summing up tip boxes        
-        self._add_tip_boxes(gwl)
+        self._add_tip_boxes()
+
+    def add_commands(self, commands, gwl=None):
+        """Adding tips & labware of gwl commands (eg., from Fluent.iter_gwl()) in 1 pass.
+        gwl : gwl object providing the database (default: shared database)
+        """
+        if gwl is not None:
+            self.db = gwl.db
+        self._tip_mounted = False
+        self._src = None
+        for cmd in commands:
+            self._count_tip(cmd)
+            self._count_transfer(cmd)
+            self._add_labware(cmd, gwl)
+        self._add_tip_boxes()
+
+    def add_command(self, cmd, gwl):
+        """Adding tips & labware of 1 gwl command to labware object.
+        Note: add_gwl() is faster (uses the gwl labware & tip indexes).
+        Tip boxes are not added.
+        """
+        self._count_tip(cmd)
+        self._count_transfer(cmd)
+        self._add_labware(cmd, gwl)
+
+    def merge(self, other):
+        """Adding the labware & tips summarized by another labware object
+        (eg., from another gwl object) without re-walking any commands.
+        Labware of `other` is added after the labware of self.
+        Return: self
+        """
+        self._add_tip_count(other.tip_count)
+        self._add_transfers(other.transfers)
+        for RackLabel in sorted(other.labware_order, key=other.labware_order.get):
+            self._set_rack(RackLabel, other.labware[RackLabel])
+        self._add_tip_boxes()
+        return self
 
     def table(self):
         """Creating pandas dataframe of labware
         columns: labware_name, labware_type,target_location,target_position
+        All labware is placed at once (see solve_layout); labware with the
+        most transfers between them is placed closest together.
         """
-        # init target position counters
-        loc_tracker = {}
-        
         # init liist of dicts (will be coverted to dataframe)
         cols = ['labware_name', 'labware_type',
                 'target_location', 'target_position']
+
+        # tip boxes (sorting largest to smallest tip size; [001], [002], ...), then other labware
+        func = lambda x: (x[1][1]['max_volume'], x[0][0])
+        tip_boxes = sorted(self.tip_boxes.items(), key=func, reverse=True)
+        tip_boxes = [(RackLabel,v[1]) for RackLabel,v in tip_boxes]
+        racks = [(RackLabel,self.labware[RackLabel]) for RackLabel in
+                 sorted(self.labware_order, key=self.labware_order.get)]
+        layout = solve_layout(tip_boxes + racks, self.target_position, self.transfers)
         
-        # adding tip boxes; sorting largest to smallest tip size; [001], [002], ...
+        # adding tip boxes
         df_tips = []
-        func = lambda x: (x[1][1]['max_volume'], x[0][0])
-        for RackLabel,v in sorted(self.tip_boxes.items(), key=func, reverse=True):
-            RackType_num,v = v
+        for RackLabel,v in tip_boxes:
             # RackType
             try:
                 RackType = v['RackType']
@@ -162,10 +430,7 @@ class labware(object):
                 msg = 'No RackType for labware: "{}"'
                 raise KeyError(msg.format(RackLabel))
             # location & position
-            loc,pos = self._next(v, loc_tracker, keep_empty=True)
-            if loc is None:
-                msg = 'No possible target location for labware: "{}"'
-                raise ValueError(msg.format(RackLabel))
+            loc,pos = layout[RackLabel]
             # creating table entry
             df_tips.append({'labware_name' : RackLabel,
                             'labware_type' : RackType,
@@ -173,11 +438,10 @@ class labware(object):
                             'target_position' : pos,
                             'target_location_prompt' : loc,
                             'target_position_prompt' : pos})  # prompt = what is prompted for user
-        # adding other labware; sorting by labware order in the gwl
+        # adding other labware; adapters numbered in order of position
         df_labware = []
         adapter_cnt = {'96 well' : 0, '384 well' : 0}
-        for RackLabel in sorted(self.labware_order, key=self.labware_order.get):
-            v = self.labware[RackLabel]
+        for RackLabel,v in sorted(racks, key=lambda x: layout[x[0]]):
             # RackType
             try:
                 RackType = v['RackType']
@@ -185,12 +449,9 @@ class labware(object):
                 msg = 'No RackType for labware: "{}"'
                 raise KeyError(msg.format(RackLabel))
             # location & position
-            loc,pos = self._next(v, loc_tracker, keep_empty=True)
+            loc,pos = layout[RackLabel]
             loc_prompt = loc
             pos_prompt = pos
-            if loc is None:
-                msg = 'No possible target location for labware: "{}"'
-                raise ValueError(msg.format(RackLabel))
             ## if Racktype includes adapter, adding adapter + plate
             if RackType.startswith('PCR Adapter 96 Well and '):
                 adapter_cnt['96 well'] += 1
@@ -246,70 +507,16 @@ class labware(object):
         # return
         return pd.concat([df_tips, df_labware])
     
-    def _next(self, labware, loc_tracker, keep_empty=True):
-        """Getting nest target position for target location
-        """
-        # what the possible 
-        psbl_targets = labware['target_location']
-        # which of the possible target positions to use?
-        target = None
-        for x in psbl_targets:
-            try:                
-                target = self.target_position[x]
-                target = [x, target]
-                break
-            except KeyError:
-                continue            
-        if target is None:
-            return None
-        # target variables
-        try:
-            position_count = target[1]['position_count']
-        except KeyError:
-            position_count = 1
-        try:
-            keep_empty_list = target[1]['keep_empty']
-        except KeyError:
-            keep_empty_list = None
-        # setting target location
-        while 1:
-            # adding to position counter
-            try:
-                loc_tracker[target[0]] += 1
-            except KeyError:
-                loc_tracker[target[0]] = 1
-
-            # checking if position is available
-            if loc_tracker[target[0]] >= position_count:  
-                msg = 'Not enough positions for target: "{}"'
-                raise ValueError(msg.format(target[0]))
-            elif (keep_empty == True and
-                  loc_tracker[target[0]] in keep_empty_list):
-                continue
-            else:
-                return target[0], loc_tracker[target[0]]                           
-        return None
-
     def _add_labware(self, cmd, gwl):
-        """Adding labware (no tip boxes) to self
+        """Adding labware (no tip boxes) of 1 command to self
         """
         if isinstance(cmd, Fluent.Reagent_distribution):
             assert cmd.SrcRackLabel is not None
             assert cmd.DestRackLabel is not None
             assert cmd.SrcRackType is not None
             assert cmd.DestRackType is not None
-            # labware info
-            self.labware[cmd.SrcRackLabel] = gwl.db.get_labware(cmd.SrcRackType)
-            self.labware[cmd.DestRackLabel] = gwl.db.get_labware(cmd.DestRackType)
-            # labware order in the gwl object
-            try:
-                _ = self.labware_order[cmd.SrcRackLabel]
-            except KeyError:
-                self.labware_order[cmd.SrcRackLabel] = len(self.labware_order.keys())
-            try:
-                _ = self.labware_order[cmd.DestRackLabel]
-            except KeyError:
-                self.labware_order[cmd.DestRackLabel] = len(self.labware_order.keys())            
+            self._add_rack(cmd.SrcRackLabel, cmd.SrcRackType, gwl)
+            self._add_rack(cmd.DestRackLabel, cmd.DestRackType, gwl)
         else:
             try:
                 RackLabel = cmd.RackLabel
@@ -319,21 +526,67 @@ class labware(object):
                 RackType = cmd.RackType
             except AttributeError:
                 return None
-            # labware info
-            self.labware[RackLabel] = gwl.db.get_labware(RackType)
-            # labware order in the gwl
+            self._add_rack(RackLabel, RackType, gwl)
+
+    def _add_rack(self, RackLabel, RackType, gwl=None):
+        """Adding 1 labware (RackLabel + RackType) to self.
+        The database is just queried for new labware (or a new RackType for the RackLabel).
+        """
+        try:
+            if self.labware[RackLabel]['RackType'] == RackType:
+                return None
+        except KeyError:
+            pass
+        db = self.db if gwl is None else gwl.db
+        self._set_rack(RackLabel, db.get_labware(RackType))
+
+    def _set_rack(self, RackLabel, info):
+        """Setting the labware info of RackLabel (order of first use is kept)
+        """
+        self.labware[RackLabel] = info
+        if RackLabel not in self.labware_order:
+            self.labware_order[RackLabel] = len(self.labware_order)
+
+    def _add_tip_count(self, tip_count):
+        """Adding tip counts (dict of TipType : count) to self
+        """
+        for TipType,count in tip_count.items():
             try:
-                _ = self.labware_order[RackLabel]
+                self.tip_count[TipType] += count
             except KeyError:
-                self.labware_order[RackLabel] = len(self.labware_order.keys()) 
+                self.tip_count[TipType] = count
     
-    def _add_tip_boxes(self, gwl):
-        """Adding tip boxes to self
+    def _add_transfers(self, transfers):
+        """Adding transfer counts (dict of (src RackLabel, dest RackLabel) : count) to self
         """
+        for k,count in transfers.items():
+            try:
+                self.transfers[k] += count
+            except KeyError:
+                self.transfers[k] = count
+
+    def _count_transfer(self, cmd):
+        """Counting the transfers of 1 gwl command (source = RackLabel of the last Asp command)
+        """
+        if isinstance(cmd, Fluent.Aspirate):
+            self._src = cmd.RackLabel
+        elif isinstance(cmd, Fluent.Dispense) and self._src is not None:
+            self._add_transfers({(self._src, cmd.RackLabel) : 1})
+        elif isinstance(cmd, Fluent.Waste):
+            self._src = None
+        elif isinstance(cmd, Fluent.Reagent_distribution):
+            key = (cmd.SrcRackLabel, cmd.DestRackLabel)
+            self._add_transfers({key : len(cmd.dest_positions())})
+    
+    def _add_tip_boxes(self, gwl=None):
+        """Setting the tip boxes needed for all counted tips
+        """
+        db = self.db if gwl is None else gwl.db
+        self.tip_boxes = {}
         # getting tip boxes from count
         for TipType,count in self.tip_count.items():
-            tip_box = gwl.db.get_tip_box(TipType)
-            d = gwl.db.get_labware(tip_box)
+            tip_box = db.get_tip_box(TipType)
+            d = db.get_labware(tip_box)
             try:
                 wells = d['wells']
             except KeyError:
@@ -343,35 +596,44 @@ class labware(object):
             n_boxes = int(round(count / wells + 0.5,0))
             for i in range(n_boxes):
                 tip_box_label = '{0}[{1:0>3}]'.format(tip_box, i + 1)
-                self.tip_boxes[tip_box_label] = [i, gwl.db.get_labware(tip_box)]
+                self.tip_boxes[tip_box_label] = [i, d]
                         
     def _count_tips(self, commands):
         """Counting all tip usage in gwl commands and adding to self.
-        Tips can be re-used if no waste command provided, so counting number 
-        of Asp-Waste found.
-        All Asp commands lacking a TipType will be skipped
+        Tips are re-used until a Waste command (eg., "A; D; F; A; D; F; W;"),
+        so a tip is counted for each Asp command without a mounted tip.
         """
-        TipType = None
+        self._tip_mounted = False
         for cmd in commands:
-            if isinstance(cmd, Fluent.Waste):
-                # adding tip to count
-                try:
-                    self.tip_count[TipType] += 1
-                except KeyError:
-                    self.tip_count[TipType] = 1
-            if isinstance(cmd, Fluent.Aspirate):
-                # getting tip type for aspirate
-                try:
-                    TipType = cmd.TipType
-                except AttributeError:
-                    TipType = None
-            if isinstance(cmd, Fluent.Reagent_distribution):
-                # all tips used
-                assert cmd.TipType is not None
-                try: 
-                    self.tip_count[cmd.TipType] += 8    # TODO: more precise
-                except KeyError:
-                    self.tip_count[cmd.TipType] = 8    # TODO: more precise
+            self._count_tip(cmd)
+
+    def _count_tip(self, cmd):
+        """Counting tip usage of 1 gwl command.
+        The TipType of the Asp command picking up the tip is used.
+        """
+        if isinstance(cmd, Fluent.Waste):
+            # dropping tip
+            self._tip_mounted = False
+        if isinstance(cmd, Fluent.Aspirate) and not self._tip_mounted:
+            # adding tip to count
+            try:
+                TipType = cmd.TipType
+            except AttributeError:
+                TipType = None
+            try:
+                self.tip_count[TipType] += 1
+            except KeyError:
+                self.tip_count[TipType] = 1
+            self._tip_mounted = True
+        if isinstance(cmd, Fluent.Reagent_distribution):
+            # tips used by the channels
+            assert cmd.TipType is not None
+            geo = get_geometry(cmd.DestRackType, labware=self.db.labware)
+            n_tips = cmd.n_tips(geo)
+            try: 
+                self.tip_count[cmd.TipType] += n_tips
+            except KeyError:
+                self.tip_count[cmd.TipType] = n_tips
                 
                     
 class worktable_tracker():
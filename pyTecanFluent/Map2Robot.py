@@ -14,6 +14,8 @@ import pandas as pd
 from pyTecanFluent import Utils
 from pyTecanFluent import Fluent
 from pyTecanFluent import Labware
+from pyTecanFluent import Runtime
+from pyTecanFluent import Tune
 
 
 # functions
@@ -123,10 +125,17 @@ def parse_args(test_args=None, subparsers=None):
                       help='Sample liquid class (default: %(default)s)')
     liq.add_argument('--water-liq', type=str, default='Water Free Single Wall Disp',
                       help='Water liquid class (default: %(default)s)')
+    liq.add_argument('--water-multi-disp', action='store_true', default=False,
+                     help='Multi-dispense water (as many wells per aspiration as fit in the tip) (default: %(default)s)')
     liq.add_argument('--n-tip-reuse', type=int, default=4,
                      help='Number of tip reuses for applicable reagents (default: %(default)s)')
     liq.add_argument('--n-multi-disp', type=int, default=1,
                      help='Number of tip reuses for applicable reagents (default: %(default)s)')
+    liq.add_argument('--optimize', action='store_true', default=False,
+                     help='Group pipetting steps by source labware to reduce arm travel (default: %(default)s)')
+    liq.add_argument('--reagent-dist', action='store_true', default=False,
+                     help='Use Reagent_distribution (R) commands for runs of uniform reagent dispenses; requires FCA waste source labware (default: %(default)s)')
+    Tune.add_args(liq)
     
     # running test args
     if test_args:
@@ -154,6 +163,64 @@ def main(args=None):
                       rxn_reps=args.rxns)
     df_map = check_rack_labels(df_map)
     
+    # tuning tip reuse & multi-dispense
+    if args.tune:
+        grid = {'n_tip_reuse' : Tune.GRID['n_tip_reuse'],
+                'n_multi_disp' : Tune.GRID['n_multi_disp']}
+        tune_file = args.prefix + '_tune.txt'
+        Tune.tune_args(make_gwl, df_map, args, grid, tune_file, n_jobs=args.tune_jobs)
+    
+    # gwl construction
+    df_map, gwl = make_gwl(df_map, args)
+    
+    ## writing out worklist (gwl) file
+    gwl_file = args.prefix + '.gwl'
+    gwl.write(gwl_file)
+    
+    # Report (total volumes; sample truncation; samples)
+    report_file = args.prefix + '_report.txt'
+    with open(report_file, 'w') as repFH:
+        write_report(df_map, outFH=repFH,
+                     pcr_volume=args.pcr_volume,
+                     mm_volume=args.mm_volume,
+                     prm_volume=args.prm_volume,
+                     n_rxn_reps=args.rxns,
+                     error_perc=args.error_perc)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
+        
+    # making labware table
+    lw = Labware.labware()
+    lw.add_gwl(gwl)
+    lw_df = lw.table()
+    lw_file = args.prefix + '_labware.txt'
+    lw_df.to_csv(lw_file, sep='\t', index=False)
+        
+    # Mapping file with destinations
+    df_file = args.prefix + '_map.txt'
+    df_map['TECAN_water_rxn_volume'] = df_map['TECAN_water_rxn_volume'].round(2)
+    df_map['TECAN_dest_target_position'] = df_map['TECAN_dest_target_position'].astype(int)
+    df_map['TECAN_pcr_rxn_rep'] = df_map['TECAN_pcr_rxn_rep'].astype(int)
+    df_map.to_csv(df_file, sep='\t', index=False, na_rep='NA')
+
+    # Plate map file for Bio-Rad PrimePCR software (designates: sampleID <--> wellID)
+    biorad_files = PrimerPCR_plate_map(df_map, prefix=args.prefix)
+    
+    # status on files written
+    Utils.file_written(gwl_file)
+    Utils.file_written(lw_file)
+    Utils.file_written(report_file)
+    [Utils.file_written(x) for x in biorad_files]
+    Utils.file_written(df_file)
+    if args.tune:
+        Utils.file_written(tune_file)
+    
+    # Return
+    return (gwl_file, report_file, df_file, lw_file)
+        
+def make_gwl(df_map, args):
+    """Creating the gwl object (in memory) for the PCR setup
+    Return: (df_map, gwl)
+    """
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
                 'FCA, 50ul SBS', 'FCA, 10ul SBS']     
@@ -196,51 +263,21 @@ def main(args=None):
                                prm_volume=args.prm_volume,
                                water_in_mm=args.water_in_mm)
     if sum(df_map['TECAN_water_rxn_volume']) > 0:
-        pip_water(df_map, gwl, liq_cls=args.water_liq)
+        pip_water(df_map, gwl, liq_cls=args.water_liq,
+                  multi_disp=args.water_multi_disp)
     else:
         msg = 'WARNING: water skipped; make sure that water is added to the mastermix!'
         print(msg, file=sys.stderr)
     
-    ## writing out worklist (gwl) file
-    gwl_file = args.prefix + '.gwl'
-    gwl.write(gwl_file)
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
     
-    # Report (total volumes; sample truncation; samples)
-    report_file = args.prefix + '_report.txt'
-    with open(report_file, 'w') as repFH:
-        write_report(df_map, outFH=repFH,
-                     pcr_volume=args.pcr_volume,
-                     mm_volume=args.mm_volume,
-                     prm_volume=args.prm_volume,
-                     n_rxn_reps=args.rxns,
-                     error_perc=args.error_perc)
-        
-    # making labware table
-    lw = Labware.labware()
-    lw.add_gwl(gwl)
-    lw_df = lw.table()
-    lw_file = args.prefix + '_labware.txt'
-    lw_df.to_csv(lw_file, sep='\t', index=False)
-        
-    # Mapping file with destinations
-    df_file = args.prefix + '_map.txt'
-    df_map['TECAN_water_rxn_volume'] = df_map['TECAN_water_rxn_volume'].round(2)
-    df_map['TECAN_dest_target_position'] = df_map['TECAN_dest_target_position'].astype(int)
-    df_map['TECAN_pcr_rxn_rep'] = df_map['TECAN_pcr_rxn_rep'].astype(int)
-    df_map.to_csv(df_file, sep='\t', index=False, na_rep='NA')
+    ## optimizing pipetting order
+    if args.optimize:
+        gwl.optimize()
 
-    # Plate map file for Bio-Rad PrimePCR software (designates: sampleID <--> wellID)
-    biorad_files = PrimerPCR_plate_map(df_map, prefix=args.prefix)
-    
-    # status on files written
-    Utils.file_written(gwl_file)
-    Utils.file_written(lw_file)
-    Utils.file_written(report_file)
-    [Utils.file_written(x) for x in biorad_files]
-    Utils.file_written(df_file)
-    
-    # Return
-    return (gwl_file, report_file, df_file, lw_file)
+    return df_map, gwl
         
 def check_args(args):
     """Checking user input
@@ -446,14 +483,11 @@ def pip_mastermix(df_map, gwl, mm_labware_type='25ml_1 waste',
 
     ## ordering df for proper tip reuse
     if n_multi_disp == 1:
-        x = cycle(range(8))
-        df['CHANNEL_ORDER'] = [next(x) for y in range(df.shape[0])]
-        x = cycle(range(n_tip_reuse))
-        df['TIP_BATCH'] = Utils.tip_batch(df['CHANNEL_ORDER'], n_tip_reuse)
-        df.sort_values(by=['TIP_BATCH',
-                           'CHANNEL_ORDER',
-                           'TECAN_dest_target_position'], inplace=True)
-        df.reset_index(inplace=True)
+        df = Utils.channel_batches(df, gwl,
+                                   'TECAN_dest_labware_name',
+                                   'TECAN_dest_labware_type',
+                                   'TECAN_dest_target_position',
+                                   n_tip_reuse=n_tip_reuse)
         
     # dispense
     for i in range(df_f.shape[0]):
@@ -465,31 +499,32 @@ def pip_mastermix(df_map, gwl, mm_labware_type='25ml_1 waste',
         if n_multi_disp == 1:
             # creating asp-dispense
             liq_cls = re.sub('Multi', 'Single', liq_cls)
-            for ii in range(df_tmp.shape[0]):
-                # aspiration
-                asp = Fluent.Aspirate()
-                if mm_one_source == True:
-                    asp.RackLabel = 'Mastermix'
-                else:
-                    asp.RackLabel = 'Mastermix[{0:0>3}]'.format(i + 1)
-                asp.RackType = mm_labware_type
-                asp.Position = 1
-                asp.Volume = mm_volume
-                asp.LiquidClass = liq_cls
-                gwl.add(asp)
-
-                # dispensing
-                disp = Fluent.Dispense()
-                disp.RackLabel = df_tmp.loc[ii,'TECAN_dest_labware_name']
-                disp.RackType = df_tmp.loc[ii,'TECAN_dest_labware_type']
-                disp.Position = df_tmp.loc[ii,'TECAN_dest_target_position']
-                disp.Volume = mm_volume
-                disp.LiquidClass = liq_cls
-                gwl.add(disp)
-                
-                # waste
-                if (ii + 1) % n_tip_reuse == 0 or ii + 1 == df_tmp.shape[0]:
-                    gwl.add(Fluent.Waste())
+            # (new tip for each plate)
+            with gwl.using_tip_policy(Fluent.tip_reuse(n_tip_reuse)):
+                for ii in range(df_tmp.shape[0]):
+                    # new tip for each channel of a tip batch
+                    if ii > 0 and df_tmp.loc[ii,'TIP'] != df_tmp.loc[ii-1,'TIP']:
+                        gwl.drop_tip()
+                    # aspiration
+                    asp = Fluent.Aspirate()
+                    if mm_one_source == True:
+                        asp.RackLabel = 'Mastermix'
+                    else:
+                        asp.RackLabel = 'Mastermix[{0:0>3}]'.format(i + 1)
+                    asp.RackType = mm_labware_type
+                    asp.Position = 1
+                    asp.Volume = mm_volume
+                    asp.LiquidClass = liq_cls
+                    gwl.add(asp)
+
+                    # dispensing
+                    disp = Fluent.Dispense()
+                    disp.RackLabel = df_tmp.loc[ii,'TECAN_dest_labware_name']
+                    disp.RackType = df_tmp.loc[ii,'TECAN_dest_labware_type']
+                    disp.Position = df_tmp.loc[ii,'TECAN_dest_target_position']
+                    disp.Volume = mm_volume
+                    disp.LiquidClass = liq_cls
+                    gwl.add(disp)
                 
         # using reagent distribution
         else:
@@ -525,42 +560,18 @@ def pip_mastermix(df_map, gwl, mm_labware_type='25ml_1 waste',
     gwl.add(Fluent.Break())
 
         
-def pip_primer(i, gwl, df_map, primer_labware_name, 
-               primer_labware_type, primer_target_position,
-               primer_volume, liq_cls):
-    """Pipetting a single primer
-    """
-    # aspiration
-    asp = Fluent.Aspirate()
-    asp.RackLabel = df_map.loc[i, primer_labware_name]
-    asp.RackType = df_map.loc[i, primer_labware_type]
-    asp.Position = df_map.loc[i, primer_target_position]
-    asp.Volume = primer_volume
-    asp.LiquidClass = liq_cls
-    gwl.add(asp)
-
-    # dispensing
-    disp = Fluent.Dispense()
-    disp.RackLabel = df_map.loc[i,'TECAN_dest_labware_name']
-    disp.RackType = df_map.loc[i,'TECAN_dest_labware_type']
-    disp.Position = df_map.loc[i,'TECAN_dest_target_position']
-    disp.Volume = primer_volume
-    asp.LiquidClass = liq_cls
-    gwl.add(disp)
-
-    # waste
-    gwl.add(Fluent.Waste())
-    
 def pip_primers(df_map, gwl, prm_volume=0, liq_cls='Water Free Single'):
     """Commands for aliquoting primers
     """
     gwl.add(Fluent.Comment('Primers'))    
-    for i in range(df_map.shape[0]):
-        pip_primer(i, gwl, df_map,
-                   'TECAN_primer_labware_name', 
-                   'TECAN_primer_labware_type',
-                   'TECAN_primer_target_position',
-                   prm_volume, liq_cls)
+    gwl.add_transfers(df_map,
+                      'TECAN_primer_labware_name',
+                      'TECAN_primer_labware_type',
+                      'TECAN_primer_target_position',
+                      'TECAN_dest_labware_name',
+                      'TECAN_dest_labware_type',
+                      'TECAN_dest_target_position',
+                      volume=prm_volume, liq_cls=liq_cls)
         
     # adding break
     gwl.add(Fluent.Break())
@@ -571,27 +582,15 @@ def pip_samples(df_map, gwl, liq_cls='Water Free Single'):
     """
     gwl.add(Fluent.Comment('Samples'))
     # for each Sample-PCR_rxn_rep, write out asp/dispense commands
-    for i in range(df_map.shape[0]):
-        # aspiration
-        asp = Fluent.Aspirate()
-        asp.RackLabel = df_map.loc[i,'TECAN_sample_labware_name']
-        asp.RackType = df_map.loc[i,'TECAN_sample_labware_type']
-        asp.Position = df_map.loc[i,'TECAN_sample_target_position']
-        asp.Volume = round(df_map.loc[i,'TECAN_sample_rxn_volume'], 1)
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)
-
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df_map.loc[i,'TECAN_dest_labware_name']
-        disp.RackType = df_map.loc[i,'TECAN_dest_labware_type']
-        disp.Position = df_map.loc[i,'TECAN_dest_target_position']
-        disp.Volume = round(df_map.loc[i,'TECAN_sample_rxn_volume'], 1)
-        disp.LiquidClass = liq_cls
-        gwl.add(disp)
-
-        # waste
-        gwl.add(Fluent.Waste())
+    gwl.add_transfers(df_map,
+                      'TECAN_sample_labware_name',
+                      'TECAN_sample_labware_type',
+                      'TECAN_sample_target_position',
+                      'TECAN_dest_labware_name',
+                      'TECAN_dest_labware_type',
+                      'TECAN_dest_target_position',
+                      volume=df_map['TECAN_sample_rxn_volume'].round(1),
+                      liq_cls=liq_cls)
         
     # adding break
     gwl.add(Fluent.Break())
@@ -614,10 +613,28 @@ def calc_water_needed(df_map, pcr_volume=25.0, mm_volume=13.1,
         df_map['TECAN_water_rxn_volume'] = water_volume
     return df_map
         
-def pip_water(df_map, gwl, liq_cls='Water Free Single'):
+def pip_water(df_map, gwl, liq_cls='Water Free Single', multi_disp=False,
+              disp_frac=0.95):
     """Commands for aliquoting water to each PCR rxn
+    multi_disp : multi-dispense water (see Fluent.multi_disp)
+    disp_frac : fraction of the aspirated volume that is dispensed (multi-dispense)
     """
     gwl.add(Fluent.Comment('Water'))
+
+    # multi-dispense
+    if multi_disp is True:
+        md = Fluent.multi_disp()
+        md.SrcRackLabel = '25ml_1[001]'
+        md.SrcRackType = '25ml_1 waste'
+        md.SrcPosition = 1
+        md.DestRackLabel = df_map['TECAN_dest_labware_name'].tolist()
+        md.DestRackType = df_map['TECAN_dest_labware_type'].tolist()
+        md.DestPositions = df_map['TECAN_dest_target_position']
+        md.Volume = df_map['TECAN_water_rxn_volume'].round(1).tolist()
+        md.LiquidClass = Utils.multi_disp_liq_cls(liq_cls, gwl)
+        md.add(gwl, disp_frac)
+        gwl.add(Fluent.Break())
+        return None
     
     # for each Sample-PCR_rxn_rep, write out asp/dispense commands
     for i in range(df_map.shape[0]):
@@ -658,9 +675,7 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     Return: list of pandas dataframes (1 dataframe per file)
     """
     # Plate import file for Bio-Rad PrimePCR software
-    dest_pos_max = 96 if df_map['TECAN_dest_target_position'].max() <= 96 else 384
-    f = functools.partial(map2biorad, positions=dest_pos_max)
-    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(f)
+    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(map2biorad)
     biorad_files = []
     if isinstance(df_biorad.index, pd.core.index.MultiIndex):
         for labware in df_biorad.index.get_level_values(0).unique():
@@ -674,10 +689,10 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     
     return biorad_files
         
-def map2biorad(df_map, positions):
+def map2biorad(df_map, positions=None):
     """Making a table for loading into the Bio-Rad PrimePCR software
     columns are:  Row,Column,*Target Name,*Sample Name
-    positions = max number of positions on qPCR plate
+    positions = max number of positions on qPCR plate (default: from the destination labware type)
     Notes:
       Row = letter format
       Column = numeric
@@ -686,11 +701,13 @@ def map2biorad(df_map, positions):
     df_biorad = df_biorad[['SampleID', 'TECAN_dest_target_position']]
     df_biorad.columns = ['*Sample Name', 'TECAN_dest_target_position']
     lw_utils = Labware.utils()
-    f = functools.partial(lw_utils.position2well, wells = positions)
-    x = df_map['TECAN_dest_target_position'].apply(f)
-    x = pd.DataFrame([y for y in x], columns=['Row', 'Column'])
-    df_biorad['Row'] = x.iloc[:,0].tolist()
-    df_biorad['Column'] = x.iloc[:,1].tolist()
+    RackType = None
+    if positions is None:
+        RackType = df_map['TECAN_dest_labware_type'].iloc[0]
+    rows,cols = lw_utils.positions2wells(df_map['TECAN_dest_target_position'],
+                                         wells=positions, RackType=RackType)
+    df_biorad['Row'] = rows
+    df_biorad['Column'] = cols
 
     df_biorad['*Target Name'] = np.nan
     df_biorad = df_biorad[['Row', 'Column', '*Target Name', '*Sample Name']]
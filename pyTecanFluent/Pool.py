@@ -97,6 +97,8 @@ def parse_args(test_args=None, subparsers=None):
                          help='Per-sample volume to pool (default: %(default)s)')
     pooling.add_argument('--liq-cls', type=str, default='Water Free Single No-cLLD',
                          help='Liquid class for pooling (default: %(default)s)')
+    pooling.add_argument('--optimize', action='store_true', default=False,
+                         help='Group pipetting steps by source labware to reduce arm travel (default: %(default)s)')
 #    pooling.add_argument('--new-tips',  action='store_true', default=False,
 #                        help='Use new tips between sample replicates? (default: %(default)s)')
 
@@ -161,35 +163,49 @@ def main(args=None):
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
                 'FCA, 50ul SBS', 'FCA, 10ul SBS']     
-    gwl = Fluent.gwl(TipTypes)
+    ## worklist (gwl) file & labware written as commands are added
+    ## (unless the commands are optimized at the end)
+    gwl_file = args.prefix + '.gwl'
+    lw = Labware.labware()
+    if args.optimize:
+        gwl = Fluent.gwl(TipTypes)
+    else:
+        gwl = Fluent.gwl_stream(gwl_file, TipTypes, labware=lw)
     
-    # Reordering src if plate type is 384-well
-    df_samp = Utils.reorder_384well(df_samp, gwl,
-                                    labware_name_col=args.sample_labware_name,
-                                    labware_type_col=args.sample_labware_type,
-                                    position_col=args.position_col)
-
-    # samples
-    pool_samples(df_samp,
-                 gwl,
-                 sample_col=args.sample_col,
-                 labware_name_col=args.sample_labware_name,
-                 labware_type_col=args.sample_labware_type,
-                 position_col=args.position_col,
-                 volume_col=args.volume_col,
-                 dest_labware_name=args.dest_name,
-                 dest_labware_type=args.dest_type,
-                 volume=args.volume,
-                 liq_cls=args.liq_cls)
-                 #new_tips=args.new_tips)
+    try:
+        # Reordering src if plate type is 384-well
+        df_samp = Utils.reorder_384well(df_samp, gwl,
+                                        labware_name_col=args.sample_labware_name,
+                                        labware_type_col=args.sample_labware_type,
+                                        position_col=args.position_col)
+        # samples
+        pool_samples(df_samp,
+                     gwl,
+                     sample_col=args.sample_col,
+                     labware_name_col=args.sample_labware_name,
+                     labware_type_col=args.sample_labware_type,
+                     position_col=args.position_col,
+                     volume_col=args.volume_col,
+                     dest_labware_name=args.dest_name,
+                     dest_labware_type=args.dest_type,
+                     volume=args.volume,
+                     liq_cls=args.liq_cls)
+                     #new_tips=args.new_tips)
+    except Exception:
+        ## no (incomplete) worklist file is written
+        if not args.optimize:
+            gwl.discard()
+        raise
     
     ## writing out worklist (gwl) file
-    gwl_file = args.prefix + '.gwl'
-    gwl.write(gwl_file)
+    if args.optimize:
+        gwl.optimize()
+        gwl.write(gwl_file)
+        lw.add_gwl(gwl)
+    else:
+        gwl.close()
 
     # making labware table
-    lw = Labware.labware()
-    lw.add_gwl(gwl)
     lw_df = lw.table()
     lw_file = args.prefix + '_labware.txt'
     lw_df.to_csv(lw_file, sep='\t', index=False)
@@ -277,9 +293,8 @@ def sample2df(samplefile, sample_col, include_col,
     df.loc[:,include_col].apply(check_include_column)
     ## converting wells to positions
     lw_utils = Labware.utils()
-    f = lambda row: lw_utils.well2position(row[position_col],
-                                           RackType=row[labware_type_col])
-    df[position_col] = df.apply(f, axis=1)
+    df[position_col] = lw_utils.wells2positions(df[position_col],
+                                                RackType=df[labware_type_col])
 
     # selecting relevant columns
     df = df.loc[:,req_cols]
@@ -404,42 +419,33 @@ def pool_samples(df, gwl, sample_col, labware_name_col,
     gwl.add(Fluent.Comment('Sample pooling'))
     
     # for each Sample, generate asp/dispense commands
-    ## optional: keep tips among sample replicates
-    for sample in df[sample_col].unique():
-        df_sub = df.loc[df[sample_col] == sample]
-        df_sub.index = range(df_sub.shape[0])
-        for i in range(df_sub.shape[0]):
-            # aspiration
-            asp = Fluent.Aspirate()
-            asp.RackLabel = df_sub.loc[i, labware_name_col]
-            asp.RackType = df_sub.loc[i, labware_type_col]
-            asp.Position = df_sub.loc[i, position_col]
-            if volume_col.lower() == 'none':
-                asp.Volume = volume
-            else:
-                asp.Volume = df_sub.loc[i, volume_col]
-            if asp.Volume <= 0:
-                msg = 'WARNING: skipping sample because volume <= 0\n'
-                sys.stderr.write(msg)
-                continue
-            asp.LiquidClass = liq_cls
-            gwl.add(asp)
-
-            # dispensing
-            disp = Fluent.Dispense()
-            disp.RackLabel = df_sub.loc[i,'TECAN_dest_labware_name']
-            disp.RackType = df_sub.loc[i,'TECAN_dest_labware_type']
-            disp.Position = df_sub.loc[i,'TECAN_dest_target_position']
-            disp.Volume = asp.Volume
-            disp.LiquidClass = liq_cls
-            gwl.add(disp)
-
-            # tip to waste (each replicate)
-            gwl.add(Fluent.Waste())
-                
-        # tip to waste (between samples)
-        #if new_tips == False:            
-        #    gwl.add(Fluent.Waste())
+    ## samples (& their replicates) pipetted in order of first appearance
+    df = df.loc[pd.notnull(df[sample_col])]
+    samples = pd.Categorical(df[sample_col], categories=df[sample_col].unique())
+    df = df.iloc[np.argsort(samples.codes, kind='mergesort')]
+    if volume_col.lower() == 'none':
+        volumes = np.array([volume] * df.shape[0], dtype=float)
+    else:
+        volumes = df[volume_col].values.astype(float)
+    ## skipping missing volumes (NaN) & no-volume
+    missing = np.isnan(volumes)
+    msg = 'WARNING: skipping sample "{}" because volume is missing\n'
+    for x in df.loc[missing, sample_col]:
+        sys.stderr.write(msg.format(x))
+    volumes = np.where(missing, 0, volumes)
+    msg = 'WARNING: skipping sample because volume <= 0\n'
+    for i in range((volumes[~missing] <= 0).sum()):
+        sys.stderr.write(msg)
+    ## tip to waste (each replicate)
+    gwl.add_transfers(df.iloc[volumes > 0],
+                      labware_name_col,
+                      labware_type_col,
+                      position_col,
+                      'TECAN_dest_labware_name',
+                      'TECAN_dest_labware_type',
+                      'TECAN_dest_target_position',
+                      volume=volumes[volumes > 0],
+                      liq_cls=liq_cls)
 
 
 def filter_samp(df_samp, sample_col):
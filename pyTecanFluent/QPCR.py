@@ -14,6 +14,8 @@ import pandas as pd
 from pyTecanFluent import Utils
 from pyTecanFluent import Fluent
 from pyTecanFluent import Labware
+from pyTecanFluent import Runtime
+from pyTecanFluent import Tune
 
 
 # functions
@@ -94,8 +96,13 @@ def parse_args(test_args=None, subparsers=None):
                       help='Sample liquid class (default: %(default)s)')
     liq.add_argument('--water-liq', type=str, default='Water Free Single Wall Disp',
                       help='Water liquid class (default: %(default)s)')
+    liq.add_argument('--water-multi-disp', action='store_true', default=False,
+                     help='Multi-dispense water (as many wells per aspiration as fit in the tip) (default: %(default)s)')
     liq.add_argument('--n-tip-reuse', type=int, default=4,
                      help='Number of tip reuses for applicable reagents (default: %(default)s)')
+    liq.add_argument('--reagent-dist', action='store_true', default=False,
+                     help='Use Reagent_distribution (R) commands for runs of uniform reagent dispenses; requires FCA waste source labware (default: %(default)s)')
+    Tune.add_args(liq)
 
     # Parse & return
     if test_args:
@@ -126,32 +133,23 @@ def main(args=None):
     df_setup = check_rack_labels(df_setup)
     
     # Reordering dest for optimal pipetting
-    if n_wells == 384:
+    if Labware.get_geometry(args.dest_type).channel_step() > 1:
         df_setup = Utils.reorder_384well(df_setup, gwl,
                                        labware_name_col='dest_labware_name',
                                        labware_type_col='dest_labware_type',
                                        position_col='dest_target_position')
-    elif n_wells == 96:
-        df_setup.sort(['dest_target_position'], inplace=True)
     else:
-        msg = 'Labware type "{}" not recognized'
-        raise ValueError(msg.format(args.desttype))
+        df_setup.sort_values(by=['dest_target_position'], inplace=True)
     
-    # Adding commands to gwl object
-    pip_mastermixes(df_setup, gwl=gwl, 
-                    src_labware_type=args.mm_type,
-                    liq_cls=args.mm_liq,
-                    n_tip_reuse=args.n_tip_reuse)
+    # tuning tip reuse
+    if args.tune:
+        grid = {'n_tip_reuse' : Tune.GRID['n_tip_reuse']}
+        tune_file = args.prefix + '_tune.txt'
+        Tune.tune_args(make_gwl, df_setup, args, grid, tune_file, n_jobs=args.tune_jobs)
     
-    ## Samples
-    pip_samples(df_setup, gwl=gwl,
-                liq_cls=args.samp_liq)
+    # Adding commands to gwl object
+    df_setup, gwl = make_gwl(df_setup, args)
     
-    ## Water
-    pip_water(df_setup, gwl=gwl,
-              src_labware_type=args.water_type,
-              liq_cls=args.water_liq)
-
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '.gwl'
     gwl.write(gwl_file)
@@ -171,11 +169,44 @@ def main(args=None):
             df = df_setup.loc[df_setup['mm name'] == MM_name]        
             df.reset_index(inplace=True)
             write_report(df, MM_name=MM_name, outFH=repFH)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
     
     # status on files written
     Utils.file_written(gwl_file)
     Utils.file_written(lw_file)
     Utils.file_written(report_file)
+    if args.tune:
+        Utils.file_written(tune_file)
+
+def make_gwl(df_setup, args):
+    """Creating the gwl object (in memory) for the qPCR setup
+    Return: (df_setup, gwl)
+    """
+    TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
+                'FCA, 50ul SBS', 'FCA, 10ul SBS']    
+    gwl = Fluent.gwl(TipTypes)
+    
+    # Adding commands to gwl object
+    pip_mastermixes(df_setup, gwl=gwl, 
+                    src_labware_type=args.mm_type,
+                    liq_cls=args.mm_liq,
+                    n_tip_reuse=args.n_tip_reuse)
+    
+    ## Samples
+    pip_samples(df_setup, gwl=gwl,
+                liq_cls=args.samp_liq)
+    
+    ## Water
+    pip_water(df_setup, gwl=gwl,
+              src_labware_type=args.water_type,
+              liq_cls=args.water_liq,
+              multi_disp=args.water_multi_disp)
+
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+
+    return df_setup, gwl
     
 def check_args(args):
     """Checking user input
@@ -276,23 +307,8 @@ def plate2robot_loc(row_val, col_val, n_wells):
     col_vol: string
     plate_type: string; plate type to determine well location indexing
     """    
-    # index for converting row to numeric
-    idx = string.ascii_uppercase
-    idx = {x:i+1 for i,x in enumerate(idx)}    
-    row_val = idx[row_val]
-
-    # getting location on plate
-    msg = 'Destination location "{}" is out of range'
-    if n_wells == 96:
-        loc = (col_val - 1) * 8 + row_val
-        assert loc > 0 and loc <= 96, msg.format(loc)
-    elif n_wells == 384:
-        loc = (col_val - 1) * 16 + row_val
-        assert loc > 0 and loc <= 384, msg.format(loc)
-    else:
-        msg = 'Number of wells is not valid: "{}"'
-        raise ValueError(msg.format(plate_type))
-    return loc
+    geom = Labware.get_geometry(wells=n_wells)
+    return int(geom.rowcol2positions([row_val], [col_val])[0])
 
 
 def add_dest(df_setup, dest_labware_name, dest_labware_type, n_wells=96):
@@ -305,8 +321,9 @@ def add_dest(df_setup, dest_labware_name, dest_labware_type, n_wells=96):
     df_setup['dest_labware_type'] = dest_labware_type
     
     # setting destination location based on plate layout 
-    func = lambda x: plate2robot_loc(x['row'], x['column'], n_wells=n_wells)
-    df_setup['dest_target_position'] = df_setup.apply(func, 1)
+    geom = Labware.get_geometry(dest_labware_type)
+    df_setup['dest_target_position'] = geom.rowcol2positions(df_setup['row'],
+                                                             df_setup['column'])
 
 def reorder_384well(df, reorder_col):
     """Reorder values so that the odd, then the even locations are
@@ -351,42 +368,39 @@ def pip_mastermix(df_map, gwl, MM_name, src_labware_type,
     # df copy
     df = df_map.copy()
     ## ordering df for proper tip reuse
-    x = cycle(range(8))
-    df['CHANNEL_ORDER'] = [next(x) for y in range(df.shape[0])]
-    x = cycle(range(n_tip_reuse))
-    df['TIP_BATCH'] = Utils.tip_batch(df['CHANNEL_ORDER'], n_tip_reuse)
-    df.sort_values(by=['TIP_BATCH',
-                       'CHANNEL_ORDER',
-                       'dest_target_position'], inplace=True)
-    df.reset_index(inplace=True)
+    df = Utils.channel_batches(df, gwl,
+                               'dest_labware_name',
+                               'dest_labware_type',
+                               'dest_target_position',
+                               n_tip_reuse=n_tip_reuse)
     
     # iterating mastermix records in setup table (single mastermix)
     gwl.add(Fluent.Comment('Mastermix: {}'.format(MM_name)))
-    for i in range(df.shape[0]):
-        # aspiration
-        asp = Fluent.Aspirate()
-        asp.RackLabel = '{0} MM[{1:0>3}]'.format(MM_name, 1)
-        asp.RackType = src_labware_type
-        asp.Position = 1
-        asp.Volume = df.loc[i,'mm volume']
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)
+    with gwl.using_tip_policy(Fluent.tip_reuse(n_tip_reuse)):
+        for i in range(df.shape[0]):
+            # new tip for each channel of a tip batch
+            if i > 0 and df.loc[i,'TIP'] != df.loc[i-1,'TIP']:
+                gwl.drop_tip()
+            # aspiration
+            asp = Fluent.Aspirate()
+            asp.RackLabel = '{0} MM[{1:0>3}]'.format(MM_name, 1)
+            asp.RackType = src_labware_type
+            asp.Position = 1
+            asp.Volume = df.loc[i,'mm volume']
+            asp.LiquidClass = liq_cls
+            gwl.add(asp)
         
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df.loc[i,'dest_labware_name']
-        disp.RackType = df.loc[i,'dest_labware_type']
-        disp.Position = df.loc[i,'dest_target_position']
-        disp.Volume = df.loc[i,'mm volume']
-        asp.LiquidClass = liq_cls
-        gwl.add(disp)
-
-        # waste
-        if (i + 1) % n_tip_reuse == 0 or i + 1 == df.shape[0]:
-            gwl.add(Fluent.Waste())
+            # dispensing
+            disp = Fluent.Dispense()
+            disp.RackLabel = df.loc[i,'dest_labware_name']
+            disp.RackType = df.loc[i,'dest_labware_type']
+            disp.Position = df.loc[i,'dest_target_position']
+            disp.Volume = df.loc[i,'mm volume']
+            asp.LiquidClass = liq_cls
+            gwl.add(disp)
                 
-    # finish section
-    gwl.add(Fluent.Break())
+        # finish section
+        gwl.add(Fluent.Break())
 
 def pip_mastermix_multi_disp(df, gwl, MM_name, src_labware_type, multi_disp=6,
                              liq_cls='Mastermix Free Multi'):
@@ -444,36 +458,24 @@ def pip_samples(df_setup, gwl, liq_cls='Water Contact Wet Single'):
         print(msg, file=sys.stderr)
     
     # for each Sample, create asp/dispense commands
-    for i in range(df.shape[0]):
-        # aspiration
-        asp = Fluent.Aspirate()
-        
-        asp.RackLabel = df.loc[i,'sample labware name']
-        asp.RackType = df.loc[i,'sample labware type']
-        asp.Position = df.loc[i, 'sample location']
-        asp.Volume = df.loc[i,'sample volume']
-        asp.LiquidClass = liq_cls
-        gwl.add(asp)
-        
-        # dispensing
-        disp = Fluent.Dispense()
-        disp.RackLabel = df.loc[i,'dest_labware_name']
-        disp.RackType = df.loc[i,'dest_labware_type']
-        disp.Position = df.loc[i,'dest_target_position']
-        disp.Volume = df.loc[i,'sample volume']
-        asp.LiquidClass = liq_cls
-        gwl.add(disp)
-        
-        # waste (no tip re-use)
-        gwl.add(Fluent.Waste())
+    gwl.add_transfers(df,
+                      'sample labware name',
+                      'sample labware type',
+                      'sample location',
+                      'dest_labware_name',
+                      'dest_labware_type',
+                      'dest_target_position',
+                      volume='sample volume', liq_cls=liq_cls)
         
     gwl.add(Fluent.Break())
 
         
 def pip_water(df_setup, gwl, src_labware_type, 
-              liq_cls='Water Contact Wet Single'):
+              liq_cls='Water Contact Wet Single', multi_disp=False,
+              disp_frac=0.95):
     """Writing worklist commands for aliquoting water
-    Using single asp-disp.
+    Using single asp-disp, unless multi_disp=True (see Fluent.multi_disp).
+    disp_frac : fraction of the aspirated volume that is dispensed (multi-dispense)
     """
     gwl.add(Fluent.Comment('Water')) 
     
@@ -484,6 +486,21 @@ def pip_water(df_setup, gwl, src_labware_type,
     if df.shape[0] < df_setup.shape[0]:
         msg = 'WARNING: water asp/disp for some samples skipped due to missing "water volume" values!'
         print(msg, file=sys.stderr)
+
+    # multi-dispense
+    if multi_disp is True:
+        md = Fluent.multi_disp()
+        md.SrcRackLabel = 'Water source[{0:0>3}]'.format(1)
+        md.SrcRackType = src_labware_type
+        md.SrcPosition = 1
+        md.DestRackLabel = df['dest_labware_name'].tolist()
+        md.DestRackType = df['dest_labware_type'].tolist()
+        md.DestPositions = df['dest_target_position']
+        md.Volume = df['water volume'].tolist()
+        md.LiquidClass = Utils.multi_disp_liq_cls(liq_cls, gwl)
+        md.add(gwl, disp_frac)
+        gwl.add(Fluent.Break())
+        return None
     
     # for each Sample, create asp/dispense commands
     for i in range(df.shape[0]):
@@ -0,0 +1,208 @@
+from __future__ import print_function
+
+# import
+## batteries
+import json
+import math
+import collections
+## 3rd party
+import numpy as np
+## package
+from pyTecanFluent import Fluent
+
+
+class runtime(object):
+    """Class for estimating the robot runtime of gwl commands.
+    The estimate is the sum of (parameter * amount) over all "features" of the commands:
+      * ('command', ID) : number of commands of each type (A, D, W, F, C, B, R)
+      * ('tip_pickup',) : number of tip pick-ups (Asp commands without a mounted tip)
+      * ('labware_switch',) : number of Asp/Disp commands using other labware than the previous one
+      * ('R_cycle',) : number of asp-multi-dispense cycles of the R commands (8 channels)
+      * ('liquid_class', liquid, 'aspirate'|'dispense') : volumes (ul) pipetted
+    The parameters (seconds per feature) are in the runtime.json database file
+    and can be fit to measured runtimes (see calibrate()).
+    Liquid class parameters: exact liquid class name, else the first word of
+    the name (eg., "Water"), else "default".
+    Commands are assumed to be run one after another.
+    """
+    def __init__(self, database_dir=None, params=None):
+        if params is None:
+            params = Fluent.db(database_dir).runtime
+        self.params = json.loads(json.dumps(_thaw(params)))
+        self.features = collections.OrderedDict()
+        self._tip_mounted = False
+        self._last_RackLabel = None
+
+    def add_gwl(self, gwl):
+        """Adding the commands of a gwl object
+        """
+        self.add_commands(gwl.commands)
+        return self
+
+    def add_file(self, file_obj):
+        """Adding the commands of a gwl file (file path or file-like object)
+        """
+        self.add_commands(Fluent.iter_gwl(file_obj))
+        return self
+
+    def add_commands(self, commands):
+        """Adding the features of gwl commands
+        """
+        for cmd in commands:
+            self._add_command(cmd)
+        return self
+
+    def _add(self, key, value=1):
+        try:
+            self.features[key] += value
+        except KeyError:
+            self.features[key] = value
+
+    def _liquid(self, LiquidClass):
+        """Liquid class key of the runtime parameters
+        """
+        params = self.params['liquid_class']
+        if LiquidClass in params:
+            return LiquidClass
+        try:
+            x = LiquidClass.split(' ')[0]
+        except AttributeError:
+            x = None
+        return x if x in params else 'default'
+
+    def _add_command(self, cmd):
+        ID = cmd.cmd()[0]
+        self._add(('command', ID))
+        if isinstance(cmd, Fluent.asp_disp):
+            if isinstance(cmd, Fluent.Aspirate):
+                step = 'aspirate'
+                if not self._tip_mounted:
+                    self._add(('tip_pickup',))
+                    self._tip_mounted = True
+            else:
+                step = 'dispense'
+            if cmd.RackLabel != self._last_RackLabel:
+                self._add(('labware_switch',))
+                self._last_RackLabel = cmd.RackLabel
+            volume = 0 if cmd.Volume is None else float(cmd.Volume)
+            self._add(('liquid_class', self._liquid(cmd.LiquidClass), step), volume)
+        elif isinstance(cmd, Fluent.Waste):
+            self._tip_mounted = False
+        elif isinstance(cmd, Fluent.Reagent_distribution):
+            self._add_R(cmd)
+
+    def _add_R(self, cmd):
+        """Features of a Reagent_distribution command (8 channels)
+        """
+        wells = cmd.dest_positions()
+        n_multi = max(int(cmd.NoOfMultiDisp), 1)
+        n_cycles = int(math.ceil(len(wells) / float(8 * n_multi)))
+        n_reuse = max(int(cmd.NoOfDiTiReuses), 1)
+        self._add(('R_cycle',), n_cycles)
+        self._add(('tip_pickup',), int(math.ceil(n_cycles / float(n_reuse))))
+        self._add(('labware_switch',), 2)
+        self._last_RackLabel = cmd.DestRackLabel
+        volume = len(wells) * float(cmd.Volume)
+        liquid = self._liquid(cmd.LiquidClass)
+        self._add(('liquid_class', liquid, 'aspirate'), volume)
+        self._add(('liquid_class', liquid, 'dispense'), volume)
+
+    def _param(self, key):
+        x = self.params
+        for k in key:
+            x = x[k]
+        return x
+
+    def times(self):
+        """Estimated time (seconds) per feature
+        Return: OrderedDict of feature : seconds
+        """
+        return collections.OrderedDict([(k, self._param(k) * v)
+                                        for k,v in self.features.items()])
+
+    def total(self):
+        """Estimated total runtime (seconds)
+        """
+        return sum(self.times().values())
+
+    def summary(self):
+        """Estimated runtime (seconds) per step
+        Return: OrderedDict of step : seconds
+        """
+        steps = collections.OrderedDict([(x, 0.0) for x in
+                                         ['Aspirate', 'Dispense', 'Tips',
+                                          'Labware switches', 'Reagent distribution',
+                                          'Other']])
+        names = {'A' : 'Aspirate', 'D' : 'Dispense', 'W' : 'Tips', 'F' : 'Tips',
+                 'R' : 'Reagent distribution'}
+        for k,v in self.times().items():
+            if k[0] == 'command':
+                step = names.get(k[1], 'Other')
+            elif k[0] == 'liquid_class':
+                step = 'Aspirate' if k[2] == 'aspirate' else 'Dispense'
+            elif k[0] == 'tip_pickup':
+                step = 'Tips'
+            elif k[0] == 'labware_switch':
+                step = 'Labware switches'
+            else:
+                step = 'Reagent distribution'
+            steps[step] += v
+        return steps
+
+    def write(self, outFH):
+        """Writing the runtime estimate (eg., to a report file)
+        """
+        outFH.write('# Robot runtime estimate (min)\n')
+        for k,v in self.summary().items():
+            outFH.write('{}:\t{}\n'.format(k, round(v / 60.0, 1)))
+        outFH.write('Total:\t{}\n'.format(round(self.total() / 60.0, 1)))
+
+    def calibrate(self, runs, min_value=0.0):
+        """Fitting the runtime parameters to measured runtimes (least squares).
+        Just the parameters of features found in the runs are changed.
+        runs : list of (runtime object, measured seconds)
+        min_value : minimum parameter value
+        Return: dict of the calibrated parameters (the runtime.json format)
+        """
+        keys = []
+        for rt,sec in runs:
+            keys += [k for k in rt.features.keys() if k not in keys]
+        X = np.array([[rt.features.get(k, 0) for k in keys] for rt,sec in runs],
+                     dtype=float)
+        y = np.array([sec for rt,sec in runs], dtype=float)
+        # fitting relative to the current parameters (minimum-norm change)
+        p0 = np.array([self._param(k) for k in keys], dtype=float)
+        ## rcond set explicitly (rcond=None requires numpy >= 1.14)
+        rcond = np.finfo(float).eps * max(X.shape)
+        delta = np.linalg.lstsq(X, y - X.dot(p0), rcond=rcond)[0]
+        values = np.maximum(p0 + delta, min_value)
+        for k,v in zip(keys, values):
+            x = self.params
+            for kk in k[:-1]:
+                x = x[kk]
+            x[k[-1]] = float(v)
+        return self.params
+
+    def write_params(self, outfile):
+        """Writing the (calibrated) parameters as a runtime.json file
+        """
+        with open(outfile, 'w') as outF:
+            json.dump(self.params, outF, indent=4)
+            outF.write('\n')
+
+
+def _thaw(x):
+    """Mutable copy of a (read-only) database object
+    """
+    try:
+        return {k:_thaw(v) for k,v in x.items()}
+    except AttributeError:
+        pass
+    if isinstance(x, (list, tuple)):
+        return [_thaw(v) for v in x]
+    return x
+
+
+# main
+if __name__ == '__main__':
+    pass
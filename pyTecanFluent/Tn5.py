@@ -13,6 +13,8 @@ import pandas as pd
 from pyTecanFluent import Utils
 from pyTecanFluent import Fluent
 from pyTecanFluent import Labware
+from pyTecanFluent import Runtime
+from pyTecanFluent import Tune
 from pyTecanFluent import Tn5_pip
 
 
@@ -128,10 +130,13 @@ def parse_args(test_args=None, subparsers=None):
                       help='PCR: Mastermix liquid class (default: %(default)s)')
     liq.add_argument('--primer-liq', type=str, default='Water Contact Wet Single Ignore',
                      help='Primer liquid class (default: %(default)s)')
+    liq.add_argument('--reagent-dist', action='store_true', default=False,
+                     help='Use Reagent_distribution (R) commands for runs of uniform reagent dispenses; requires FCA waste source labware (default: %(default)s)')
 
     misc = parser.add_argument_group('Misc')     
     misc.add_argument('--error-perc', type=float, default=10.0,
                       help='Percent of extra total reagent volume to include (default: %(default)s)')
+    Tune.add_args(misc)
     
     # running test args
     if test_args:
@@ -267,12 +272,10 @@ def calc_Tn5_mastermix_volumes(df_map, DNA_conc, DNA_volume, rxn_volume, error_p
     return [[Tn5_rxn_volume, buffer_rxn_volume, water_rxn_volume],
             [Tn5_volume, buffer_volume, water_volume]]
         
-def main_tagmentation(df_map, args):
-    """Tagmentation step of the Tn5 method
+def make_tag_gwl(df_map, args):
+    """Creating the tagmentation gwl object (in memory)
+    Return: (df_map, gwl)
     """
-    # calculating volumes
-    #df_map = calc_tag_volumes(df_map, args)
-    
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
                 'FCA, 50ul SBS', 'FCA, 10ul SBS']     
@@ -298,6 +301,27 @@ def main_tagmentation(df_map, args):
                         n_tip_reuse = args.tag_n_tip_reuse)
 
         
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+
+    return df_map, gwl
+
+def main_tagmentation(df_map, args):
+    """Tagmentation step of the Tn5 method
+    """
+    # calculating volumes
+    #df_map = calc_tag_volumes(df_map, args)
+    
+    # tuning tip reuse
+    if args.tune:
+        grid = {'tag_n_tip_reuse' : Tune.GRID['n_tip_reuse']}
+        tune_file = args.prefix + '_tag_tune.txt'
+        Tune.tune_args(make_tag_gwl, df_map, args, grid, tune_file, n_jobs=args.tune_jobs)
+    
+    # gwl construction
+    df_map, gwl = make_tag_gwl(df_map, args)
+    
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '_tag.gwl'
     gwl.write(gwl_file)
@@ -321,6 +345,7 @@ def main_tagmentation(df_map, args):
     with open(report_file, 'w') as repFH:
         write_tag_report(df_map, repFH, mm_volumes, args.sample_volume,
                          args.tag_rxn_volume, error_perc=args.error_perc)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
     
     # Mapping file with destinations
     df_file = args.prefix + '_tag_map.txt'
@@ -332,12 +357,15 @@ def main_tagmentation(df_map, args):
     Utils.file_written(lw_file)
     Utils.file_written(report_file)
     Utils.file_written(df_file)
+    if args.tune:
+        Utils.file_written(tune_file)
 
     # returning modified df_map
     return df_map, [gwl_file, lw_file, report_file, df_file]
 
-def main_PCR(df_map, args):
-    """PCR step of the Tn5 method
+def make_pcr_gwl(df_map, args):
+    """Creating the PCR gwl object (in memory)
+    Return: (df_map, gwl)
     """
     # gwl construction
     TipTypes = ['FCA, 1000ul SBS', 'FCA, 200ul SBS',
@@ -363,6 +391,24 @@ def main_PCR(df_map, args):
                             prm_volume=args.primer_volume,
                             liq_cls=args.primer_liq)
     
+    ## reagent distribution (R) commands
+    if args.reagent_dist:
+        gwl.collapse_reagent_runs()
+
+    return df_map, gwl
+
+def main_PCR(df_map, args):
+    """PCR step of the Tn5 method
+    """
+    # tuning tip reuse
+    if args.tune:
+        grid = {'pcr_n_tip_reuse' : Tune.GRID['n_tip_reuse']}
+        tune_file = args.prefix + '_pcr_tune.txt'
+        Tune.tune_args(make_pcr_gwl, df_map, args, grid, tune_file, n_jobs=args.tune_jobs)
+    
+    # gwl construction
+    df_map, gwl = make_pcr_gwl(df_map, args)
+    
     ## writing out worklist (gwl) file
     gwl_file = args.prefix + '_pcr.gwl'
     gwl.write(gwl_file)
@@ -374,6 +420,7 @@ def main_PCR(df_map, args):
                          mm_volume=args.pcr_mm_volume,
                          prm_volume=args.primer_volume,
                          error_perc=args.error_perc)
+        Runtime.runtime().add_gwl(gwl).write(repFH)
         
     # making labware table
     lw = Labware.labware()
@@ -395,6 +442,8 @@ def main_PCR(df_map, args):
     Utils.file_written(lw_file)
     Utils.file_written(report_file)
     Utils.file_written(df_file)
+    if args.tune:
+        Utils.file_written(tune_file)
     for F in biorad_files:
         Utils.file_written(F)
 
@@ -611,9 +660,7 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     Return: list of pandas dataframes (1 dataframe per file)
     """
     # Plate import file for Bio-Rad PrimePCR software
-    dest_pos_max = 96 if df_map['TECAN_dest_target_position'].max() <= 96 else 384
-    f = functools.partial(map2biorad, positions=dest_pos_max)
-    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(f)
+    df_biorad = df_map.groupby('TECAN_dest_labware_name').apply(map2biorad)
     biorad_files = []
     if isinstance(df_biorad.index, pd.core.index.MultiIndex):
         for labware in df_biorad.index.get_level_values(0).unique():
@@ -627,10 +674,10 @@ def PrimerPCR_plate_map(df_map, prefix='PrimerPCR', sep=','):
     
     return biorad_files
         
-def map2biorad(df_map, positions):
+def map2biorad(df_map, positions=None):
     """Making a table for loading into the Bio-Rad PrimePCR software
     columns are:  Row,Column,*Target Name,*Sample Name
-    positions = max number of positions on qPCR plate
+    positions = max number of positions on qPCR plate (default: from the destination labware type)
     Notes:
       Row = letter format
       Column = numeric
@@ -639,11 +686,13 @@ def map2biorad(df_map, positions):
     df_biorad = df_biorad[['SampleID', 'TECAN_dest_target_position']]
     df_biorad.columns = ['*Sample Name', 'TECAN_dest_target_position']
     lw_utils = Labware.utils()
-    f = functools.partial(lw_utils.position2well, wells = positions)
-    x = df_map['TECAN_dest_target_position'].apply(f)
-    x = pd.DataFrame([y for y in x], columns=['Row', 'Column'])
-    df_biorad['Row'] = x.iloc[:,0].tolist()
-    df_biorad['Column'] = x.iloc[:,1].tolist()
+    RackType = None
+    if positions is None:
+        RackType = df_map['TECAN_dest_labware_type'].iloc[0]
+    rows,cols = lw_utils.positions2wells(df_map['TECAN_dest_target_position'],
+                                         wells=positions, RackType=RackType)
+    df_biorad['Row'] = rows
+    df_biorad['Column'] = cols
 
     df_biorad['*Target Name'] = np.nan
     df_biorad = df_biorad[['Row', 'Column', '*Target Name', '*Sample Name']]
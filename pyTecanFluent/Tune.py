@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+# import
+## batteries
+import os
+import sys
+import copy
+import itertools
+import functools
+import multiprocessing
+## 3rd party
+import pandas as pd
+## package
+from pyTecanFluent import Labware
+from pyTecanFluent import Runtime
+
+# default values tested for each parameter
+GRID = {'n_tip_reuse' : [1, 2, 4, 6, 8, 12],
+        'n_multi_disp' : [1, 2, 4, 6, 8, 12]}
+
+
+def add_args(parser):
+    """Adding the tuning args to an argparse parser (or argument group)
+    """
+    parser.add_argument('--tune', action='store_true', default=False,
+                        help='Pick the tip reuse/multi-dispense settings with the lowest estimated runtime (& tip boxes); all settings are tested in memory and written to PREFIX_tune.txt (default: %(default)s)')
+    parser.add_argument('--tune-jobs', type=int, default=0,
+                        help='Number of parallel processes for --tune (0 = all cores) (default: %(default)s)')
+
+def score_gwl(gwl):
+    """Scoring a gwl object by estimated runtime & the number of tip boxes
+    Return: dict of score : value
+    """
+    lw = Labware.labware()
+    lw.add_gwl(gwl)
+    runtime = Runtime.runtime().add_gwl(gwl).total()
+    return {'runtime_min' : round(runtime / 60.0, 2),
+            'tip_boxes' : len(lw.tip_boxes),
+            'tips' : sum(gwl.count_tips().values()),
+            'commands' : len(gwl.commands)}
+
+def _evaluate(make_gwl, df_map, args, params):
+    """Generating & scoring the gwl for 1 set of parameters (output is muted)
+    """
+    args = copy.copy(args)
+    for k,v in params.items():
+        setattr(args, k, v)
+    stdout,stderr = sys.stdout,sys.stderr
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout,sys.stderr = devnull,devnull
+        try:
+            df_map,gwl = make_gwl(df_map.copy(), args)
+        finally:
+            sys.stdout,sys.stderr = stdout,stderr
+    scores = score_gwl(gwl)
+    scores.update(params)
+    return scores
+
+def tune(make_gwl, df_map, args, grid, n_jobs=0, verbose=True):
+    """Generating worklists for a grid of parameters (in memory) and
+    ranking them by estimated runtime, then by number of tip boxes.
+    make_gwl : function(df_map, args) returning (df_map, gwl); must be picklable (module-level)
+    df_map : table of samples/reagents provided to make_gwl (not modified)
+    args : argparse args provided to make_gwl; the grid parameters are set on a copy
+    grid : dict of args attribute : list of values (all combinations are tested)
+    n_jobs : number of parallel processes (0 = all cores)
+    Return: (dict of best parameters, pandas DataFrame of all scores (best first))
+    """
+    keys = list(grid.keys())
+    params = [dict(zip(keys, x)) for x in itertools.product(*[grid[k] for k in keys])]
+    if len(params) == 0:
+        raise ValueError('The parameter grid is empty')
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = min(n_jobs, len(params))
+    func = functools.partial(_evaluate, make_gwl, df_map, args)
+    if n_jobs > 1:
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            scores = pool.map(func, params)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        scores = [func(x) for x in params]
+    # ranking
+    cols = ['runtime_min', 'tip_boxes', 'tips', 'commands']
+    df = pd.DataFrame(scores)[keys + cols]
+    df = df.sort_values(['runtime_min', 'tip_boxes'] + keys).reset_index(drop=True)
+    best = {k:df.loc[0,k].item() for k in keys}
+    # status
+    if verbose:
+        msg = 'Tuning: {} settings tested; best: {} ({} min; {} tip boxes)'
+        best_str = ', '.join(['{}={}'.format(k,v) for k,v in best.items()])
+        print(msg.format(df.shape[0], best_str, df.loc[0,'runtime_min'],
+                         df.loc[0,'tip_boxes']), file=sys.stderr)
+    return best, df
+
+def tune_args(make_gwl, df_map, args, grid, table_file, n_jobs=0):
+    """Tuning & setting the best parameters on args.
+    The comparison table is written to table_file.
+    grid : dict of args attribute : list of values (eg., GRID['n_tip_reuse'])
+    Return: dict of best parameters
+    """
+    best, df = tune(make_gwl, df_map, args, grid, n_jobs=n_jobs)
+    for k,v in best.items():
+        setattr(args, k, v)
+    df.to_csv(table_file, sep='\t', index=False)
+    return best
+
+
+# main
+if __name__ == '__main__':
+    pass
@@ -9,6 +9,9 @@ import itertools
 from functools import partial
 import numpy as np
 import pandas as pd
+## package
+from pyTecanFluent import Fluent
+from pyTecanFluent import Labware
 
 # functions
 def rm_special_chars(x, colname=None):
@@ -70,30 +73,44 @@ def make_range(x, set_zero_index=False):
     return z
 
 
-def check_gwl(gwl_file):
-    """Checking that gwl in correct format
+def check_gwl(gwl_file, database_dir=None):
+    """Checking that gwl in correct format.
+    All fields are checked against the database (see Fluent.gwl_validator).
     gwl_file : input file name or file handle
+    database_dir : directory containing the database JSON files (default: package database)
+    Raises: ValueError listing all errors (with line numbers)
     """
-    # file read
-    try:
-        gwl_file = open(gwl_file, 'r')
-    except ValueError:
-        pass
-    # checks
-    for line in gwl_file:
-        line = line.rstrip()
-        if line is '':
-            msg = 'Empty lines not allowed in gwl files'
-            raise ValueError(msg)
-        if not line[0] in ('A', 'D', 'R', 'W', 'F', 'C', 'B'):
-            msg = '"{}" not a valid command ID'
-            raise ValueError(msg.format(line[0]))
-    # file close
-    gwl_file.close()
+    errors = Fluent.gwl_validator(database_dir).validate(gwl_file)
+    if len(errors) > 0:
+        msg = '{} error(s) in gwl file:\n{}'
+        errors = ['Line {}: {}'.format(*x) for x in errors]
+        raise ValueError(msg.format(len(errors), '\n'.join(errors)))
 
 
+def multi_disp_liq_cls(liq_cls, gwl):
+    """Multi-dispense version of a liquid class
+    (eg., "Water Free Single Wall Disp" => "Water Free Multi Wall Disp").
+    Multi-dispense liquid classes are returned as-is.
+    gwl : gwl object providing the database
+    Raises: ValueError if there is no multi-dispense liquid class in the database
+    """
+    words = liq_cls.split(' ')
+    if 'Multi' in words:
+        multi_cls = liq_cls
+    elif 'Single' in words:
+        multi_cls = ' '.join(['Multi' if x == 'Single' else x for x in words])
+    else:
+        msg = 'Cannot determine the multi-dispense version of liquid class: "{}"'
+        raise ValueError(msg.format(liq_cls))
+    if multi_cls not in gwl.db.liquid_class:
+        msg = 'Multi-dispense liquid class for "{}" not in database: "{}"'
+        raise ValueError(msg.format(liq_cls, multi_cls))
+    return multi_cls
+
 def to_win(file_name, suffix='_win'):
     """Create a copy of a file but with windows line breakds
+    Note: gwl files can be written directly with windows line breaks
+    via Fluent.gwl.write(file_name, line_terminator='\r\n')
     file_name : str, name of file
     suffix : added to file name of copy
     Returns : name of new file
@@ -132,23 +149,24 @@ def backup_file(f):
 def _reorder_384well(df, gwl, labware_type_col, position_col):
     df[position_col] = pd.to_numeric(df[position_col])
     
-    odd_even = lambda x: (x % 2, x)
-
-    # n-wells for labware type
+    # plate geometry of labware type
     labware_type = df[labware_type_col].unique()[0]
-    n_wells = gwl.db.get_labware_wells(labware_type)
-    if n_wells == 384:
-        df = pd.concat([df.loc[df[position_col] % 2 != 0].sort_values(by=position_col),
-                        df.loc[df[position_col] % 2 == 0].sort_values(by=position_col)])
+    geom = Labware.get_geometry(labware_type, labware=gwl.db.labware)
+    step = geom.channel_step()
+    if step > 1:
+        row_set = geom.positions2rows(df[position_col]) % step
+        df = pd.concat([df.loc[row_set == i].sort_values(by=position_col)
+                        for i in range(step)])
     return df
 
 def reorder_384well(df, gwl, labware_name_col, labware_type_col, position_col):
-    """Reordering target positions of any 384-well labware types in df.
-    Reordering to all odd-even in order to account for channel offset (reordering speeds up asp/disp)
+    """Reordering target positions of any high-density plates (eg., 384- or 1536-well) in df.
+    Reordering to sets of rows that the channels can reach together (eg., odd-even rows
+    of a 384-well plate) in order to account for channel offset (reordering speeds up asp/disp)
     Method:
     # group by labware name and iter by groups
-    ## if labware type is 384 well `n_wells = gwl.db.get_labware_wells(labware_type)`
-    ### reorder by odd-even
+    ## if wells are closer than the channels (see Labware.geometry.channel_step)
+    ### reorder by row set (eg., odd-even)
     """
     f = partial(_reorder_384well, gwl=gwl,
                 labware_type_col=labware_type_col,
@@ -185,22 +203,65 @@ def reorder_plate_n_tip_reuse(df, n_tip_reuse):
     return df
 
 
-def tip_batch(x, n_tip_reuse=1):
-    """Grouping asp/disp into tip-reuse batches
+def _group_ids(df, cols):
+    """Group number of each row of df (groups numbered in order of first appearance)
+    Note: same as df.groupby(cols, sort=False).ngroup() (pandas >= 0.20.2)
     """
-    x = list(x)
-    batchID = 0
-    channel_cycles = 1
-    last_value = 0
-    y = []
-    for xx in x:
-        if xx < last_value:
-            if channel_cycles % n_tip_reuse == 0:
-                batchID += 1
-            channel_cycles += 1
-        y.append(batchID)
-        last_value = xx
-    return y
+    keys = np.empty(df.shape[0], dtype=object)
+    keys[:] = list(zip(*[df[x].values for x in cols]))
+    return pd.factorize(keys)[0]
+
+def channel_batches(df, gwl, labware_name_col, labware_type_col, position_col,
+                    n_tip_reuse=1, n_channels=8, verbose=True):
+    """Planning batches of transfers that the channels can pipette in parallel.
+    Destinations (column-wise positions) are grouped into column groups:
+    wells in the same plate column that the channels reach together
+    (every channel_step-th row; eg., odd or even rows of a 384-well plate; see Labware.geometry).
+    The channel of each transfer is set by its row, and each channel
+    re-uses its tip for n_tip_reuse consecutive column groups (1 tip batch).
+    df : pandas.DataFrame; 1 row per transfer (column groups keep their order in df)
+    *_col : destination columns in df
+    verbose : write the channel utilisation to STDERR
+    Return: copy of df sorted for pipetting, with the added columns:
+      CHANNEL = channel of the transfer (0-indexed)
+      TIP_BATCH = tip batch
+      TIP = tip (new tip for each TIP_BATCH-CHANNEL)
+    """
+    df = df.copy()
+    if df.shape[0] == 0:
+        for x in ['CHANNEL', 'TIP_BATCH', 'TIP']:
+            df[x] = []
+        return df
+    # plate geometry
+    geoms = {x:Labware.get_geometry(x, labware=gwl.db.labware)
+             for x in df[labware_type_col].unique()}
+    rows = df[labware_type_col].map({k:v.nrows for k,v in geoms.items()}).values
+    step = df[labware_type_col].map({k:v.channel_step(n_channels)
+                                     for k,v in geoms.items()}).values
+    pos = df[position_col].astype(int).values - 1
+    row = pos % rows
+    # column groups (in order of first use)
+    df['_COLUMN'] = pos // rows
+    df['_ROW_SET'] = row % step
+    cols = [labware_name_col, '_COLUMN', '_ROW_SET']
+    group = _group_ids(df, cols)
+    # channels & tip batches
+    df['CHANNEL'] = (row // step) % n_channels
+    df['TIP_BATCH'] = group // n_tip_reuse
+    df['_GROUP'] = group
+    df['_POS'] = pos
+    df.sort_values(by=['TIP_BATCH', 'CHANNEL', '_GROUP', '_POS'],
+                   kind='mergesort', inplace=True)
+    df['TIP'] = _group_ids(df, ['TIP_BATCH', 'CHANNEL'])
+    df.drop(['_COLUMN', '_ROW_SET', '_GROUP', '_POS'], axis=1, inplace=True)
+    df.reset_index(drop=True, inplace=True)
+    # status
+    if verbose:
+        n_groups = group.max() + 1
+        util = df.shape[0] / float(n_groups * n_channels) * 100
+        msg = 'Channel utilisation: {:.1f}% ({} transfers in {} column batches of {} channels)'
+        print(msg.format(util, df.shape[0], n_groups, n_channels), file=sys.stderr)
+    return df
 
     
 # main
@@ -11,6 +11,7 @@ import unittest
 ## 3rd party
 import pandas as pd
 ## package
+from pyTecanFluent import Fluent
 from pyTecanFluent import Dilute
 from pyTecanFluent import Utils
 
@@ -20,6 +21,17 @@ test_dir = os.path.join(os.path.dirname(__file__))
 data_dir = os.path.join(test_dir, 'data')
 
 
+def well_volumes(gwl_file):
+    """Total volume dispensed into each well (RackLabel, Position)
+    """
+    volumes = {}
+    for cmd in Fluent.iter_gwl(gwl_file):
+        if isinstance(cmd, Fluent.Dispense):
+            key = (cmd.RackLabel, cmd.Position)
+            volumes[key] = round(volumes.get(key, 0) + cmd.Volume, 6)
+    return volumes
+
+
 # tests
 class Test_Dilute_main1(unittest.TestCase):
 
@@ -53,6 +65,26 @@ class Test_Dilute_main2(unittest.TestCase):
         ret = Utils.check_gwl(self.files[0])
         self.assertIsNone(ret)
 
+class Test_Dilute_main_dil_multi_disp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        concfile = os.path.join(data_dir, 'conc_file2.txt')
+        prefix = os.path.join(self.tmp_dir, 'single_')
+        self.files = Dilute.main(Dilute.parse_args(['--prefix', prefix, concfile]))
+        prefix = os.path.join(self.tmp_dir, 'multi_')
+        self.args = Dilute.parse_args(['--prefix', prefix, '--dil-multi-disp', concfile])
+        self.files_md = Dilute.main(self.args)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)        
+
+    def test_main_gwl(self):
+        ret = Utils.check_gwl(self.files_md[0])
+        self.assertIsNone(ret)
+        # same volume dispensed into each well
+        self.assertEqual(well_volumes(self.files_md[0]), well_volumes(self.files[0]))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -4,7 +4,10 @@
 # import
 ## batteries
 import os
+import io
 import sys
+import shutil
+import tempfile
 import unittest
 ## 3rd party
 import pandas as pd
@@ -33,6 +36,19 @@ class Test_db(unittest.TestCase):
         v = self.db.get_labware(RackType)
         self.assertTrue(isinstance(v, dict))
 
+    def test_shared(self):
+        db2 = Fluent.db()
+        self.assertIs(self.db.labware, db2.labware)
+        RackType = self.db.RackTypes()[0]
+        with self.assertRaises(TypeError):
+            self.db.labware[RackType]['wells'] = 0
+
+    def test_reload(self):
+        labware = self.db.labware
+        Fluent.reload_database()
+        self.assertIsNot(Fluent.db().labware, labware)
+        self.assertEqual(Fluent.db().RackTypes(), self.db.RackTypes())
+
 class Test_aspirate(unittest.TestCase):
     def setUp(self):
         self.asp = Fluent.Aspirate()
@@ -44,6 +60,20 @@ class Test_aspirate(unittest.TestCase):
 
     def test_cmd(self):
         self.assertTrue(isinstance(self.asp.cmd(), str))
+        self.assertEqual(self.asp.cmd(), 'A;test;;test;1;;;Water Free Single;;;')
+
+    def test_cmd_cache(self):
+        self.assertEqual(self.asp.cmd(), 'A;test;;test;1;;;Water Free Single;;;')
+        self.asp.Position = 2
+        self.asp.Volume = 0.1 + 0.2
+        self.assertEqual(self.asp.cmd(), 'A;test;;test;2;;0.3;Water Free Single;;;')
+        self.asp.Volume = 2
+        self.assertEqual(self.asp.cmd(), 'A;test;;test;2;;2;Water Free Single;;;')
+
+    def test_slots(self):
+        self.assertFalse(hasattr(self.asp, '__dict__'))
+        with self.assertRaises(AttributeError):
+            self.asp.not_a_field = 1
 
 class Test_dispense(unittest.TestCase):
     def setUp(self):
@@ -77,6 +107,44 @@ class Test_waste(unittest.TestCase):
         ret = self.waste.cmd()
         self.assertTrue(isinstance(ret, str))        
             
+class Test_multi_disp(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        self.md = Fluent.multi_disp()
+        self.md.SrcRackLabel = 'Water'
+        self.md.SrcRackType = '25ml_1 waste'
+        self.md.DestRackLabel = ['dest'] * 10
+        self.md.DestRackType = ['96 Well Eppendorf TwinTec PCR'] * 10
+        self.md.DestPositions = range(1, 11)
+        self.md.Volume = [10, 20, 0, 50, 30] * 2
+        self.md.LiquidClass = 'Water Free Multi'
+
+    def tearDown(self):
+        pass
+
+    def _asp_volumes(self):
+        return [x.Volume for x in self.gwl.commands if isinstance(x, Fluent.Aspirate)]
+        
+    def test_add(self):
+        # packed by the DTH volume of the largest tip (170 ul)
+        self.md.add(self.gwl, 0.95)
+        self.assertEqual(self._asp_volumes(), [147.0, 84.0])
+        disp = [x.Position for x in self.gwl.commands if isinstance(x, Fluent.Dispense)]
+        self.assertEqual(disp, [1, 2, 4, 5, 6, 7, 9, 10])
+
+    def test_add_rounding(self):
+        # 80.95 * 2 * 1.05 = 169.995 => rounded to the largest DTH volume (170 ul)
+        self.md.Volume = [80.95] * 10
+        self.md.add(self.gwl, 0.95)
+        self.assertEqual(self._asp_volumes(), [85.0] * 10)
+        self.assertEqual(set(self.gwl.count_tips()), set(['FCA, 200ul SBS']))
+
+    def test_add_max_disp(self):
+        self.md.TipType = 'FCA, 50ul SBS'
+        self.md.NoOfMultiDisp = 2
+        self.md.add(self.gwl, 0.95)
+        self.assertEqual(self._asp_volumes(), [31.5, 52.5, 31.5, 31.5, 52.5, 31.5])
+
 class Test_gwl(unittest.TestCase):
     def setUp(self):
         self.gwl = Fluent.gwl()
@@ -87,7 +155,479 @@ class Test_gwl(unittest.TestCase):
     def test_add(self):
         asp = Fluent.Aspirate()
         self.assertRaises(AssertionError, self.gwl.add, asp)
+
+    def test_write_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            gwl_file = os.path.join(tmp_dir, 'test.gwl')
+            self.gwl.add(Fluent.Comment('test'))
+            self.gwl.add(Fluent.Waste())
+            for line_terminator in ['\n', '\r\n']:
+                self.gwl.write(gwl_file, line_terminator=line_terminator)
+                with open(gwl_file, 'rb') as inF:
+                    text = inF.read()
+                self.assertEqual(text, line_terminator.join(['C;test', 'W;', '']).encode('utf-8'))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_set_TipTypes(self):
+        gwl = Fluent.gwl(['FCA, 1000ul SBS', 'FCA, 200ul SBS',
+                          'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        volumes = [0.5, 8, 8.1, 42, 100, 170, 999.9]
+        for RackType in [None, '96 Well Eppendorf TwinTec PCR', '10ml Falcon']:
+            tips = [gwl.set_TipType(x, RackType) for x in volumes]
+            self.assertEqual(gwl.set_TipTypes(volumes, RackType), tips)
+        self.assertRaises(ValueError, gwl.set_TipTypes, [1, 1000])
+
+    def test_validation_cache(self):
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS'])
+        for i in range(3):
+            asp = Fluent.Aspirate()
+            asp.RackLabel = 'tube'
+            asp.RackType = '1.5ml Eppendorf'
+            asp.Position = i + 2
+            asp.Volume = 10
+            gwl.add(asp)
+        self.assertEqual([x.Position for x in gwl.commands], [1, 1, 1])
+        self.assertEqual(gwl.validation_stats(), {'hits' : 2, 'misses' : 1})
+
+class Test_gwl_optimize(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        self.df = pd.DataFrame({'src_name' : ['src1', 'src2', 'src1', 'src2'],
+                                'src_type' : '96 Well Eppendorf TwinTec PCR',
+                                'src_pos' : [1, 2, 3, 4],
+                                'dest_name' : 'dest',
+                                'dest_type' : '96 Well Eppendorf TwinTec PCR',
+                                'dest_pos' : [1, 2, 3, 4],
+                                'volume' : 5})
+        self.cols = ['src_name', 'src_type', 'src_pos',
+                     'dest_name', 'dest_type', 'dest_pos']
+
+    def tearDown(self):
+        pass
+
+    def test_optimize(self):
+        self.gwl.add(Fluent.Comment('section 1'))
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume')
+        self.gwl.add(Fluent.Break())
+        self.gwl.add_transfers(self.df.iloc[[0, 1]], *self.cols, volume='volume')
+        before = [x.cmd() for x in self.gwl.commands]
+        ret = self.gwl.optimize(verbose=False)
+        self.assertEqual(ret, (5, 3))
+        after = [x.cmd() for x in self.gwl.commands]
+        self.assertEqual(sorted(before), sorted(after))
+        srcs = [x.Position for x in self.gwl.commands if isinstance(x, Fluent.Aspirate)]
+        self.assertEqual(srcs, [1, 3, 2, 4, 1, 2])
+        self.assertEqual(list(self.gwl.list_labware().keys()), ['src1', 'dest', 'src2'])
+
+    def test_dependent(self):
+        # dispensing into a source well: order kept
+        self.df.loc[3, 'dest_name'] = 'src1'
+        self.df.loc[3, 'dest_pos'] = 3
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume')
+        self.assertEqual(self.gwl.optimize(verbose=False), (3, 3))
+
+class Test_gwl_collapse_reagent_runs(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        pos = [x for x in range(1, 11) if x != 4]
+        self.df = pd.DataFrame({'src_name' : 'Mastermix',
+                                'src_type' : '25ml_1 waste',
+                                'src_pos' : 1,
+                                'dest_name' : 'dest',
+                                'dest_type' : '96 Well Eppendorf TwinTec PCR',
+                                'dest_pos' : pos,
+                                'volume' : 10})
+        self.cols = ['src_name', 'src_type', 'src_pos',
+                     'dest_name', 'dest_type', 'dest_pos']
+
+    def tearDown(self):
+        pass
+
+    def test_collapse(self):
+        self.gwl.add(Fluent.Comment('mastermix'))
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume', n_tip_reuse=3)
+        ret = self.gwl.collapse_reagent_runs(verbose=False)
+        self.assertEqual(ret, 1)
+        self.assertEqual(len(self.gwl.commands), 2)
+        rd = self.gwl.commands[1]
+        self.assertTrue(isinstance(rd, Fluent.Reagent_distribution))
+        self.assertEqual((rd.DestPosStart, rd.DestPosEnd), (1, 10))
+        self.assertEqual(rd.ExcludedDestWell, '4')
+        self.assertEqual(rd.NoOfDiTiReuses, 3)
+        self.assertEqual(rd.Volume, 10)
+        self.assertEqual(list(self.gwl.list_labware().keys()), ['Mastermix', 'dest'])
+
+    def test_no_collapse(self):
+        # source is not FCA waste labware
+        self.df['src_type'] = '96 Well Eppendorf TwinTec PCR'
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume')
+        before = [x.cmd() for x in self.gwl.commands]
+        self.assertEqual(self.gwl.collapse_reagent_runs(verbose=False), 0)
+        self.assertEqual([x.cmd() for x in self.gwl.commands], before)
+
+class Test_reagent_distribution_tips(unittest.TestCase):
+    def setUp(self):
+        self.rd = Fluent.Reagent_distribution()
+        self.rd.SrcRackLabel = 'Mastermix'
+        self.rd.SrcRackType = '25ml_1 waste'
+        self.rd.DestRackLabel = 'dest'
+        self.rd.DestRackType = '96 Well Eppendorf TwinTec PCR'
+        self.rd.DestPosStart = 1
+        self.rd.DestPosEnd = 96
+        self.rd.NoOfMultiDisp = 4
+        self.rd.NoOfDiTiReuses = 1
+
+    def tearDown(self):
+        pass
+
+    def test_dest_positions(self):
+        self.rd.ExcludedDestWell = ''
+        self.assertEqual(len(self.rd.dest_positions()), 96)
+        self.rd.ExcludedDestWell = '1;2;96'
+        self.assertEqual(self.rd.dest_positions()[:2], [3, 4])
+        self.assertEqual(len(self.rd.dest_positions()), 93)
+
+    def test_n_tips(self):
+        geo = Labware.get_geometry(self.rd.DestRackType)
+        # 12 dispenses per channel => 3 aspirations per channel
+        self.assertEqual(self.rd.n_tips(geo), 24)
+        self.rd.NoOfDiTiReuses = 3
+        self.assertEqual(self.rd.n_tips(geo), 8)
+        # just column 1: 1 dispense per channel
+        self.rd.DestPosEnd = 8
+        self.assertEqual(self.rd.n_tips(geo), 8)
+        # channels without dispenses use no tips
+        self.rd.ExcludedDestWell = '5;6;7;8'
+        self.assertEqual(self.rd.n_tips(geo), 4)
+        self.rd.DestPosEnd = 0
+        self.assertEqual(self.rd.n_tips(geo), 0)
+
+    def test_n_tips_384(self):
+        self.rd.DestRackType = '384 Well Biorad PCR'
+        self.rd.DestPosEnd = 384
+        geo = Labware.get_geometry(self.rd.DestRackType)
+        # 48 dispenses per channel => 12 aspirations per channel
+        self.assertEqual(self.rd.n_tips(geo), 96)
+        # odd & even rows of column 1 share channels
+        self.rd.DestPosEnd = 16
+        self.rd.NoOfMultiDisp = 1
+        self.assertEqual(self.rd.n_tips(geo), 16)
+        self.rd.NoOfMultiDisp = 2
+        self.assertEqual(self.rd.n_tips(geo), 8)
+
+    def test_tip_count(self):
+        self.rd.ExcludedDestWell = '1;9;17'
+        self.rd.Volume = 20
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        gwl.add(self.rd)
+        self.assertEqual(gwl.count_tips(), {'FCA, 200ul SBS' : 24})
+        lw = Labware.labware()
+        lw.add_gwl(gwl)
+        self.assertEqual(lw.tip_count, gwl.count_tips())
+
+class Test_tip_policy(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+
+    def tearDown(self):
+        pass
+
+    def _transfer(self, src, dest_pos, volume=5):
+        asp = Fluent.Aspirate()
+        asp.RackLabel = src
+        asp.RackType = '25ml_1 waste'
+        asp.Volume = volume
+        self.gwl.add(asp)
+        disp = Fluent.Dispense()
+        disp.RackLabel = 'dest'
+        disp.RackType = '96 Well Eppendorf TwinTec PCR'
+        disp.Position = dest_pos
+        disp.Volume = volume
+        self.gwl.add(disp)
+
+    def _IDs(self):
+        return ''.join([x.cmd()[0] for x in self.gwl.commands])
+        
+    def test_tip_reuse(self):
+        with self.gwl.using_tip_policy(Fluent.tip_reuse(2)):
+            for i,src in enumerate(['src1', 'src1', 'src1', 'src2']):
+                self._transfer(src, i + 1)
+        self.assertEqual(self._IDs(), 'ADADWADWADW')
+        self.assertEqual(self.gwl.count_tips(), {'FCA, 10ul SBS' : 3})
+        self.assertTrue(self.gwl.tip_policy is None)
+
+    def test_tip_type(self):
+        # no reuse for different tip types
+        with self.gwl.using_tip_policy(Fluent.tip_reuse(4)):
+            for i,volume in enumerate([5, 5, 30]):
+                self._transfer('src1', i + 1, volume)
+        self.assertEqual(self._IDs(), 'ADADWADW')
+        self.assertEqual(self.gwl.count_tips(),
+                         {'FCA, 10ul SBS' : 1, 'FCA, 50ul SBS' : 1})
+
+    def test_tip_flush(self):
+        self.gwl.tip_policy = Fluent.tip_flush()
+        for i in range(3):
+            self._transfer('src1', i + 1)
+        self.gwl.add(Fluent.Break())
+        self.assertEqual(self._IDs(), 'ADFADFADFWB')
+        self.assertEqual(self.gwl.count_tips(), {'FCA, 10ul SBS' : 1})
+        # same count from commands
+        lw = Labware.labware()
+        lw._count_tips(self.gwl.commands)
+        self.assertEqual(lw.tip_count, self.gwl.count_tips())
+
+class Test_gwl_add_transfers(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        self.df = pd.DataFrame({'src_name' : ['src', 'src', 'tube'],
+                                'src_type' : ['96 Well Eppendorf TwinTec PCR',
+                                              '96 Well Eppendorf TwinTec PCR',
+                                              '1.5ml Eppendorf'],
+                                'src_pos' : [1, 2, 5],
+                                'dest_name' : 'dest',
+                                'dest_type' : '384 Well Biorad PCR',
+                                'dest_pos' : [10, 11, 12],
+                                'volume' : [2.0, 60.0, 5.5]})
+        self.cols = ['src_name', 'src_type', 'src_pos',
+                     'dest_name', 'dest_type', 'dest_pos']
+
+    def tearDown(self):
+        pass
+
+    def test_add_transfers(self):
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume')
+        # same commands as adding asp/disp/waste 1-by-1
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        for i in range(self.df.shape[0]):
+            asp = Fluent.Aspirate()
+            asp.RackLabel = self.df.loc[i,'src_name']
+            asp.RackType = self.df.loc[i,'src_type']
+            asp.Position = self.df.loc[i,'src_pos']
+            asp.Volume = self.df.loc[i,'volume']
+            gwl.add(asp)
+            disp = Fluent.Dispense()
+            disp.RackLabel = self.df.loc[i,'dest_name']
+            disp.RackType = self.df.loc[i,'dest_type']
+            disp.Position = self.df.loc[i,'dest_pos']
+            disp.Volume = self.df.loc[i,'volume']
+            gwl.add(disp)
+            gwl.add(Fluent.Waste())
+        self.assertEqual([x.cmd() for x in self.gwl.commands],
+                         [x.cmd() for x in gwl.commands])
+        # tube position
+        self.assertEqual(self.gwl.commands[6].Position, 1)
+
+    def test_n_tip_reuse(self):
+        self.gwl.add_transfers(self.df, *self.cols, volume=2, n_tip_reuse=2)
+        cmds = [x.cmd() for x in self.gwl.commands]
+        self.assertEqual([i for i,x in enumerate(cmds) if x == 'W;'], [4, 7])
+
+    def test_liq_cls_default(self):
+        # NaN => liq_cls; not in database => default liquid class (as in add())
+        self.df['liq_cls'] = ['Water Free Multi', None, 'not a liquid class']
+        self.gwl.add_transfers(self.df, *self.cols, volume='volume',
+                               liq_cls='MasterMix Free Single', liq_cls_col='liq_cls')
+        liq_clss = [x.LiquidClass for x in self.gwl.commands
+                    if isinstance(x, Fluent.Aspirate)]
+        self.assertEqual(liq_clss, ['Water Free Multi', 'MasterMix Free Single',
+                                    'Water Free Single'])
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        gwl.add_transfers(self.df, *self.cols, volume='volume', liq_cls='not a liquid class')
+        liq_clss = [x.LiquidClass for x in gwl.commands if isinstance(x, Fluent.Dispense)]
+        self.assertEqual(set(liq_clss), set(['Water Free Single']))
+
+    def test_bad_RackType(self):
+        self.df.loc[1, 'dest_type'] = 'not a RackType'
+        with self.assertRaises(KeyError):
+            self.gwl.add_transfers(self.df, *self.cols, volume='volume')
         
+class Test_gwl_columnar(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        TipTypes = ['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS']
+        self.gwl = Fluent.gwl(TipTypes)
+        self.gwl_col = Fluent.gwl_columnar(TipTypes)
+        for gwl in (self.gwl, self.gwl_col):
+            gwl.add(Fluent.Comment('test'))
+            for i,volume in enumerate([2, 2.0, 30.5]):
+                asp = Fluent.Aspirate()
+                asp.RackLabel = 'source'
+                asp.RackType = '96 Well Eppendorf TwinTec PCR'
+                asp.Position = i + 1
+                asp.Volume = volume
+                gwl.add(asp)
+                disp = Fluent.Dispense()
+                disp.RackLabel = 'dest'
+                disp.RackType = '384 Well Biorad PCR'
+                disp.Position = i + 10
+                disp.Volume = volume
+                gwl.add(disp)
+                gwl.add(Fluent.Waste())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write(self):
+        f1 = os.path.join(self.tmp_dir, 'obj.gwl')
+        f2 = os.path.join(self.tmp_dir, 'col.gwl')
+        self.gwl.write(f1)
+        self.gwl_col.write(f2)
+        with open(f1, 'rb') as inF1, open(f2, 'rb') as inF2:
+            self.assertEqual(inF1.read(), inF2.read())
+
+    def test_write_options(self):
+        f1 = os.path.join(self.tmp_dir, 'win.gwl')
+        self.gwl.write(f1, line_terminator='\r\n')
+        with open(f1, 'rb') as inF:
+            lines = inF.read().split(b'\r\n')
+        self.assertEqual(len(lines), len(self.gwl.commands) + 1)
+        self.assertEqual(lines[0], b'C;test')
+        # in-memory buffers (text & binary)
+        outF = io.StringIO()
+        self.gwl.write(outF)
+        self.assertEqual(len(outF.getvalue().split('\n')), len(lines))
+        outF = io.BytesIO()
+        self.gwl_col.write(outF, line_terminator='\r\n', encoding='ascii')
+        self.assertEqual(outF.getvalue().split(b'\r\n'), lines)
+
+    def test_list_commands(self):
+        cmds = self.gwl_col.list_commands()
+        self.assertEqual(len(cmds), len(self.gwl.commands))
+        self.assertTrue(isinstance(cmds[1], Fluent.Aspirate))
+        self.assertEqual([x.cmd() for x in cmds],
+                         [x.cmd() for x in self.gwl.commands])
+
+    def test_table(self):
+        df = self.gwl_col.table()
+        self.assertEqual(df.shape[0], 6)
+        self.assertEqual(df['Volume'].sum(), 2 * (2 + 2.0 + 30.5))
+        
+class Test_gwl_stream(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.TipTypes = ['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS']
+        self.df = pd.DataFrame({'src_name' : ['src', 'src', 'tube'],
+                                'src_type' : ['96 Well Eppendorf TwinTec PCR',
+                                              '96 Well Eppendorf TwinTec PCR',
+                                              '1.5ml Eppendorf'],
+                                'src_pos' : [1, 2, 5],
+                                'dest_name' : 'dest',
+                                'dest_type' : '384 Well Biorad PCR',
+                                'dest_pos' : [10, 11, 12],
+                                'volume' : [2.0, 60.0, 5.5]})
+        self.cols = ['src_name', 'src_type', 'src_pos',
+                     'dest_name', 'dest_type', 'dest_pos']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write(self):
+        f1 = os.path.join(self.tmp_dir, 'gwl.gwl')
+        f2 = os.path.join(self.tmp_dir, 'stream.gwl')
+        gwl = Fluent.gwl(self.TipTypes)
+        lw1 = Labware.labware()
+        lw2 = Labware.labware()
+        with Fluent.gwl_stream(f2, self.TipTypes, labware=lw2, buffer_size=2) as gwl_s:
+            for x in (gwl, gwl_s):
+                x.add(Fluent.Comment('test'))
+                x.add_transfers(self.df, *self.cols, volume='volume')
+        gwl.write(f1)
+        lw1.add_gwl(gwl)
+        # same gwl file & labware
+        with open(f1, 'rb') as inF1, open(f2, 'rb') as inF2:
+            self.assertEqual(inF1.read(), inF2.read())
+        self.assertEqual(len(gwl_s), 10)
+        self.assertEqual(gwl_s.commands, [])
+        self.assertEqual(lw1.tip_count, lw2.tip_count)
+        self.assertTrue(lw1.table().equals(lw2.table()))
+
+    def test_error(self):
+        # an error keeps the existing file & leaves no temporary file
+        f = os.path.join(self.tmp_dir, 'stream.gwl')
+        with open(f, 'w') as outF:
+            outF.write('C;old\n')
+        with self.assertRaises(ValueError):
+            with Fluent.gwl_stream(f, self.TipTypes, buffer_size=1) as gwl_s:
+                gwl_s.add_transfers(self.df, *self.cols, volume='volume')
+                raise ValueError('pipetting error')
+        with open(f) as inF:
+            self.assertEqual(inF.read(), 'C;old\n')
+        self.assertEqual(os.listdir(self.tmp_dir), ['stream.gwl'])
+
+class Test_read_gwl(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        self.gwl.add(Fluent.Comment('test'))
+        for i,volume in enumerate([2, 2.5, 30]):
+            asp = Fluent.Aspirate()
+            asp.RackLabel = 'source'
+            asp.RackType = '96 Well Eppendorf TwinTec PCR'
+            asp.Position = i + 1
+            asp.Volume = volume
+            self.gwl.add(asp)
+            disp = Fluent.Dispense()
+            disp.RackLabel = 'dest'
+            disp.RackType = '384 Well Biorad PCR'
+            disp.Position = i + 10
+            disp.Volume = volume
+            self.gwl.add(disp)
+            self.gwl.add(Fluent.Waste())
+        rd = Fluent.Reagent_distribution()
+        rd.SrcRackLabel = 'water'
+        rd.SrcRackType = '100ml_1'
+        rd.DestRackLabel = 'dest'
+        rd.DestRackType = '384 Well Biorad PCR'
+        rd.DestPosEnd = 20
+        rd.ExcludedDestWell = '2;5'
+        self.gwl.add(rd)
+        self.gwl.add(Fluent.Break())
+        self.text = io.StringIO()
+        self.gwl.write(self.text)
+        self.text = self.text.getvalue()
+
+    def tearDown(self):
+        pass
+
+    def test_iter_gwl(self):
+        cmds = list(Fluent.iter_gwl(io.StringIO(self.text), chunk_size=7))
+        self.assertEqual([x.cmd() for x in cmds],
+                         [x.cmd() for x in self.gwl.commands])
+        self.assertEqual(cmds[-2].ExcludedDestWell, '2;5')
+        # windows line breaks & binary file objects
+        f = io.BytesIO(self.text.replace('\n', '\r\n').encode('utf-8'))
+        self.assertEqual(len(list(Fluent.iter_gwl(f))), len(cmds))
+
+    def test_iter_gwl_small_chunks(self):
+        # '\r\n' & multi-byte characters split between chunks
+        text = u'C;h\u00e9llo\r\nW;\r\nB;\r\n'
+        for chunk_size in [1, 2, 3, 4, 8]:
+            f = io.BytesIO(text.encode('utf-8'))
+            cmds = list(Fluent.iter_gwl(f, chunk_size=chunk_size))
+            self.assertEqual([x.cmd() for x in cmds], [u'C;h\u00e9llo', 'W;', 'B;'])
+        f = io.BytesIO(self.text.replace('\n', '\r\n').encode('utf-8'))
+        cmds = list(Fluent.iter_gwl(f, chunk_size=3))
+        self.assertEqual([x.cmd() for x in cmds],
+                         [x.cmd() for x in self.gwl.commands])
+
+    def test_read_gwl(self):
+        for columnar in (False, True):
+            gwl = Fluent.read_gwl(io.StringIO(self.text),
+                                  TipTypes=['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'],
+                                  columnar=columnar)
+            out = io.StringIO()
+            gwl.write(out)
+            self.assertEqual(out.getvalue(), self.text)
+            self.assertEqual(gwl.count_tips(), self.gwl.count_tips())
+
+    def test_bad_line(self):
+        text = self.text.replace('W;', 'X;', 1)
+        with self.assertRaises(ValueError) as e:
+            list(Fluent.iter_gwl(io.StringIO(text)))
+        self.assertIn('Line 4', str(e.exception))
+
 class Test_labware(unittest.TestCase):
     def setUp(self):
         self.labware = Labware.labware()
@@ -99,7 +639,160 @@ class Test_labware(unittest.TestCase):
         self.gwl = Fluent.gwl()
         ret = self.labware.add_gwl(self.gwl)
         self.assertTrue(ret is None)
-    
+
+    def test_add_gwl_index(self):
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        df = pd.DataFrame({'src_name' : ['src1', 'src2', 'src1'],
+                           'src_type' : '96 Well Eppendorf TwinTec PCR',
+                           'src_pos' : [1, 2, 5],
+                           'dest_name' : 'dest',
+                           'dest_type' : '384 Well Biorad PCR',
+                           'dest_pos' : [10, 11, 12],
+                           'volume' : [2.0, 60.0, 5.5]})
+        gwl.add_transfers(df, 'src_name', 'src_type', 'src_pos',
+                          'dest_name', 'dest_type', 'dest_pos', volume='volume')
+        self.assertEqual(list(gwl.list_labware().keys()), ['src1', 'dest', 'src2'])
+        self.assertEqual(gwl.RackType_count('96 Well Eppendorf TwinTec PCR'), 2)
+        self.assertEqual(gwl.count_tips(), {'FCA, 10ul SBS' : 2, 'FCA, 200ul SBS' : 1})
+        # same as adding commands 1-by-1
+        self.labware.add_gwl(gwl)
+        lw = Labware.labware()
+        for cmd in gwl.commands:
+            lw.add_command(cmd, gwl)
+        self.assertEqual(lw.tip_count, self.labware.tip_count)
+        self.assertEqual(lw.labware_order, self.labware.labware_order)
+        # 1 pass over the commands
+        lw = Labware.labware()
+        lw.add_commands(iter(gwl.commands), gwl)
+        self.assertEqual(lw.tip_count, self.labware.tip_count)
+        self.assertEqual(lw.labware_order, self.labware.labware_order)
+        self.assertEqual(sorted(lw.tip_boxes), sorted(self.labware.tip_boxes))
+
+    def test_merge(self):
+        gwls = []
+        for dest in ['dest1', 'dest2']:
+            gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+            df = pd.DataFrame({'src_name' : 'src', 'src_type' : '25ml_1 waste',
+                               'src_pos' : 1, 'dest_name' : dest,
+                               'dest_type' : '96 Well Eppendorf TwinTec PCR',
+                               'dest_pos' : range(1, 97), 'volume' : 5.0})
+            gwl.add_transfers(df, 'src_name', 'src_type', 'src_pos',
+                              'dest_name', 'dest_type', 'dest_pos', volume='volume')
+            gwls.append(gwl)
+        for gwl in gwls:
+            self.labware.add_gwl(gwl)
+        lw1 = Labware.labware()
+        lw1.add_gwl(gwls[0])
+        lw2 = Labware.labware()
+        lw2.add_gwl(gwls[1])
+        lw = lw1.merge(lw2)
+        self.assertEqual(lw.tip_count, {'FCA, 10ul SBS' : 192})
+        self.assertEqual(lw.tip_count, self.labware.tip_count)
+        self.assertEqual(lw.labware_order, {'src' : 0, 'dest1' : 1, 'dest2' : 2})
+        self.assertEqual(len(lw.tip_boxes), 2)
+        pd.testing.assert_frame_equal(lw.table(), self.labware.table())
+
+class Test_layout(unittest.TestCase):
+    def setUp(self):
+        self.db = Fluent.db()
+        self.plate = self.db.get_labware('96 Well Eppendorf TwinTec PCR')
+        self.trough = self.db.get_labware('25ml_1 waste')
+
+    def tearDown(self):
+        pass
+
+    def test_free_positions(self):
+        pos = Labware.free_positions(self.db.target_position['Nest61mm_Pos'])
+        self.assertEqual(pos[:5], [6, 7, 8, 9, 12])
+        self.assertEqual(len(pos), 16)
+        # last position (position_count) is not used
+        for loc,last in [('eppendorf', 95), ('eppendorf_5ml', 7),
+                         ('Falcon10_Pos_1', 11), ('Trough_100ml_3', 9)]:
+            pos = Labware.free_positions(self.db.target_position[loc])
+            self.assertEqual(pos[-1], last)
+            self.assertEqual(len(pos), last)
+
+    def test_solve_layout(self):
+        racks = [('a', self.plate), ('b', self.plate), ('c', self.plate),
+                 ('trough', self.trough)]
+        layout = Labware.solve_layout(racks, self.db.target_position)
+        self.assertEqual(layout['a'], ('Nest61mm_Pos', 6))
+        self.assertEqual(layout['c'], ('Nest61mm_Pos', 8))
+        self.assertEqual(layout['trough'], ('Trough_100ml_3', 1))
+        # most transfers between a & c => adjacent
+        transfers = {('a', 'c') : 96, ('a', 'b') : 1, ('trough', 'a') : 96}
+        layout = Labware.solve_layout(racks, self.db.target_position, transfers)
+        self.assertEqual(abs(layout['a'][1] - layout['c'][1]), 1)
+        self.assertEqual(sorted([x[1] for x in layout.values()]), [1, 6, 7, 8])
+
+    def test_overflow(self):
+        racks = [('plate{}'.format(i), self.plate) for i in range(18)]
+        racks += [('trough{}'.format(i), self.trough) for i in range(10)]
+        with self.assertRaises(ValueError) as e:
+            Labware.solve_layout(racks, self.db.target_position)
+        msg = str(e.exception)
+        self.assertIn('"plate16", "plate17"', msg)
+        self.assertNotIn('"plate15"', msg)
+        self.assertIn('"trough9"', msg)
+        self.assertNotIn('"trough8"', msg)
+
+    def test_table(self):
+        gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        df = pd.DataFrame({'src_name' : ['src1', 'src2', 'src2', 'src2'],
+                           'src_type' : '96 Well Eppendorf TwinTec PCR',
+                           'src_pos' : [1, 2, 3, 4],
+                           'dest_name' : ['dest1', 'dest2', 'dest2', 'dest2'],
+                           'dest_type' : '96 Well Eppendorf TwinTec PCR',
+                           'dest_pos' : [1, 2, 3, 4],
+                           'volume' : 5.0})
+        gwl.add_transfers(df, 'src_name', 'src_type', 'src_pos',
+                          'dest_name', 'dest_type', 'dest_pos', volume='volume')
+        self.assertEqual(gwl.count_transfers(), {('src1', 'dest1') : 1,
+                                                 ('src2', 'dest2') : 3})
+        lw = Labware.labware()
+        lw.add_gwl(gwl)
+        lw2 = Labware.labware()
+        lw2.add_commands(gwl.commands, gwl)
+        self.assertEqual(lw.transfers, lw2.transfers)
+        df_lw = lw.table().set_index('labware_name')
+        pos = df_lw['target_position']
+        self.assertEqual(abs(pos['src2'] - pos['dest2']), 1)
+
+class Test_labware_utils(unittest.TestCase):
+    def setUp(self):
+        self.utils = Labware.utils()
+
+    def tearDown(self):
+        pass
+
+    def test_position2well(self):
+        self.assertEqual(self.utils.position2well(1), ['A', 1])
+        self.assertEqual(self.utils.position2well(96), ['H', 12])
+        self.assertEqual(self.utils.position2well(17, wells=384), ['A', 2])
+        self.assertEqual(self.utils.position2well(1536, wells=1536), ['AF', 48])
+        with self.assertRaises(KeyError):
+            self.utils.position2well(97)
+
+    def test_well2position(self):
+        self.assertEqual(self.utils.well2position('A01'), 1)
+        self.assertEqual(self.utils.well2position('B1'), 2)
+        self.assertEqual(self.utils.well2position('P24', wells=384), 384)
+        self.assertEqual(self.utils.well2position(5), 5)
+        with self.assertRaises(KeyError):
+            self.utils.well2position('I01')
+
+    def test_vectorized(self):
+        positions = list(range(1, 385))
+        rows,cols = self.utils.positions2wells(positions, wells=384)
+        self.assertEqual([rows[16], cols[16]], ['A', 2])
+        well_ids = ['{}{}'.format(r,c) for r,c in zip(rows, cols)]
+        ret = self.utils.wells2positions(well_ids, RackType='384 Well Biorad PCR')
+        self.assertEqual(ret.tolist(), positions)
+        geom = Labware.get_geometry(wells=384)
+        self.assertEqual(geom.rowcol2positions(rows, cols).tolist(), positions)
+        self.assertTrue(Labware.get_geometry('384 Well Biorad PCR') is not geom)
+        self.assertTrue(Labware.get_geometry(wells=384) is geom)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,6 +21,17 @@ test_dir = os.path.join(os.path.dirname(__file__))
 data_dir = os.path.join(test_dir, 'data')
 
 
+def well_volumes(gwl_file):
+    """Total volume dispensed into each well (RackLabel, Position)
+    """
+    volumes = {}
+    for cmd in Fluent.iter_gwl(gwl_file):
+        if isinstance(cmd, Fluent.Dispense):
+            key = (cmd.RackLabel, cmd.Position)
+            volumes[key] = round(volumes.get(key, 0) + cmd.Volume, 6)
+    return volumes
+
+
 # tests
 class Test_Map2Robot_main_basic(unittest.TestCase):
 
@@ -54,6 +65,27 @@ class Test_Map2Robot_main_single_barcode(unittest.TestCase):
         ret = Utils.check_gwl(self.files[0])
         self.assertIsNone(ret)
 
+
+class Test_Map2Robot_main_water_multi_disp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        mapfile = os.path.join(data_dir, 'basic_384well.txt')
+        prefix = os.path.join(self.tmp_dir, 'single_')
+        self.files = Map2Robot.main(Map2Robot.parse_args(['--prefix', prefix, mapfile]))
+        prefix = os.path.join(self.tmp_dir, 'multi_')
+        self.args = Map2Robot.parse_args(['--prefix', prefix, '--water-multi-disp', mapfile])
+        self.files_md = Map2Robot.main(self.args)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)        
+
+    def test_main_gwl(self):
+        ret = Utils.check_gwl(self.files_md[0])
+        self.assertIsNone(ret)
+        # same volume dispensed into each well
+        self.assertEqual(well_volumes(self.files_md[0]), well_volumes(self.files[0]))
+
         
 if __name__ == '__main__':
     unittest.main()
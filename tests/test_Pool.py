@@ -4,13 +4,16 @@
 # import
 ## batteries
 import os
+import io
 import sys
 import shutil
 import tempfile
 import unittest
 ## 3rd party
+import numpy as np
 import pandas as pd
 ## package
+from pyTecanFluent import Fluent
 from pyTecanFluent import Pool
 
 
@@ -35,6 +38,14 @@ class Test_96well_NoMap(unittest.TestCase):
     def test_main(self):
         Pool.main(self.args)
 
+    def test_main_error(self):
+        # no (empty) worklist file on error
+        args = Pool.parse_args(['--prefix', self.prefix, '--volume', '5000',
+                                self.pcr_file])
+        with self.assertRaises(ValueError):
+            Pool.main(args)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
 class Test_2_96well_Map(unittest.TestCase):
 
     def setUp(self):
@@ -53,6 +64,37 @@ class Test_2_96well_Map(unittest.TestCase):
     def test_main(self):
         Pool.main(self.args)
 
+class Test_pool_samples(unittest.TestCase):
+
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+        self.df = pd.DataFrame({'Sample' : ['s1', 's2', 's1', 's3'],
+                                'labware_name' : 'src',
+                                'labware_type' : '96 Well Eppendorf TwinTec PCR',
+                                'position' : [1, 2, 3, 4],
+                                'volume' : [5.0, np.nan, 6.0, 0],
+                                'TECAN_dest_labware_name' : 'dest',
+                                'TECAN_dest_labware_type' : '2ml Eppendorf',
+                                'TECAN_dest_target_position' : [1, 2, 1, 3]})
+
+    def tearDown(self):
+        pass
+
+    def test_missing_volume(self):
+        stderr = sys.stderr
+        sys.stderr = err = io.StringIO()
+        try:
+            Pool.pool_samples(self.df, self.gwl, 'Sample', 'labware_name',
+                              'labware_type', 'position', 'volume',
+                              'dest', '2ml Eppendorf', volume=None)
+        finally:
+            sys.stderr = stderr
+        self.assertIn('skipping sample "s2" because volume is missing', err.getvalue())
+        self.assertEqual(err.getvalue().count('volume <= 0'), 1)
+        # replicates pooled in order of first appearance
+        asp = [x.Position for x in self.gwl.commands if isinstance(x, Fluent.Aspirate)]
+        self.assertEqual(asp, [1, 3])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# import
+## batteries
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+## 3rd party
+import pandas as pd
+## package
+from pyTecanFluent import Fluent
+from pyTecanFluent import QPCR
+from pyTecanFluent import Utils
+
+
+# data dir
+test_dir = os.path.join(os.path.dirname(__file__))
+data_dir = os.path.join(test_dir, 'data')
+
+
+def well_volumes(gwl_file):
+    """Total volume dispensed into each well (RackLabel, Position)
+    """
+    volumes = {}
+    for cmd in Fluent.iter_gwl(gwl_file):
+        if isinstance(cmd, Fluent.Dispense):
+            key = (cmd.RackLabel, cmd.Position)
+            volumes[key] = round(volumes.get(key, 0) + cmd.Volume, 6)
+    return volumes
+
+
+# tests
+class Test_QPCR_main_plates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp_dir, 'output_')
+        self.setup_file = os.path.join(data_dir, 'qPCR_setup', 'qPCR_24samples.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_main_gwl(self):
+        # non-384 well destination plates (sorted instead of reordered)
+        for dest_type in ['96 Well Eppendorf TwinTec PCR',
+                          '48 Well Greiner CELLSTAR',
+                          '24 Well Greiner CELLSTAR']:
+            args = QPCR.parse_args(['--prefix', self.prefix,
+                                    '--dest-type', dest_type,
+                                    self.setup_file])
+            QPCR.main(args)
+            gwl_file = self.prefix + '.gwl'
+            self.assertIsNone(Utils.check_gwl(gwl_file))
+            disp = [x for x in Fluent.iter_gwl(gwl_file)
+                    if isinstance(x, Fluent.Dispense) and x.RackType == dest_type]
+            self.assertEqual(len(set([x.Position for x in disp])), 24)
+
+
+class Test_QPCR_main_water_multi_disp(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.setup_file = os.path.join(data_dir, 'qPCR_setup', 'qPCR_24samples.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_main_gwl(self):
+        gwl_files = []
+        for x in [[], ['--water-multi-disp']]:
+            prefix = os.path.join(self.tmp_dir, 'output{}_'.format(len(x)))
+            QPCR.main(QPCR.parse_args(['--prefix', prefix] + x + [self.setup_file]))
+            gwl_files.append(prefix + '.gwl')
+        self.assertIsNone(Utils.check_gwl(gwl_files[1]))
+        # same volume dispensed into each well
+        self.assertEqual(well_volumes(gwl_files[1]), well_volumes(gwl_files[0]))
+        # water multi-dispensed
+        liq_cls = set([x.LiquidClass for x in Fluent.iter_gwl(gwl_files[1])
+                       if isinstance(x, Fluent.Aspirate)])
+        self.assertIn('Water Free Multi Wall Disp', liq_cls)
+
+    def test_liq_cls_error(self):
+        args = QPCR.parse_args(['--prefix', os.path.join(self.tmp_dir, 'output_'),
+                                '--water-multi-disp', '--water-liq',
+                                'Water Contact Wet Single Ignore', self.setup_file])
+        with self.assertRaises(ValueError):
+            QPCR.main(args)
+
+
+if __name__ == '__main__':
+    unittest.main()
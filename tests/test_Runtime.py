@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# import
+## batteries
+import os
+import io
+import sys
+import unittest
+## package
+from pyTecanFluent import Fluent
+from pyTecanFluent import Runtime
+
+# data dir
+test_dir = os.path.join(os.path.dirname(__file__))
+data_dir = os.path.join(test_dir, 'data')
+
+
+class Test_runtime(unittest.TestCase):
+    def setUp(self):
+        self.gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+
+    def tearDown(self):
+        pass
+
+    def _transfer(self, gwl, dest_pos, volume=5):
+        asp = Fluent.Aspirate()
+        asp.RackLabel = 'src'
+        asp.RackType = '25ml_1 waste'
+        asp.Volume = volume
+        gwl.add(asp)
+        disp = Fluent.Dispense()
+        disp.RackLabel = 'dest'
+        disp.RackType = '96 Well Eppendorf TwinTec PCR'
+        disp.Position = dest_pos
+        disp.Volume = volume
+        gwl.add(disp)
+
+    def test_total(self):
+        rt = Runtime.runtime().add_gwl(self.gwl)
+        self.assertEqual(rt.total(), 0)
+        with self.gwl.using_tip_policy(Fluent.tip_new()):
+            self._transfer(self.gwl, 1)
+        t1 = Runtime.runtime().add_gwl(self.gwl).total()
+        self.assertTrue(t1 > 0)
+        with self.gwl.using_tip_policy(Fluent.tip_new()):
+            self._transfer(self.gwl, 2)
+        t2 = Runtime.runtime().add_gwl(self.gwl).total()
+        self.assertAlmostEqual(t2, t1 * 2)
+
+    def test_tip_pickups(self):
+        with self.gwl.using_tip_policy(Fluent.tip_flush()):
+            for i in range(4):
+                self._transfer(self.gwl, i + 1)
+        rt = Runtime.runtime().add_gwl(self.gwl)
+        self.assertEqual(rt.features[('tip_pickup',)], 1)
+        self.assertEqual(rt.features[('command', 'F')], 4)
+        self.assertEqual(rt.features[('liquid_class', 'Water', 'aspirate')], 20)
+
+    def test_reagent_distribution(self):
+        with self.gwl.using_tip_policy(Fluent.tip_new()):
+            for i in range(16):
+                self._transfer(self.gwl, i + 1)
+        n_R = self.gwl.collapse_reagent_runs(verbose=False)
+        self.assertEqual(n_R, 1)
+        rt = Runtime.runtime().add_gwl(self.gwl)
+        self.assertEqual(rt.features[('R_cycle',)], 2)
+        self.assertEqual(rt.features[('liquid_class', 'Water', 'dispense')], 80)
+
+    def test_add_file(self):
+        with self.gwl.using_tip_policy(Fluent.tip_new()):
+            self._transfer(self.gwl, 1)
+        outF = io.StringIO()
+        self.gwl.write(outF)
+        outF.seek(0)
+        rt1 = Runtime.runtime().add_file(outF)
+        rt2 = Runtime.runtime().add_gwl(self.gwl)
+        self.assertEqual(rt1.features, rt2.features)
+
+    def test_calibrate(self):
+        runs = []
+        for n in [1, 2, 4]:
+            gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+            with gwl.using_tip_policy(Fluent.tip_new()):
+                for i in range(n):
+                    self._transfer(gwl, i + 1)
+            rt = Runtime.runtime().add_gwl(gwl)
+            runs.append((rt, rt.total() * 1.5))
+        rt = Runtime.runtime()
+        rt.calibrate(runs)
+        for x,sec in runs:
+            x.params = rt.params
+            self.assertAlmostEqual(x.total(), sec, places=4)
+
+    def test_write(self):
+        with self.gwl.using_tip_policy(Fluent.tip_new()):
+            self._transfer(self.gwl, 1)
+        outF = io.StringIO()
+        Runtime.runtime().add_gwl(self.gwl).write(outF)
+        lines = outF.getvalue().rstrip().split('\n')
+        self.assertEqual(lines[0], '# Robot runtime estimate (min)')
+        self.assertTrue(lines[-1].startswith('Total:'))
+
+
+if __name__ == '__main__':
+    unittest.main()
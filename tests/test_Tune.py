@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# import
+## batteries
+import os
+import sys
+import argparse
+import unittest
+## 3rd party
+import pandas as pd
+## package
+from pyTecanFluent import Fluent
+from pyTecanFluent import Tune
+
+
+def make_gwl(df_map, args):
+    """Transfers from 1 trough to each destination well
+    """
+    gwl = Fluent.gwl(['FCA, 200ul SBS', 'FCA, 50ul SBS', 'FCA, 10ul SBS'])
+    with gwl.using_tip_policy(Fluent.tip_reuse(args.n_tip_reuse, same_source=False)):
+        for i,row in df_map.iterrows():
+            asp = Fluent.Aspirate()
+            asp.RackLabel = 'src'
+            asp.RackType = '25ml_1 waste'
+            asp.Volume = row['volume']
+            gwl.add(asp)
+            disp = Fluent.Dispense()
+            disp.RackLabel = 'dest'
+            disp.RackType = '96 Well Eppendorf TwinTec PCR'
+            disp.Position = row['position']
+            disp.Volume = row['volume']
+            gwl.add(disp)
+    return df_map, gwl
+
+
+class Test_tune(unittest.TestCase):
+    def setUp(self):
+        self.df_map = pd.DataFrame({'position' : range(1, 25), 'volume' : 5})
+        self.args = argparse.Namespace(n_tip_reuse=1)
+        self.grid = {'n_tip_reuse' : [1, 4, 2]}
+
+    def tearDown(self):
+        pass
+
+    def test_tune(self):
+        best, df = Tune.tune(make_gwl, self.df_map, self.args, self.grid,
+                             n_jobs=1, verbose=False)
+        self.assertEqual(best, {'n_tip_reuse' : 4})
+        self.assertEqual(df['n_tip_reuse'].tolist(), [4, 2, 1])
+        self.assertEqual(df['tips'].tolist(), [6, 12, 24])
+        # args not modified
+        self.assertEqual(self.args.n_tip_reuse, 1)
+
+    def test_tune_parallel(self):
+        best1, df1 = Tune.tune(make_gwl, self.df_map, self.args, self.grid,
+                               n_jobs=1, verbose=False)
+        best2, df2 = Tune.tune(make_gwl, self.df_map, self.args, self.grid,
+                               n_jobs=2, verbose=False)
+        self.assertEqual(best1, best2)
+        pd.testing.assert_frame_equal(df1, df2)
+
+
+if __name__ == '__main__':
+    unittest.main()
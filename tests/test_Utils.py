@@ -4,12 +4,14 @@
 # import
 ## batteries
 import os
+import io
 import sys
 import unittest
 ## 3rd party
 import pandas as pd
 ## package
 from pyTecanFluent import Utils
+from pyTecanFluent import Fluent
 
 
 # data dir
@@ -60,6 +62,77 @@ class Test_Utils(unittest.TestCase):
         gwl_file = os.path.join(data_dir, 'multi_dispense.gwl')
         ret = Utils.check_gwl(gwl_file)
         self.assertIsNone(ret)
+        gwl_file = os.path.join(data_dir, 'reagent_dispense.gwl')
+        self.assertIsNone(Utils.check_gwl(gwl_file))
+
+    def test_check_gwl_errors(self):
+        lines = ['C;test',
+                 'A;src;;96 Well Eppendorf TwinTec PCR;1;;10;Water Free Single;;;',
+                 'D;dest;;96 Well Eppendorf TwinTec PCR;97;;10;Water Free Single;;;',
+                 'A;src;;not a RackType;1;;ten;Water Free Single;;;',
+                 'D;dest;;;1;;10',
+                 'W;',
+                 'X;',
+                 'A;src;;96 Well Eppendorf TwinTec PCR;1;;10;Water Free Single;;;;extra;more']
+        with self.assertRaises(ValueError) as e:
+            Utils.check_gwl(io.StringIO('\n'.join(lines) + '\n'))
+        msg = str(e.exception)
+        self.assertTrue(msg.startswith('6 error(s)'))
+        for x in ['Line 3: Position 97', 'Line 4: RackType not in database',
+                  'Line 4: Volume is not a number', 'Line 5: D command has 7 fields',
+                  'Line 7: Not a valid gwl command', 'Line 8: A command has 13 fields']:
+            self.assertIn(x, msg)
+
+    def test_multi_disp_liq_cls(self):
+        gwl = Fluent.gwl()
+        x = Utils.multi_disp_liq_cls('Water Free Single Wall Disp', gwl)
+        self.assertEqual(x, 'Water Free Multi Wall Disp')
+        x = Utils.multi_disp_liq_cls('Water Free Multi', gwl)
+        self.assertEqual(x, 'Water Free Multi')
+        # no 'Single' in name; no multi-dispense version in the database
+        for x in ['Water Free', 'Water Contact Wet Single Ignore']:
+            with self.assertRaises(ValueError):
+                Utils.multi_disp_liq_cls(x, gwl)
+
+    def test_channel_batches(self):
+        gwl = Fluent.gwl()
+        # 384-well: odd & even rows of column 1 are pipetted separately
+        df = pd.DataFrame({'name' : 'plate', 'type' : '384 Well Biorad PCR',
+                           'pos' : range(1, 17)})
+        df = Utils.channel_batches(df, gwl, 'name', 'type', 'pos',
+                                   n_tip_reuse=2, verbose=False)
+        self.assertListEqual(df['pos'].tolist()[:4], [1, 2, 3, 4])
+        self.assertListEqual(df['CHANNEL'].tolist()[:4], [0, 0, 1, 1])
+        self.assertEqual(df['TIP'].nunique(), 8)
+        # 96-well: channel set by row; new tip batch after n_tip_reuse columns
+        df = pd.DataFrame({'name' : 'plate', 'type' : '96 Well Eppendorf TwinTec PCR',
+                           'pos' : [1, 3, 9, 11, 17]})
+        df = Utils.channel_batches(df, gwl, 'name', 'type', 'pos',
+                                   n_tip_reuse=2, verbose=False)
+        self.assertListEqual(df['pos'].tolist(), [1, 9, 3, 11, 17])
+        self.assertListEqual(df['CHANNEL'].tolist(), [0, 0, 2, 2, 0])
+        self.assertListEqual(df['TIP_BATCH'].tolist(), [0, 0, 0, 0, 1])
+        # 1536-well: every 4th row is reached by adjacent channels
+        df = pd.DataFrame({'name' : 'plate', 'type' : '1536 Well Greiner',
+                           'pos' : range(1, 33)})
+        df = Utils.channel_batches(df, gwl, 'name', 'type', 'pos', verbose=False)
+        self.assertListEqual(df['CHANNEL'].tolist()[:8], list(range(8)))
+        self.assertEqual(df['TIP'].nunique(), 32)
+
+    def test_reorder_384well(self):
+        gwl = Fluent.gwl()
+        for RackType,step in [('96 Well Eppendorf TwinTec PCR', 1),
+                              ('384 Well Biorad PCR', 2),
+                              ('1536 Well Greiner', 4)]:
+            df = pd.DataFrame({'name' : 'plate', 'type' : RackType,
+                               'pos' : range(8, 0, -1)})
+            df = Utils.reorder_384well(df, gwl, 'name', 'type', 'pos')
+            pos = df['pos'].tolist()
+            if step == 1:
+                self.assertListEqual(pos, list(range(8, 0, -1)))
+            else:
+                expect = sorted(range(1, 9), key=lambda x: ((x - 1) % step, x))
+                self.assertListEqual(pos, expect)
 
         
 if __name__ == '__main__':